@@ -0,0 +1,234 @@
+import math
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+PRUNE_INTERVAL = 60  # seconds between deletions of full (idle) SQLite buckets
+
+# Atomic refill-and-take on Redis: KEYS[1] bucket, ARGV capacity, refill per
+# second, now. Returns the seconds until a token is available, 0 if one was taken.
+REDIS_TAKE = """
+local capacity, rate, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+def parse_rate(text):
+    """"20/60" -> (20, 60.0): bursts of 20 requests, refilled over 60 seconds. None for "" or "0"."""
+    if not text or text.strip() == "0":
+        return None
+    count, _, seconds = text.partition("/")
+    return int(count), float(seconds or 60)
+
+
+def refill(tokens, updated, now, capacity, rate):
+    """Takes a token from a bucket. Returns (tokens left, seconds to wait, 0 if taken)."""
+    tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class TokenBuckets:
+    """Token buckets by key: `capacity` requests at once, refilled at capacity / per_seconds a second."""
+
+    backend = None
+
+    def take(self, key, capacity, per_seconds):
+        """Seconds until the key may make a request, 0 if this one is allowed."""
+        return self._take(key, capacity, capacity / per_seconds, time.time())
+
+
+class MemoryTokenBuckets(TokenBuckets):
+    """Buckets of this process only."""
+
+    backend = "memory"
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = {}  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def _take(self, key, capacity, rate, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens, wait = refill(tokens, updated, now, capacity, rate)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                # Buckets idle long enough are full again, forgetting them changes nothing
+                self._buckets = {k: v for k, v in self._buckets.items() if now - v[1] < 3600}
+        return wait
+
+
+class SQLiteTokenBuckets(TokenBuckets):
+    """Buckets shared by all workers of one machine through a SQLite file (WAL mode)."""
+
+    backend = "sqlite"
+
+    def __init__(self, path, idle_ttl=3600):
+        self.path = path
+        self.idle_ttl = idle_ttl
+        self._local = threading.local()
+        self._last_prune = 0
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        # sqlite3 connections cannot be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _take(self, key, capacity, rate, now):
+        db = self._db()
+        # IMMEDIATE: the read and the write of a bucket happen under one write lock
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, wait = refill(*(row or (capacity, now)), now, capacity, rate)
+            db.execute(
+                "INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                (key, tokens, now),
+            )
+            if now - self._last_prune > PRUNE_INTERVAL:
+                self._last_prune = now
+                db.execute("DELETE FROM buckets WHERE updated <= ?", (now - self.idle_ttl,))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return wait
+
+
+class RedisTokenBuckets(TokenBuckets):
+    """Buckets in Redis, shared by every node. Needs the redis package (pip install redis)."""
+
+    backend = "redis"
+    PREFIX = "chatbot:bucket:"
+
+    def __init__(self, url):
+        import redis
+
+        self.redis = redis.Redis.from_url(url, socket_timeout=2)
+        self._script = self.redis.register_script(REDIS_TAKE)
+
+    def _take(self, key, capacity, rate, now):
+        return float(self._script(keys=[self.PREFIX + key], args=[capacity, rate, now]))
+
+
+class Rejected(Exception):
+    """A request turned away before it reached the pipeline."""
+
+    def __init__(self, status, error, retry_after=None):
+        super().__init__(error)
+        self.status = status
+        self.error = error
+        self.retry_after = retry_after
+
+    def payload(self):
+        return {"error": self.error}
+
+    def headers(self):
+        return {"Retry-After": str(self.retry_after)} if self.retry_after else {}
+
+
+class AdmissionControl:
+    """Turns chat requests away (413 / 429 with Retry-After) before any upstream call.
+
+    Every traffic class ("interactive", "batch") has its own budgets: a token
+    bucket per session id and one per client IP, as (capacity, per_seconds)
+    or None for no limit. At most `max_in_flight` requests of this process run
+    at once, and batch traffic only gets `batch_share` of them.
+    """
+
+    def __init__(self, buckets, budgets, max_in_flight=64, batch_share=0.5, max_message_chars=2000):
+        self.buckets = buckets
+        self.budgets = budgets
+        self.max_in_flight = max_in_flight
+        self.batch_share = batch_share
+        self.max_message_chars = max_message_chars
+        self.in_flight = Counter()
+        self.peak = 0
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def admit(self, traffic, message, session_id, remote_addr):
+        """Takes a slot for the request or raises Rejected. The caller calls leave() when it is done."""
+        if len(message or "") > self.max_message_chars:
+            self._count(traffic, "too_large")
+            raise Rejected(413, f"Message is longer than {self.max_message_chars} characters")
+
+        limit = self.max_in_flight if traffic != "batch" else max(1, int(self.max_in_flight * self.batch_share))
+        with self._lock:
+            total = sum(self.in_flight.values())
+            if total >= self.max_in_flight or self.in_flight[traffic] >= limit:
+                self.stats[f"{traffic}:queue_full"] += 1
+                queue_full = True
+            else:
+                self.in_flight[traffic] += 1
+                self.peak = max(self.peak, total + 1)
+                queue_full = False
+        if queue_full:
+            raise Rejected(429, "Too many requests in progress, try again shortly", retry_after=1)
+
+        try:
+            budget = self.budgets.get(traffic, {})
+            # The IP bucket first: a client rotating session ids still runs out
+            for scope, key in (("ip", remote_addr), ("session", session_id or remote_addr)):
+                if budget.get(scope) and key:
+                    try:
+                        wait = self.buckets.take(f"{traffic}:{scope}:{key}", *budget[scope])
+                    except Exception as e:
+                        # The limiter must not take the chat down with it: fail open
+                        print(f"[RATE-LIMIT] Bucket store error, not limiting: {e}")
+                        self._count(traffic, "store_errors")
+                        wait = 0
+                    if wait:
+                        self._count(traffic, f"rate_{scope}")
+                        raise Rejected(429, "Too many requests, slow down", retry_after=math.ceil(wait))
+        except Exception:
+            self.leave(traffic)
+            raise
+        self._count(traffic, "admitted")
+
+    def leave(self, traffic):
+        with self._lock:
+            self.in_flight[traffic] -= 1
+
+    def _count(self, traffic, name):
+        with self._lock:
+            self.stats[f"{traffic}:{name}"] += 1
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            in_flight = dict(self.in_flight)
+        return {
+            "backend": self.buckets.backend,
+            "budgets": self.budgets,
+            "max_in_flight": self.max_in_flight,
+            "in_flight": in_flight,
+            "peak_in_flight": self.peak,
+            **stats,
+        }
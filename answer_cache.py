@@ -0,0 +1,162 @@
+import math
+import operator
+import sqlite3
+import threading
+import time
+from array import array
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    version TEXT NOT NULL,
+    entities TEXT NOT NULL,
+    question TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    answer TEXT NOT NULL,
+    created REAL NOT NULL,
+    last_hit REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS answers_version ON answers (version);
+"""
+
+DEFAULT_THRESHOLD = 0.93  # cosine similarity between two questions to reuse an answer
+NEAR_MISS_MARGIN = 0.05  # misses this close to the threshold are counted for tuning
+SYNC_INTERVAL = 30  # seconds between full re-reads of the ids other workers evicted
+MAX_CANDIDATES = 200  # most recent entries of one version / entities a question is compared with
+
+
+def _normalize(vector):
+    norm = sum(x * x for x in vector) ** 0.5
+    return [x / norm for x in vector] if norm else list(vector)
+
+
+def _dot(a, b):
+    return sum(map(operator.mul, a, b))
+
+
+if hasattr(math, "sumprod"):  # Python 3.12+: the same in C, several times faster
+    _dot = math.sumprod
+
+
+class SemanticAnswerCache:
+    """Answers to first-turn questions, shared by all workers through one SQLite file.
+
+    A question hits when an entry of the same knowledge-base version and the
+    same linked entities has a query embedding within `threshold` cosine
+    similarity. Every worker keeps the embeddings in memory and only reads
+    new rows from the file, so a lookup is one small query plus dot products,
+    computed outside the lock on a snapshot of the candidates.
+    """
+
+    def __init__(self, path, threshold=DEFAULT_THRESHOLD, ttl=86400, max_entries=500):
+        self.path = path
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._groups = {}  # (version, entities) -> {id: normalized embedding as array("f")}
+        self._keys = {}  # id -> (version, entities)
+        self._last_id = 0
+        self._last_sync = 0
+        self.stats = {"hits": 0, "misses": 0, "near_misses": 0, "stores": 0, "errors": 0}
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        # sqlite3 connections cannot be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _sync(self, now):
+        """Loads rows written by any worker since the last sync, drops evicted ones."""
+        db = self._db()
+        rows = db.execute(
+            "SELECT id, version, entities, embedding FROM answers WHERE id > ?", (self._last_id,)
+        ).fetchall()
+        for row_id, version, entities, blob in rows:
+            self._groups.setdefault((version, entities), {})[row_id] = array("f", blob)
+            self._keys[row_id] = (version, entities)
+            self._last_id = max(self._last_id, row_id)
+        if now - self._last_sync > SYNC_INTERVAL:
+            alive = {row_id for (row_id,) in db.execute("SELECT id FROM answers")}
+            for row_id in set(self._keys) - alive:
+                key = self._keys.pop(row_id)
+                del self._groups[key][row_id]
+                if not self._groups[key]:
+                    del self._groups[key]
+            self._last_sync = now
+
+    def lookup(self, version, entities, embedding):
+        """Returns (answer, score) of the closest fresh entry, or None."""
+        now = time.time()
+        query = _normalize(embedding)
+        try:
+            with self._lock:
+                self._sync(now)
+                # Ids grow with time: the last ones are the most recent entries
+                candidates = list(self._groups.get((version, entities), {}).items())[-MAX_CANDIDATES:]
+            best_score, best_id = max(((_dot(query, vector), row_id) for row_id, vector in candidates), default=(0, None))
+            if best_id is not None and best_score >= self.threshold:
+                db = self._db()
+                row = db.execute(
+                    "SELECT answer FROM answers WHERE id = ? AND created > ?", (best_id, now - self.ttl)
+                ).fetchone()
+                if row:
+                    with db:
+                        db.execute("UPDATE answers SET hits = hits + 1, last_hit = ? WHERE id = ?", (now, best_id))
+                    self._count("hits")
+                    return row[0], best_score
+        except sqlite3.Error as e:
+            print(f"Answer cache error: {e}")
+            self._count("errors")
+            return None
+
+        self._count("misses")
+        if best_score >= self.threshold - NEAR_MISS_MARGIN:
+            self._count("near_misses")
+            print(f"[ANSWER-CACHE] Near miss ({best_score:.3f})")
+        return None
+
+    def store(self, version, entities, question, embedding, answer):
+        now = time.time()
+        blob = array("f", _normalize(embedding)).tobytes()
+        try:
+            db = self._db()
+            with db:
+                db.execute(
+                    "INSERT INTO answers (version, entities, question, embedding, answer, created, last_hit) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (version, entities, question, blob, answer, now, now),
+                )
+                # Eviction: other versions, expired entries, then least recently hit over the limit
+                db.execute("DELETE FROM answers WHERE version != ? OR created <= ?", (version, now - self.ttl))
+                db.execute(
+                    "DELETE FROM answers WHERE id NOT IN (SELECT id FROM answers ORDER BY last_hit DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+            self._count("stores")
+        except sqlite3.Error as e:
+            print(f"Answer cache error: {e}")
+            self._count("errors")
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        try:
+            stats["entries"] = self._db().execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        except sqlite3.Error:
+            stats["entries"] = None
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+        stats["threshold"] = self.threshold
+        return stats
@@ -1,8 +1,36 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
 import openai
+import concurrent.futures
+import contextvars
 import json
 import os
+import hashlib
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from collections import Counter
 from dotenv import load_dotenv
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import answer_cache
+import calculator
+import circuit
+import concurrency
+import admission
+import extractive
+import idempotency
+import intents
+import openai_clients
+import profanity
+import programs
+import router
+import sessions
+import warmup
+from singleflight import SingleFlight
+from stage_timings import StageTimings
+from textnorm import normalize_text
+from ttl_cache import TTLCache
 
 load_dotenv()
 
@@ -13,11 +41,293 @@ openai.api_key = os.getenv("OPENAI_API_KEY")
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_FILE = os.path.join(BASE_DIR, "scrap website data", "meu_data.json")
 CHUNKS = []
-CONVERSATION_HISTORY = {}
+CHUNK_META = {}  # chunk index -> {"program_id": ..., "program_type": ..., "faculty_id": ...}
+KB_VERSION = None  # Short hash of the data file, changes whenever the knowledge base changes
+KB_MTIME = None  # mtime of the loaded data file; a newer file is reloaded
+KB_CHECK_INTERVAL = float(os.getenv("KB_CHECK_INTERVAL", "30"))  # seconds between mtime checks
+KB_CHECKED_AT = 0
+KB_LOCK = threading.Lock()
+PROGRAM_INDEX = None  # programs.ProgramIndex for structured range / comparison queries
+PROMPT_PREFIX = ""  # static start of every completion prompt for this version (see build_prompt_prefix)
+
+UNKNOWN_INFO_ANSWER = (
+    "للحصول على المعلومة المطلوبة يمكنك التواصل مع الجامعة من خلال الارقام التالية \n"
+    "+962 6 4790222\n"
+    "+962 79 712 2000\n"
+    "او عبر الواتس اب \n"
+    "+962 79 712 2000"
+)
+
+# Template answers for intents detected locally (see intents.py).
+# "contact" is rebuilt from the data file in load_data().
+CANNED_ANSWERS = {
+    "greeting": (
+        "أهلاً وسهلاً بك! أنا المساعد الآلي لجامعة الشرق الأوسط. كيف يمكنني مساعدتك؟\n"
+        "Welcome! I am the Middle East University assistant. How can I help you?"
+    ),
+    "thanks": (
+        "عفواً، يسعدنا خدمتك دائماً! هل هناك أي شيء آخر يمكنني مساعدتك به؟\n"
+        "You're welcome! Is there anything else I can help you with?"
+    ),
+    "developer": "تم تطويري من قبل دائرة تكنولوجيا المعلومات في جامعة الشرق الاوسط. I was developed by the IT Department at Middle East University.",
+    "contact": UNKNOWN_INFO_ANSWER,
+    "contact_admission": "يمكنك التواصل مع القبول و التسجيل من خلال الرقم +962 79 712 2000",
+    "contact_finance": "يمكنك التواصل من خلال الرقم التالي +962 6 4790222",
+    "facilities": (
+        "مرافق الجامعة :\n"
+        "الملعب الأولمبي\n"
+        "صالة اللياقة البدنية\n"
+        "الملاعب الرياضية الخارجية\n"
+        "الملاعب الرياضية الداخلية\n"
+        "نكست ليفل\n"
+        "مواقف السيارات\n"
+        "المواصلات\n"
+        "أماكن العبادة\n"
+        "خدمات الطعام والشراب\n"
+        "خدمات الإنترنت\n"
+        "الخدمات البنكية\n"
+        "خدمات ذوي الإحتياجات الخاصة\n"
+        "الخدمات الطبية والتأمين الصحي\n"
+        "مركز جامعة الشرق الأوسط للعلاج الحكمي"
+    ),
+    "recreational_facilities": (
+        "المرافق الترفيهية :\n"
+        "نكست ليفل\n"
+        "الملعب الأولمبي\n"
+        "صالة اللياقة البدنية\n"
+        "الملاعب الرياضية الخارجية\n"
+        "الملاعب الرياضية الداخلية\n"
+        "خدمات الطعام والشراب"
+    ),
+    "health_facilities": (
+        "المرافق الصحية :\n"
+        "الخدمات الطبية والتأمين الصحي\n"
+        "مركز جامعة الشرق الأوسط للعلاج الحكمي "
+    ),
+}
+
+# Local intent classifier (see intents.py)
+INTENT_CONFIDENCE_THRESHOLD = float(os.getenv("INTENT_CONFIDENCE_THRESHOLD", intents.DEFAULT_CONFIDENCE_THRESHOLD))
+INTENT_HITS = Counter()
+STATS_LOCK = threading.Lock()  # guards the monitoring counters
+METRICS_SOURCES = {}  # extra /api/metrics sections: name -> function returning a dict (e.g. asgi_app.py)
+
+# Latency budget for a completion; past it (or on any upstream error) the
+# answer is extracted locally from the retrieved chunks (see extractive.py)
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "20"))
+SUMMARY_MODE_ANSWERS = Counter()  # reason -> count
+DEGRADED = Counter()  # local stand-ins used for failed upstream calls (lexical retrieval, ...)
+PROMPT_TOKENS = Counter()  # calls, prompt / cached / completion tokens of the completions
+
+# Canonical questions served by GET /api/faq/<key> (the suggestion chips).
+# Answers are computed once per knowledge-base version and are HTTP cacheable,
+# so browsers and the IIS / nginx front end can answer them without Python.
+FAQ_QUESTIONS = {
+    "international-programs": "البرامج الدولية",
+    "diploma-programs": "ما تخصصات الدبلوم المتوسط",
+    "bachelor-programs": "ما تخصصات البكالوريوس",
+    "master-programs": "ما تخصصات الماجستير",
+    "contact": "كيف يمكنني التواصل",
+    "facilities": "ما مرافق الجامعة",
+}
+FAQ_MAX_AGE = int(os.getenv("FAQ_MAX_AGE", "3600"))  # seconds
+FAQ_ANSWERS = {}  # (KB_VERSION, key) -> response payload
+FAQ_LOCK = threading.Lock()
+
+# Answers to first-turn questions shared by all workers (see answer_cache.py).
+# A new question reuses an answer when its embedding is close enough. ANSWER_CACHE=0 disables it.
+ANSWER_CACHE = None
+if os.getenv("ANSWER_CACHE", "1") != "0":
+    ANSWER_CACHE = answer_cache.SemanticAnswerCache(
+        os.getenv("ANSWER_CACHE_PATH", os.path.join(BASE_DIR, "answer_cache.sqlite3")),
+        threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", answer_cache.DEFAULT_THRESHOLD)),
+        ttl=int(os.getenv("ANSWER_CACHE_TTL", "86400")),
+        max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "500")),
+    )
+
+# Local bad-words filter, checked before anything else (see profanity.py).
+# MODERATION_ALLOWLIST adds comma-separated words that must never be blocked.
+WORD_FILTER = profanity.WordFilter(
+    allowlist=profanity.ALLOWLIST + [word.strip() for word in os.getenv("MODERATION_ALLOWLIST", "").split(",") if word.strip()],
+)
+
+# OpenAI moderation verdicts (flagged or clean) per normalized message.
+# The key includes the model and policy version, so changing either invalidates old verdicts.
+MODERATION_MODEL = os.getenv("MODERATION_MODEL", "omni-moderation-latest")
+MODERATION_POLICY_VERSION = os.getenv("MODERATION_POLICY_VERSION", "1")
+MODERATION_CACHE = TTLCache(
+    max_size=int(os.getenv("MODERATION_CACHE_SIZE", "10000")),
+    ttl=int(os.getenv("MODERATION_CACHE_TTL", "86400")),
+)
+
+# Per-worker caches of question embeddings and retrieval results
+QUERY_EMBEDDING_CACHE = TTLCache(max_size=5000, ttl=86400)
+RETRIEVAL_CACHE = TTLCache(max_size=5000, ttl=86400)
+
+# Cache warming: after every knowledge-base load the FAQ and the most asked
+# questions (warm_queries.json, written by mine_queries.py) go through the pipeline.
+WARM_CACHES = os.getenv("WARM_CACHES", "1") != "0"
+WARM_QUERIES_FILE = os.getenv("WARM_QUERIES_FILE", os.path.join(BASE_DIR, "warm_queries.json"))
+WARM_QUERIES_LIMIT = int(os.getenv("WARM_QUERIES_LIMIT", "50"))
+WARMUP = {"version": None, "owner": None, "questions": 0, "warmed": 0, "errors": 0}
+# Only one worker of the machine warms a version (see warmup.py). The others
+# read the FAQ answers it shares and hit the answer cache it fills.
+SHARED_WARMUP = warmup.SharedWarmup(os.getenv("WARMUP_PATH", os.path.join(BASE_DIR, "warmup.sqlite3")))
+WARMUP_POLL_SECONDS = 60  # how often a worker that lost the claim checks the warmer is alive
+
+# Every chat turn is appended here as JSON lines (input of mine_queries.py). Empty disables it.
+CONVERSATION_LOG = os.getenv("CONVERSATION_LOG", os.path.join(BASE_DIR, "logs", "conversations.jsonl"))
+CONVERSATION_LOG_LOCK = threading.Lock()
+
+
+# Identical first-turn questions in flight at the same moment share one upstream run
+SINGLE_FLIGHT = SingleFlight(timeout=float(os.getenv("SINGLE_FLIGHT_TIMEOUT", "30")))
+
+# Conversations by session id: the last messages and the state for follow-up
+# questions (active program, chosen degree type, ...). See sessions.py.
+# SESSION_STORE=sqlite (default) shares them between the workers of a machine,
+# redis between machines, memory keeps them per process. SESSION_STORE=token
+# keeps nothing on the server: the conversation travels in a signed state token
+# (STATE_TOKENS) that every answer returns and the client sends back.
+SESSION_STORE = os.getenv("SESSION_STORE", "sqlite")
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))  # seconds since the last turn
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+SESSIONS = STATE_TOKENS = None
+if SESSION_STORE == "token":
+    SESSION_SECRET = os.getenv("SESSION_SECRET")
+    if not SESSION_SECRET:
+        # Tokens then only verify on this process: set SESSION_SECRET with several workers or nodes
+        print("SESSION_SECRET is not set, signing state tokens with a per-process key")
+        SESSION_SECRET = os.urandom(32).hex()
+    STATE_TOKENS = sessions.StateTokens(SESSION_SECRET, ttl=SESSION_TTL)
+elif SESSION_STORE == "redis":
+    SESSIONS = sessions.RedisSessionStore(os.getenv("REDIS_URL", "redis://localhost:6379/0"), ttl=SESSION_TTL, max_sessions=SESSION_MAX)
+elif SESSION_STORE == "memory":
+    SESSIONS = sessions.MemorySessionStore(ttl=SESSION_TTL, max_sessions=SESSION_MAX)
+else:
+    SESSIONS = sessions.SQLiteSessionStore(
+        os.getenv("SESSION_DB_PATH", os.path.join(BASE_DIR, "sessions.sqlite3")), ttl=SESSION_TTL, max_sessions=SESSION_MAX,
+    )
+
+# Results of recent /api/chat requests by the client's Idempotency-Key, so a retried
+# request attaches to the original (or gets its stored answer) instead of running again.
+# Completed results are shared like the sessions: IDEMPOTENCY_STORE=sqlite between
+# the workers of a machine, redis between machines, memory keeps them per process.
+IDEMPOTENCY_STORE = os.getenv("IDEMPOTENCY_STORE", "redis" if SESSION_STORE == "redis" else "sqlite")
+if IDEMPOTENCY_STORE == "redis":
+    IDEMPOTENCY_SHARED = idempotency.RedisResults(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+elif IDEMPOTENCY_STORE == "memory":
+    IDEMPOTENCY_SHARED = None
+else:
+    IDEMPOTENCY_SHARED = idempotency.SQLiteResults(os.getenv("IDEMPOTENCY_DB_PATH", os.path.join(BASE_DIR, "idempotency.sqlite3")))
+IDEMPOTENCY = idempotency.IdempotencyStore(
+    ttl=int(os.getenv("IDEMPOTENCY_TTL", "300")),
+    wait_timeout=float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", "60")),
+    shared=IDEMPOTENCY_SHARED,
+)
+
+# Admission control: chat requests over budget are answered 429 (with Retry-After)
+# before any upstream call, messages over MAX_MESSAGE_CHARS 413 (see admission.py).
+# Budgets are "requests/seconds" token buckets per client IP and per session id,
+# separate for interactive chat and for batch / evaluation traffic (requests with
+# the header X-Traffic-Class: batch); "0" disables one. Buckets are shared by the
+# workers through RATE_LIMIT_STORE=sqlite (default) or redis; memory is per process.
+# MAX_IN_FLIGHT caps the requests a process runs at once, batch getting BATCH_SHARE of it.
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "sqlite")
+if RATE_LIMIT_STORE == "redis":
+    RATE_LIMIT_BUCKETS = admission.RedisTokenBuckets(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+elif RATE_LIMIT_STORE == "memory":
+    RATE_LIMIT_BUCKETS = admission.MemoryTokenBuckets()
+else:
+    RATE_LIMIT_BUCKETS = admission.SQLiteTokenBuckets(os.getenv("RATE_LIMIT_DB_PATH", os.path.join(BASE_DIR, "ratelimit.sqlite3")))
+ADMISSION = admission.AdmissionControl(
+    RATE_LIMIT_BUCKETS,
+    budgets={
+        "interactive": {
+            "ip": admission.parse_rate(os.getenv("RATE_LIMIT_IP", "120/60")),  # a campus NAT is one IP
+            "session": admission.parse_rate(os.getenv("RATE_LIMIT_SESSION", "10/60")),
+        },
+        "batch": {
+            "ip": admission.parse_rate(os.getenv("RATE_LIMIT_BATCH_IP", "60/60")),
+            "session": admission.parse_rate(os.getenv("RATE_LIMIT_BATCH_SESSION", "0")),
+        },
+    },
+    max_in_flight=int(os.getenv("MAX_IN_FLIGHT", "64")),
+    batch_share=float(os.getenv("BATCH_SHARE", "0.5")),
+    max_message_chars=int(os.getenv("MAX_MESSAGE_CHARS", "2000")),
+)
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("MAX_REQUEST_BYTES", "65536"))  # larger bodies get 413
+
+# The per-IP budget needs the client's address, not the proxy's: TRUSTED_PROXIES
+# is the number of proxies in front of the app (the Heroku router, nginx, IIS
+# ARR), each appending the address it got the request from to X-Forwarded-For.
+# 0 (default) trusts no header, for a server clients reach directly.
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "0"))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+# Adaptive concurrency per OpenAI endpoint (see concurrency.py): each window grows
+# while calls succeed and shrinks on 429s, timeouts and latency spikes, so the
+# process stays near its quota instead of failing in bursts. Calls over the
+# window queue by priority class: interactive, then batch, then warm-up.
+# UPSTREAM_MAX_CONCURRENCY bounds every window, UPSTREAM_QUEUE_TIMEOUT the wait
+# (past it the call fails like an upstream error: summary mode for completions).
+# A 429 pauses the endpoint for its Retry-After and the call queues again.
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "64"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "10"))
+UPSTREAM_RATE_LIMIT_RETRIES = int(os.getenv("UPSTREAM_RATE_LIMIT_RETRIES", "2"))
+UPSTREAM_LIMITS = {
+    endpoint: concurrency.AdaptiveLimiter(
+        endpoint, initial=initial, max_limit=UPSTREAM_MAX_CONCURRENCY, latency_tolerance=tolerance,
+        queue_timeout=UPSTREAM_QUEUE_TIMEOUT, congestion_errors=(openai.APITimeoutError,),
+    )
+    # Completion times vary with the answer length (and routing tier): more tolerance
+    for endpoint, initial, tolerance in (("chat", 8, 4.0), ("embeddings", 16, 2.0), ("moderations", 16, 2.0))
+}
+# Priority class of the upstream calls of the current request (the traffic class, or "warmup")
+UPSTREAM_PRIORITY = contextvars.ContextVar("UPSTREAM_PRIORITY", default="interactive")
+
+# Circuit breakers per OpenAI endpoint (see circuit.py). An endpoint failing (or
+# slower than its BREAKER_SLOW_* seconds) in BREAKER_FAILURE_RATIO of its recent
+# calls is not called for BREAKER_OPEN_SECONDS, then probed again. Meanwhile
+# requests degrade at once: local moderation only, keyword retrieval, and
+# canned or extractive (summary mode) answers.
+UPSTREAM_BREAKERS = {
+    endpoint: circuit.CircuitBreaker(
+        endpoint,
+        failure_ratio=float(os.getenv("BREAKER_FAILURE_RATIO", "0.5")),
+        min_calls=int(os.getenv("BREAKER_MIN_CALLS", "5")),
+        window=int(os.getenv("BREAKER_WINDOW", "20")),
+        slow_seconds=float(os.getenv(f"BREAKER_SLOW_{endpoint.upper()}", slow)),
+        open_seconds=float(os.getenv("BREAKER_OPEN_SECONDS", "30")),
+    )
+    for endpoint, slow in (("chat", str(LLM_TIMEOUT_SECONDS * 0.75)), ("embeddings", "5"), ("moderations", "3"))
+}
+
+# Sessions keep a compact state instead of the transcript: the active program /
+# faculty and a rolling summary of the last SUMMARY_TURNS turns (question and
+# start of the answer, SUMMARY_CHARS each), which is all the prompt gets
+SUMMARY_TURNS = 3
+SUMMARY_CHARS = 160
+
+# Moderation and the query embedding are independent upstream calls: they run
+# side by side on this pool (see screen()). Durations of every stage go to STAGE_TIMINGS.
+PIPELINE_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=int(os.getenv("PIPELINE_THREADS", "16")), thread_name_prefix="pipeline")
+STAGE_TIMINGS = StageTimings()
+
+# Model routing: every question that reaches the LLM step gets the model tier,
+# token limit and temperature of the first matching rule (see router.py), or an
+# answer without the LLM. ROUTING_TABLE is a JSON file replacing the default table.
+# The completion time of each tier is recorded as the stage "route:<tier>".
+ROUTER = router.Router.load(os.environ["ROUTING_TABLE"]) if os.getenv("ROUTING_TABLE") else router.Router()
 
 def load_data():
-    """Loads JSON and creates text chunks for retrieval."""
-    global CHUNKS
+    """Loads JSON and creates text chunks for retrieval.
+
+    Chunks, embeddings and the program index are built aside and published
+    together, so a reload never shows requests a half-built knowledge base.
+    """
+    global CHUNKS, CHUNK_META, CHUNK_EMBEDDINGS, LEXICAL_INDEX, KB_VERSION, KB_MTIME, PROGRAM_INDEX, PROMPT_PREFIX
     print("Loading data...")
     if not os.path.exists(DATA_FILE):
         print("Data file not found!")
@@ -28,10 +338,23 @@ def load_data():
          # Try absolute path from previous context if relative fails
          expected_path = r"e:\Projects\chatBot v.3\scrap website data\meu_data.json"
 
-    with open(expected_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    mtime = os.path.getmtime(expected_path)
+    with open(expected_path, 'rb') as f:
+        raw = f.read()
+    version = hashlib.sha1(raw).hexdigest()[:12]
+    if CHUNKS and version == KB_VERSION:
+        # File touched but content unchanged
+        KB_MTIME = mtime
+        print(f"Data unchanged (version {version}).")
+        return
+    data = json.loads(raw.decode('utf-8'))
+
+    # Typed program records for structured queries (built once per knowledge-base version)
+    program_index = programs.build_index(data, version)
 
     # Chunking Strategy
+    chunks = []
+    chunk_meta = {}  # chunk index -> {"program_id": ..., "program_type": ..., "faculty_id": ...}
     
     # 1. Admin/About Info
     if "about" in data:
@@ -40,24 +363,24 @@ def load_data():
         if "president_message" in about:
             pm = about["president_message"]
             text = f"University President (رئيس الجامعة): {pm.get('president_name', 'Unknown')}. Message: {pm.get('message', '')}"
-            CHUNKS.append(text)
+            chunks.append(text)
         
         # Board of Trustees
         if "board_of_trustees" in about:
             bot = about["board_of_trustees"]
             members = ", ".join(bot.get("members", []))
-            CHUNKS.append(f"Board of Trustees Chairman (رئيس مجلس الأمناء): {bot.get('chairman', 'Unknown')}. Members: {members}")
+            chunks.append(f"Board of Trustees Chairman (رئيس مجلس الأمناء): {bot.get('chairman', 'Unknown')}. Members: {members}")
 
         # Board of Directors
         if "board_of_directors" in about:
             bod = about["board_of_directors"]
             members = ", ".join(bod.get("members", []))
-            CHUNKS.append(f"Board of Directors Chairman (رئيس هيئة المديرين): {bod.get('chairman', 'Unknown')}. Members: {members}")
+            chunks.append(f"Board of Directors Chairman (رئيس هيئة المديرين): {bod.get('chairman', 'Unknown')}. Members: {members}")
 
         # Deans
         if "council_of_deans" in about:
              members = ", ".join(about["council_of_deans"].get("members", []))
-             CHUNKS.append(f"The Council of Deans (مجلس العمداء) members are: {members}")
+             chunks.append(f"The Council of Deans (مجلس العمداء) members are: {members}")
 
         # Contact Info
         if "contact" in data:
@@ -77,12 +400,21 @@ def load_data():
                 f"Email (البريد الإلكتروني): {email}. "
                 f"Working Hours (ساعات الدوام): {work_hours}."
             )
-            CHUNKS.append(contact_chunk)
+            chunks.append(contact_chunk)
+
+            CANNED_ANSWERS["contact"] = (
+                f"معلومات التواصل مع الجامعة:\n"
+                f"الهاتف: {phones.get('landline')}\n"
+                f"الموبايل / واتس اب: {phones.get('mobile')}\n"
+                f"العنوان: {addr_str}\n"
+                f"البريد الإلكتروني: {email}\n"
+                f"ساعات الدوام: {work_hours}"
+            )
 
     # 2. Key Figures
     if "key_figures" in data:
         for role, name in data["key_figures"].items():
-            CHUNKS.append(f"Key Figure - {role.replace('_', ' ').title()}: {name}")
+            chunks.append(f"Key Figure - {role.replace('_', ' ').title()}: {name}")
 
     # 3. Admission
     if "admission" in data:
@@ -92,7 +424,7 @@ def load_data():
             steps = " ".join(mp.get("steps", []))
             reqs = " ".join(mp.get("requirements", []))
             # keywords: admission, master, قبول, ماجستير, تسجيل
-            CHUNKS.append(f"Master's Degree Admission Procedures (إجراءات قبول الماجستير): {steps}. Requirements: {reqs}")
+            chunks.append(f"Master's Degree Admission Procedures (إجراءات قبول الماجستير): {steps}. Requirements: {reqs}")
 
     # 4. International Programs
     if "uk_degrees" in data:
@@ -100,7 +432,7 @@ def load_data():
         progs = ", ".join(uk.get("programs", []))
         desc = uk.get("description", "")
         # Use Q&A format to help the LLM understand this is the answer
-        CHUNKS.append(
+        chunks.append(
             f"Question: What are the International Programs? British Degrees? (البرامج الدولية / البرامج البريطانية). "
             f"Answer: {desc} Programs include: {progs}."
         )
@@ -109,6 +441,8 @@ def load_data():
     bachelor_names = []
     faculty_map = {} # Map faculty_name -> list of majors
 
+    faculty_ids = {} # Map faculty_name -> faculty id
+
     if "ebooklet" in data and "bachelor_programs" in data["ebooklet"]:
         for prog in data["ebooklet"]["bachelor_programs"]:
             name = prog.get("name_ar", "Unknown Program")
@@ -127,6 +461,7 @@ def load_data():
             if faculty_ar not in faculty_map:
                 faculty_map[faculty_ar] = {"en": faculty_en, "majors": []}
             faculty_map[faculty_ar]["majors"].append(f"{name}")
+            faculty_ids[faculty_ar] = prog.get("faculty_id")
 
             # Requirements (summarized)
             reqs = ""
@@ -153,7 +488,8 @@ def load_data():
             if "required_documents" in prog:
                 chunk += f" Required Documents (الوثائق المطلوبة): {prog['required_documents']}"
             
-            CHUNKS.append(chunk)
+            chunks.append(chunk)
+            chunk_meta[len(chunks) - 1] = {"program_id": eng_name, "program_type": "bachelor", "faculty_id": prog.get("faculty_id")}
 
         # Create Faculty Summary Chunks
         for f_ar, data_obj in faculty_map.items():
@@ -165,12 +501,13 @@ def load_data():
                 f"List of Majors/Programs (قائمة التخصصات): {majors_list}. "
                 f"Degrees offered: Bachelor (بكالوريوس)."
             )
-            CHUNKS.append(summary)
+            chunks.append(summary)
+            chunk_meta[len(chunks) - 1] = {"faculty_id": faculty_ids.get(f_ar)}
             
         # Add Bachelor Summary Chunk (Aggregate all names)
         if bachelor_names:
             full_list = ", ".join(bachelor_names)
-            CHUNKS.append(f"List of all Bachelor Programs (تخصصات البكالوريوس المتاحة): {full_list}")
+            chunks.append(f"List of all Bachelor Programs (تخصصات البكالوريوس المتاحة): {full_list}")
 
     # 6. Master Programs
     master_names = []
@@ -207,12 +544,13 @@ def load_data():
             if "required_documents" in prog:
                 chunk += f" Required Documents (الوثائق المطلوبة): {prog['required_documents']}"
             
-            CHUNKS.append(chunk)
+            chunks.append(chunk)
+            chunk_meta[len(chunks) - 1] = {"program_id": eng_name, "program_type": "master"}
 
         # Add Master Summary Chunk
         if master_names:
             full_list = ", ".join(master_names)
-            CHUNKS.append(f"List of all Master Programs (تخصصات الماجستير المتاحة): {full_list}")
+            chunks.append(f"List of all Master Programs (تخصصات الماجستير المتاحة): {full_list}")
 
     # 7. Diploma Programs
     diploma_names = []
@@ -246,95 +584,134 @@ def load_data():
             if "required_documents" in prog:
                 chunk += f" Required Documents (الوثائق المطلوبة): {prog['required_documents']}"
             
-            CHUNKS.append(chunk)
+            chunks.append(chunk)
+            chunk_meta[len(chunks) - 1] = {"program_id": eng_name, "program_type": "diploma"}
             
         # Add Diploma Summary Chunk
         if diploma_names:
             full_list = ", ".join(diploma_names)
-            CHUNKS.append(f"List of all Diploma Programs (تخصصات الدبلوم المتاحة): {full_list}")
+            chunks.append(f"List of all Diploma Programs (تخصصات الدبلوم المتاحة): {full_list}")
 
     # 8. Specific Contact Questions
     # Admission and Registration
-    CHUNKS.append("Question: كيف يمكنني التواصل مع القبول و التسجيل؟ Answer: يمكنك التواصل مع القبول و التسجيل من خلال الرقم +962 79 712 2000")
+    chunks.append(f"Question: كيف يمكنني التواصل مع القبول و التسجيل؟ Answer: {CANNED_ANSWERS['contact_admission']}")
     
     # Finance Department
-    CHUNKS.append("Question: كيف يمكنني التواصل مع المالية؟ كيف يمكنني التواصل مع الدائرة المالية؟ Answer: يمكنك التواصل من خلال الرقم التالي +962 6 4790222")
+    chunks.append(f"Question: كيف يمكنني التواصل مع المالية؟ كيف يمكنني التواصل مع الدائرة المالية؟ Answer: {CANNED_ANSWERS['contact_finance']}")
 
     # University Facilities
-    facilities_answer = (
-        "مرافق الجامعة :\n"
-        "الملعب الأولمبي\n"
-        "صالة اللياقة البدنية\n"
-        "الملاعب الرياضية الخارجية\n"
-        "الملاعب الرياضية الداخلية\n"
-        "نكست ليفل\n"
-        "مواقف السيارات\n"
-        "المواصلات\n"
-        "أماكن العبادة\n"
-        "خدمات الطعام والشراب\n"
-        "خدمات الإنترنت\n"
-        "الخدمات البنكية\n"
-        "خدمات ذوي الإحتياجات الخاصة\n"
-        "الخدمات الطبية والتأمين الصحي\n"
-        "مركز جامعة الشرق الأوسط للعلاج الحكمي"
-    )
-    CHUNKS.append(f"Question: ما مرافق الجامعة؟ مرافق الجامعه؟ Answer: {facilities_answer}")
+    chunks.append(f"Question: ما مرافق الجامعة؟ مرافق الجامعه؟ Answer: {CANNED_ANSWERS['facilities']}")
 
     # Recreational Facilities
-    recreational_answer = (
-        "المرافق الترفيهية :\n"
-        "نكست ليفل\n"
-        "الملعب الأولمبي\n"
-        "صالة اللياقة البدنية\n"
-        "الملاعب الرياضية الخارجية\n"
-        "الملاعب الرياضية الداخلية\n"
-        "خدمات الطعام والشراب"
-    )
-    CHUNKS.append(f"Question: ما المرافق الترفيهية؟ ما المرافق الترفيهيه؟ Answer: {recreational_answer}")
+    chunks.append(f"Question: ما المرافق الترفيهية؟ ما المرافق الترفيهيه؟ Answer: {CANNED_ANSWERS['recreational_facilities']}")
 
     # Health Facilities
-    health_answer = (
-        "المرافق الصحية :\n"
-        "الخدمات الطبية والتأمين الصحي\n"
-        "مركز جامعة الشرق الأوسط للعلاج الحكمي "
-    )
-    CHUNKS.append(f"Question: ما المرافق الصحية؟ ما المرافق الصحيه؟ Answer: {health_answer}")
+    chunks.append(f"Question: ما المرافق الصحية؟ ما المرافق الصحيه؟ Answer: {CANNED_ANSWERS['health_facilities']}")
 
     # 9. Developer Info (Hardcoded)
-    dev_info = "تم تطويري من قبل دائرة تكنولوجيا المعلومات في جامعة الشرق الاوسط. I was developed by the IT Department at Middle East University."
-    CHUNKS.append(f"Question: Who made you? Who developed you? من صنعك؟ Answer: {dev_info}")
+    chunks.append(f"Question: Who made you? Who developed you? من صنعك؟ Answer: {CANNED_ANSWERS['developer']}")
+
+    print(f"Data loaded. {len(chunks)} chunks, {len(program_index)} programs created (version {version}).")
+    embeddings = generate_embeddings(chunks)
+
+    prompt_prefix = build_prompt_prefix(program_index)
+
+    CHUNKS, CHUNK_META, CHUNK_EMBEDDINGS, LEXICAL_INDEX = chunks, chunk_meta, embeddings, extractive.LexicalIndex(chunks)
+    PROGRAM_INDEX, PROMPT_PREFIX, KB_VERSION, KB_MTIME = program_index, prompt_prefix, version, mtime
+
+def build_prompt_prefix(program_index):
+    """The static start of every completion prompt: rules, contact answers and the program lists.
+
+    Byte-identical for all requests of a knowledge-base version, so OpenAI's
+    automatic prompt caching (prefixes of 1024+ tokens) applies to it.
+    Everything that changes per request goes after it (see build_messages).
+    """
+    program_lists = []
+    for prog_type, (label_ar, label_en) in programs.TYPE_LABELS.items():
+        ids = sorted(program_index.by_type.get(prog_type, [])) if program_index else []
+        if ids:
+            names = ", ".join(f"{program_index.programs[pid].name_ar} ({pid})" for pid in ids)
+            program_lists.append(f"{label_en} Programs ({label_ar}): {names}")
+
+    return (
+        "You are a helpful assistant for Middle East University (MEU) in Jordan. "
+        "Your goal is to answer student questions based on the provided context.\n\n"
+        
+        "IMPORTANT RULES:\n"
+        "1. **Prioritize History for Follow-ups**: If the user asks a follow-up question (e.g., 'How much is it?', 'What are the requirements?') and the previous message was about a specific program/topic, ASSUME they are asking about the SAME topic. Use information from the Conversation State if the current Context is irrelevant.\n"
+        "2. **Program Types**: Diploma, Bachelor and Master programs with similar names are different programs. Answer only about the program type named in the question or Conversation State, and do NOT mix their prices or requirements.\n"
+        "3. **Ask for Clarification**: If the user's question is vague (e.g., 'fees', 'master', 'location') AND there is NO clear topic in the Conversation State, ask a clarifying question. Example: 'Which program are you asking about?'\n"
+        "4. **Unknown Info**: If the answer is STRICTLY not in the context and you cannot clarify, you MUST answer EXACTLY with the following Arabic text:\n"
+        f"\"{UNKNOWN_INFO_ANSWER}\"\n"
+        "5. **Be Concise**: Keep answers short and relevant.\n\n"
+
+        "--- University Contacts & Facilities ---\n"
+        f"Admission and Registration: {CANNED_ANSWERS['contact_admission']}\n"
+        f"Finance Department: {CANNED_ANSWERS['contact_finance']}\n"
+        f"{CANNED_ANSWERS['facilities']}\n"
+        f"{CANNED_ANSWERS['developer']}\n\n"
+
+        "--- Programs ---\n"
+        + "\n".join(program_lists) + "\n\n"
+        "The Conversation State and the Context (Search Results) of this question follow, then the user's question."
+    )
 
-    print(f"Data loaded. {len(CHUNKS)} chunks created.")
+def build_messages(session, user_message, context_text):
+    """Messages of a completion: the static prefix, then this turn's state and context, then the question."""
+    return [
+        {"role": "system", "content": PROMPT_PREFIX},
+        {"role": "system", "content": (
+            f"--- Conversation State ---\n{session_context(session)}\n\n"
+            f"--- Context (Search Results) ---\n{context_text}\n----------------"
+        )},
+        {"role": "user", "content": user_message},
+    ]
 
 def initialize_knowledge_base():
-    """Initializes the knowledge base if not already loaded."""
-    global CHUNKS, CHUNK_EMBEDDINGS
-    if CHUNKS: 
+    """Loads the knowledge base on first use and reloads it when the data file changes.
+
+    Cheap enough to call on every request: the file's mtime is checked at most
+    every KB_CHECK_INTERVAL seconds. A new version re-warms the caches.
+    """
+    global KB_CHECKED_AT
+    if CHUNKS and time.monotonic() - KB_CHECKED_AT < KB_CHECK_INTERVAL:
         return
-        
-    print("Initializing knowledge base...")
-    load_data()
-    generate_embeddings()
+
+    with KB_LOCK:
+        if CHUNKS and time.monotonic() - KB_CHECKED_AT < KB_CHECK_INTERVAL:
+            return
+        KB_CHECKED_AT = time.monotonic()
+        if CHUNKS and os.path.exists(DATA_FILE) and os.path.getmtime(DATA_FILE) == KB_MTIME:
+            return
+
+        print("Data file changed, reloading knowledge base..." if CHUNKS else "Initializing knowledge base...")
+        previous_version = KB_VERSION
+        load_data()
+
+    if KB_VERSION and KB_VERSION != previous_version and WARM_CACHES:
+        threading.Thread(target=warm_caches, args=(KB_VERSION,), daemon=True).start()
 
 CHUNK_EMBEDDINGS = []
+LEXICAL_INDEX = extractive.LexicalIndex([])  # keyword index of CHUNKS, for when embeddings are unavailable
 
-def generate_embeddings():
+def generate_embeddings(chunks):
     """Generates embeddings for all chunks."""
-    global CHUNK_EMBEDDINGS
     print("Generating embeddings for knowledge base...")
     try:
         # Batch processing would be better for many chunks, but for ~50 loop is okay or small batches
         # Let's do a simple loop for clarity and error handling per chunk, or one big batch if small.
         # OpenAI handles list of strings.
-        if not CHUNKS:
-            return
+        if not chunks:
+            return []
             
-        response = client.embeddings.create(input=CHUNKS, model="text-embedding-3-small")
+        response = upstream("embeddings", client.embeddings.with_raw_response.create, input=chunks, model="text-embedding-3-small", timeout=60)
         # Ensure order is preserved
-        CHUNK_EMBEDDINGS = [data.embedding for data in response.data]
-        print(f"Generated {len(CHUNK_EMBEDDINGS)} embeddings.")
+        embeddings = [data.embedding for data in response.data]
+        print(f"Generated {len(embeddings)} embeddings.")
+        return embeddings
     except Exception as e:
         print(f"Error generating embeddings: {e}")
+        return []
 
 def cosine_similarity(v1, v2):
     """Compute cosine similarity between two vectors."""
@@ -345,47 +722,397 @@ def cosine_similarity(v1, v2):
         return 0
     return dot_product / (magnitude_v1 * magnitude_v2)
 
-def retrieve_context(query):
-    """Semantic retrieval using Cosine Similarity."""
-    """Semantic retrieval using Cosine Similarity."""
+# Score added to chunks of programs / faculties the entity linker found in the question
+LINK_BOOST = 0.15
+
+def retrieve_context(query, program_ids=(), faculty_ids=(), exclude_ids=()):
+    """Semantic retrieval using Cosine Similarity. Returns the top chunk texts."""
+    return [CHUNKS[i] for i in retrieve(query, program_ids, faculty_ids, exclude_ids)]
+
+def embed_query(query):
+    """Embedding of a user question, or None if the API call failed."""
+    key = normalize_text(query)
+    embedding = QUERY_EMBEDDING_CACHE.get(key)
+    if embedding is not None:
+        return embedding
+    try:
+        query_response = upstream("embeddings", client.embeddings.with_raw_response.create, input=query, model="text-embedding-3-small")
+        embedding = query_response.data[0].embedding
+    except Exception as e:
+        print(f"Error embedding query: {e}")
+        return None
+    QUERY_EMBEDDING_CACHE.set(key, embedding)
+    return embedding
+
+def retrieve(query, program_ids=(), faculty_ids=(), exclude_ids=(), query_embedding=None):
+    """Semantic retrieval using Cosine Similarity. Returns the top chunk indices.
+
+    Chunks about linked programs / faculties get a LINK_BOOST so an
+    explicitly named program beats its embedding neighbours. Chunks of
+    exclude_ids (the other degree types of a chosen program) are skipped.
+    Pass query_embedding when the question was already embedded. Without
+    embeddings (of the chunks or the question) it falls back to lexical_retrieve().
+    """
     # Lazy Load: Ensure data is loaded before retrieval
-    if not CHUNKS:
-        initialize_knowledge_base()
+    initialize_knowledge_base()
 
-    if not CHUNK_EMBEDDINGS:
-        # Fallback to keyword if embeddings failed
-        return []
+    cache_key = (KB_VERSION, normalize_text(query), tuple(sorted(program_ids)), tuple(sorted(faculty_ids)), tuple(sorted(exclude_ids)))
+    cached = RETRIEVAL_CACHE.get(cache_key)
+    if cached is not None:
+        return list(cached)
+
+    if query_embedding is None and CHUNK_EMBEDDINGS:
+        query_embedding = embed_query(query)
+    if query_embedding is None or not CHUNK_EMBEDDINGS:
+        # Fallback to keyword if embeddings failed (not cached: the next question may embed again)
+        return lexical_retrieve(query, program_ids, faculty_ids, exclude_ids)
 
     try:
-        # Embed query
-        query_response = client.embeddings.create(input=query, model="text-embedding-3-small")
-        query_embedding = query_response.data[0].embedding
-        
-        scored_chunks = []
-        for i, chunk_embedding in enumerate(CHUNK_EMBEDDINGS):
-            score = cosine_similarity(query_embedding, chunk_embedding)
-            # Threshold can be adjusted. 0.3 is usually decent for semantic match, 
-            # but let's just take top 3 regardless of threshold for now, or use a low one.
-            scored_chunks.append((score, CHUNKS[i]))
-            
-        # Sort by score descending
-        scored_chunks.sort(key=lambda x: x[0], reverse=True)
-        
-        # Debug printing
-        print(f"Top match: {scored_chunks[0][0]} -> {scored_chunks[0][1][:50]}...")
-        
-        # Return top 7 matches to ensure we cover enough ground (e.g. all majors in a faculty)
-        return [chunk for score, chunk in scored_chunks[:7]]
+        scores = [cosine_similarity(query_embedding, chunk_embedding) for chunk_embedding in CHUNK_EMBEDDINGS]
+        indices = rank_chunks(scores, program_ids, faculty_ids, exclude_ids)
+        RETRIEVAL_CACHE.set(cache_key, tuple(indices))
+        return indices
     except Exception as e:
         print(f"Error in semantic retrieval: {e}")
         return []
 
-client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+def lexical_retrieve(query, program_ids=(), faculty_ids=(), exclude_ids=()):
+    """Keyword retrieval (see extractive.LexicalIndex) for questions without an embedding. Returns the top chunk indices."""
+    initialize_knowledge_base()
+    with STATS_LOCK:
+        DEGRADED["lexical_retrieval"] += 1
+    print("[LEXICAL] No query embedding, retrieving by keywords")
+    # Chunks sharing no term with the question are dropped, unless they are about a linked entity
+    return rank_chunks(LEXICAL_INDEX.scores(query), program_ids, faculty_ids, exclude_ids, min_score=1e-9)
+
+def retrieve_context(query, program_ids, faculty_ids, exclude_ids, query_embedding):
+    """(chunk indices, similarity of the best chunk) for the LLM step, by embedding or, without one, by keywords."""
+    started = time.perf_counter()
+    if query_embedding:
+        indices = retrieve(query, program_ids, faculty_ids, exclude_ids, query_embedding)
+    else:
+        # Degraded mode: the embedding failed or its circuit is open
+        indices = lexical_retrieve(query, program_ids, faculty_ids, exclude_ids)
+    STAGE_TIMINGS.record("retrieval", time.perf_counter() - started)
+    top_score = None
+    if indices and query_embedding and CHUNK_EMBEDDINGS:
+        top_score = cosine_similarity(query_embedding, CHUNK_EMBEDDINGS[indices[0]])
+    return indices, top_score
 
-client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+def rank_chunks(scores, program_ids=(), faculty_ids=(), exclude_ids=(), min_score=None):
+    """Indices of the best chunks by score, with LINK_BOOST for the linked programs / faculties."""
+    scored_chunks = []
+    for i, score in enumerate(scores):
+        meta = CHUNK_META.get(i, {})
+        if meta.get("program_id") in exclude_ids:
+            continue
+        if meta.get("program_id") in program_ids or (meta.get("faculty_id") and not meta.get("program_id") and meta["faculty_id"] in faculty_ids):
+            score += LINK_BOOST
+        # Threshold can be adjusted. 0.3 is usually decent for semantic match, 
+        # but let's just take top 3 regardless of threshold for now, or use a low one.
+        if min_score is None or score >= min_score:
+            scored_chunks.append((score, i))
+
+    if not scored_chunks:
+        return []
+
+    # Sort by score descending
+    scored_chunks.sort(key=lambda x: x[0], reverse=True)
+    
+    # Debug printing
+    print(f"Top match: {scored_chunks[0][0]} -> {CHUNKS[scored_chunks[0][1]][:50]}...")
+    
+    # Return top 7 matches to ensure we cover enough ground (e.g. all majors in a faculty)
+    return [i for score, i in scored_chunks[:7]]
+
+# One OpenAI client per worker process (see openai_clients.py): a keep-alive
+# pool sized for the request and pipeline threads, so calls reuse warm TLS
+# connections. OPENAI_CONNECT_TIMEOUT bounds connecting, OPENAI_POOL_TIMEOUT
+# waiting for a free connection; each endpoint has its own request timeout.
+client = openai_clients.make_client(
+    pool_size=int(os.getenv("OPENAI_POOL_SIZE", "32")),
+    keepalive=float(os.getenv("OPENAI_KEEPALIVE", "30")),
+    connect_timeout=float(os.getenv("OPENAI_CONNECT_TIMEOUT", "3")),
+    pool_timeout=float(os.getenv("OPENAI_POOL_TIMEOUT", "5")),
+)
+UPSTREAM_TIMEOUTS = {
+    "chat": LLM_TIMEOUT_SECONDS,
+    "embeddings": float(os.getenv("EMBEDDING_TIMEOUT_SECONDS", "10")),
+    "moderations": float(os.getenv("MODERATION_TIMEOUT_SECONDS", "5")),
+}
+# Embeddings and moderations have no side effects: on connection errors,
+# timeouts and 5xx they are retried (UPSTREAM_RETRIES times, jittered backoff).
+# Completions are not; they fall back to summary mode instead.
+IDEMPOTENT_ENDPOINTS = ("embeddings", "moderations")
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+
+def upstream(endpoint, create, consume=None, **kwargs):
+    """create(**kwargs), a with_raw_response method of the client, in a slot of UPSTREAM_LIMITS[endpoint].
+
+    The limiter learns from the call's latency, its x-ratelimit-* headers
+    and 429s. A rate-limited call was not processed, so it queues again (behind
+    the limiter's pause) up to UPSTREAM_RATE_LIMIT_RETRIES times; calls to
+    IDEMPOTENT_ENDPOINTS are also retried on transient errors, which count
+    against the endpoint's circuit breaker. Returns
+    consume(raw response), by default the parsed response; the slot is held
+    until consume returns (e.g. the end of a stream).
+    """
+    kwargs.setdefault("timeout", UPSTREAM_TIMEOUTS[endpoint])
+    breaker = UPSTREAM_BREAKERS[endpoint]
+    rate_limited = failed = 0
+    while True:
+        breaker.allow()  # CircuitOpenError while the endpoint is considered down
+        try:
+            with UPSTREAM_LIMITS[endpoint].slot(UPSTREAM_PRIORITY.get()) as call:
+                raw = create(**kwargs)
+                call.responded(raw.headers)
+                result = consume(raw) if consume else raw.parse()
+        except openai.RateLimitError as e:
+            breaker.record(None)  # up, only busy: the limiter's business
+            if rate_limited == UPSTREAM_RATE_LIMIT_RETRIES or e.code == "insufficient_quota":
+                raise
+            rate_limited += 1
+            print(f"[UPSTREAM] {endpoint} rate-limited, queueing again ({rate_limited}/{UPSTREAM_RATE_LIMIT_RETRIES})")
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            breaker.record(False)
+            if endpoint not in IDEMPOTENT_ENDPOINTS or failed == UPSTREAM_RETRIES:
+                raise
+            delay = openai_clients.backoff(failed)
+            failed += 1
+            print(f"[UPSTREAM] {endpoint} failed ({e.__class__.__name__}), retry {failed}/{UPSTREAM_RETRIES} in {delay:.2f}s")
+            time.sleep(delay)
+        except BaseException:
+            breaker.record(None)
+            raise
+        else:
+            breaker.record(True, call.latency)
+            return result
 
 # load_data() removed from global scope to prevent IIS startup timeout
 
+def moderation_key(user_message):
+    return hashlib.sha1(f"{MODERATION_MODEL}|{MODERATION_POLICY_VERSION}|{normalize_text(user_message)}".encode("utf-8")).hexdigest()
+
+def is_flagged(user_message):
+    """OpenAI moderation verdict, cached per normalized message. Raises on API errors."""
+    key = moderation_key(user_message)
+    flagged = MODERATION_CACHE.get(key)
+    if flagged is None:
+        moderation_response = upstream("moderations", client.moderations.with_raw_response.create, input=user_message, model=MODERATION_MODEL)
+        flagged = moderation_response.results[0].flagged
+        MODERATION_CACHE.set(key, flagged)
+    return flagged
+
+def timed(fn, *args):
+    """Returns (fn(*args), seconds it took)."""
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+def screen(user_message, with_embedding=True):
+    """Moderation verdict and (optionally) the query embedding, fetched concurrently.
+
+    Returns (flagged, embedding); flagged is None when the moderation API failed.
+    A flagged message returns as soon as moderation answers: the embedding is
+    cancelled if it has not started, otherwise its result is discarded.
+    """
+    started = time.perf_counter()
+    # Each call runs in a copy of the request's context (UPSTREAM_PRIORITY)
+    moderation = PIPELINE_POOL.submit(contextvars.copy_context().run, timed, is_flagged, user_message)
+    embedding = PIPELINE_POOL.submit(contextvars.copy_context().run, timed, embed_query, user_message) if with_embedding else None
+    try:
+        flagged, moderation_seconds = None, None
+        try:
+            flagged, moderation_seconds = moderation.result()
+        except Exception as e:
+            # Continue without moderation if API fails (fallback)
+            print(f"Moderation API error: {e}")
+        if flagged or embedding is None:
+            record_screen(time.perf_counter() - started, moderation_seconds, None)
+            return flagged, None
+        query_embedding, embedding_seconds = embedding.result()
+        record_screen(time.perf_counter() - started, moderation_seconds, embedding_seconds)
+        return flagged, query_embedding
+    finally:
+        if embedding:
+            embedding.cancel()
+
+def record_screen(wall_seconds, moderation_seconds, embedding_seconds):
+    """Stage timings of a screen(); "screen_saved" is the time won by not running the calls one after the other."""
+    STAGE_TIMINGS.record("screen", wall_seconds)
+    if moderation_seconds is not None:
+        STAGE_TIMINGS.record("moderation", moderation_seconds)
+    if embedding_seconds is not None:
+        STAGE_TIMINGS.record("embedding", embedding_seconds)
+    if moderation_seconds is not None and embedding_seconds is not None:
+        STAGE_TIMINGS.record("screen_saved", max(0.0, moderation_seconds + embedding_seconds - wall_seconds))
+
+def shorten(text, limit=SUMMARY_CHARS):
+    """First line of a text, cut to `limit` characters."""
+    text = " ".join(text.strip().split("\n")[0].split()) if text else ""
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+def remember_turn(session, user_message, answer, kind):
+    """Records a turn in the session's rolling summary so follow-up questions still see it.
+
+    Only the question and the start of the answer are kept (the full turn is
+    in CONVERSATION_LOG). kind is what answered it: an intent, "fact", "llm", ...
+    """
+    session["summary"] = (session["summary"] + [{"q": shorten(user_message), "a": shorten(answer)}])[-SUMMARY_TURNS:]
+    session["turns"] += 1
+    session["state"]["last_intent"] = kind
+
+def session_context(session):
+    """The session as prompt text: what the conversation is about and its last turns."""
+    state = session["state"]
+    lines = []
+    program = PROGRAM_INDEX.programs.get(state.get("program_id")) if PROGRAM_INDEX else None
+    if program:
+        lines.append(f"Active program: {program.label}, type: {program.type}, faculty: {program.faculty_en or program.faculty_ar or '-'}")
+    elif state.get("faculty_id"):
+        lines.append(f"Active faculty: {state['faculty_id']}")
+    if state.get("last_intent"):
+        lines.append(f"Last answer: {state['last_intent']}")
+    for turn in session["summary"]:
+        lines.append(f"User: {turn['q']}\nAssistant: {turn['a']}")
+    return "\n".join(lines)
+
+def find_type_ambiguity(program_ids, message, state):
+    """Programs to offer when the message may mean several degree types of one subject.
+
+    Replaces rule 2 of the system prompt (asking "Diploma or Bachelor?") with a
+    local check, so the clarifying question costs no completion.
+    """
+    if not PROGRAM_INDEX or programs.mentioned_types(message):
+        return []
+    # Two subjects named ("compare pharmacy and nursing") is a comparison, not a question about one
+    if len({PROGRAM_INDEX.family(pid) for pid in program_ids}) > 1:
+        return []
+    for pid in program_ids:
+        family = PROGRAM_INDEX.family(pid)
+        if state.get("choice") in family:
+            continue
+        if len({PROGRAM_INDEX.programs[f].type for f in family}) > 1:
+            return sorted(family, key=lambda f: list(programs.TYPE_LABELS).index(PROGRAM_INDEX.programs[f].type))
+    return []
+
+def clarification_response(session_id, session, user_message, options):
+    """Templated "which one do you mean?" answer with quick-reply options."""
+    progs = [PROGRAM_INDEX.programs[pid] for pid in options]
+    answer = (
+        "هل تقصد " + " أم ".join(p.type_ar + " " + p.name_ar for p in progs) + "؟\n"
+        "Do you mean " + " or ".join(f"{programs.TYPE_LABELS[p.type][1]} ({p.id})" for p in progs) + "?"
+    )
+    session["state"]["pending_question"] = user_message
+    print(f"[DISAMBIGUATION] {options} for {session_id}")
+    return answer, [{"label": f"{p.type_ar} {p.name_ar}", "program_id": p.id} for p in progs]
+
+def faq_answer(key):
+    """Answer payload for a canonical question, computed once per knowledge-base version."""
+    global FAQ_ANSWERS
+    initialize_knowledge_base()
+    cache_key = (KB_VERSION, key)
+    # One lock for all keys: a cold worker computes each answer once, not once per request
+    with FAQ_LOCK:
+        if cache_key in FAQ_ANSWERS:
+            return FAQ_ANSWERS[cache_key]
+
+        # Computed by another worker?
+        try:
+            payload = SHARED_WARMUP.get_faq(KB_VERSION, key)
+        except Exception as e:
+            print(f"Shared FAQ error: {e}")
+            payload = None
+
+        if payload is None:
+            # FAQ answers belong to no conversation
+            payload = answer_message(FAQ_QUESTIONS[key], f"faq:{key}")
+
+            # Summary-mode answers are a fallback, try the LLM again next time
+            if extractive.SUMMARY_MODE_MARKER in payload["response"]:
+                return payload
+            try:
+                SHARED_WARMUP.put_faq(KB_VERSION, key, payload)
+            except Exception as e:
+                print(f"Shared FAQ error: {e}")
+            print(f"[FAQ] Computed '{key}' for version {KB_VERSION}")
+        FAQ_ANSWERS = {k: v for k, v in FAQ_ANSWERS.items() if k[0] == KB_VERSION}
+        FAQ_ANSWERS[cache_key] = payload
+        return payload
+
+def warm_caches(version):
+    """Runs the FAQ and the most asked questions through the pipeline for a new version.
+
+    Fills the query-embedding, retrieval, moderation and answer caches before
+    users ask. Stops early when the knowledge base changes again. Only the
+    worker holding the SHARED_WARMUP claim runs it; the others wait in case
+    it dies.
+    """
+    try:
+        while not SHARED_WARMUP.claim(version):
+            if WARMUP["version"] != version:
+                print(f"[WARMUP] Version {version} is warmed by another worker")
+                WARMUP.update(version=version, questions=0, warmed=0, errors=0, owner=False)
+            if SHARED_WARMUP.done(version) or KB_VERSION != version:
+                return
+            time.sleep(WARMUP_POLL_SECONDS)
+    except Exception as e:
+        # Better every worker warming than none
+        print(f"Warm-up claim error, warming here: {e}")
+
+    questions = []
+    if os.path.exists(WARM_QUERIES_FILE):
+        try:
+            with open(WARM_QUERIES_FILE, 'r', encoding='utf-8') as f:
+                questions = [q["question"] for q in json.load(f)][:WARM_QUERIES_LIMIT]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Could not read warm-up questions: {e}")
+
+    UPSTREAM_PRIORITY.set("warmup")  # own thread: queued behind the users' calls
+    WARMUP.update(version=version, questions=len(FAQ_QUESTIONS) + len(questions), warmed=0, errors=0, owner=True)
+    print(f"[WARMUP] {len(FAQ_QUESTIONS)} FAQ + {len(questions)} mined questions for version {version}")
+    jobs = [(faq_answer, (key,)) for key in FAQ_QUESTIONS]
+    jobs += [(answer_message, (question, f"warmup:{i}")) for i, question in enumerate(questions)]
+    for job, args in jobs:
+        if KB_VERSION != version:
+            print(f"[WARMUP] Version {version} replaced, stopping")
+            return
+        try:
+            job(*args)
+            WARMUP["warmed"] += 1
+        except Exception as e:
+            print(f"Warm-up error for {args[0]}: {e}")
+            WARMUP["errors"] += 1
+        record_warmup_progress(version)
+    record_warmup_progress(version, finished=True)
+    print(f"[WARMUP] Done for version {version}")
+
+def record_warmup_progress(version, finished=False):
+    try:
+        SHARED_WARMUP.progress(version, finished)
+    except Exception as e:
+        print(f"Warm-up progress error: {e}")
+
+def log_turn(session_id, user_message, payload, first_turn):
+    """Appends one chat turn to CONVERSATION_LOG. Session ids are hashed (they default to the IP)."""
+    if not CONVERSATION_LOG:
+        return
+    record = {
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "session": hashlib.sha1(str(session_id).encode("utf-8")).hexdigest()[:12],
+        "first_turn": first_turn,
+        "kb_version": KB_VERSION,
+        "message": user_message,
+        "response": payload.get("response"),
+    }
+    try:
+        with CONVERSATION_LOG_LOCK:
+            os.makedirs(os.path.dirname(CONVERSATION_LOG), exist_ok=True)
+            with open(CONVERSATION_LOG, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        print(f"Could not write conversation log: {e}")
+
 @app.route("/")
 def index():
     return send_from_directory('templates', 'index.html')
@@ -394,60 +1121,368 @@ def index():
 def send_static(path):
     return send_from_directory('static', path)
 
+def traffic_class(headers):
+    """"batch" for evaluation / load-test traffic (X-Traffic-Class: batch), else "interactive"."""
+    return "batch" if headers.get("X-Traffic-Class", "").strip().lower() == "batch" else "interactive"
+
+def client_address(remote_addr, forwarded_for):
+    """The client's IP behind TRUSTED_PROXIES proxies, as ProxyFix gives it to Flask."""
+    hops = [hop.strip() for hop in (forwarded_for or "").split(",") if hop.strip()]
+    if TRUSTED_PROXIES and len(hops) >= TRUSTED_PROXIES:
+        return hops[-TRUSTED_PROXIES]
+    return remote_addr
+
+def admit(data, headers, remote_addr):
+    """Admits a chat request (see ADMISSION). Returns its traffic class; the caller must ADMISSION.leave() it."""
+    traffic = traffic_class(headers)
+    session_id = str(data.get("session_id") or remote_addr)[:128]
+    ADMISSION.admit(traffic, data.get("message"), session_id, remote_addr)
+    return traffic
+
+def rejection(e):
+    print(f"[ADMISSION] {e.status} {e.error}")
+    return jsonify(e.payload()), e.status, e.headers()
+
 @app.route("/api/chat", methods=["POST"])
 def chat():
-    user_message = request.json.get("message", "")
-    session_id = request.json.get("session_id", request.remote_addr) # Use IP as fallback session ID
+    data = request.json
+    try:
+        traffic = admit(data, request.headers, request.remote_addr)
+    except admission.Rejected as e:
+        return rejection(e)
+    priority = UPSTREAM_PRIORITY.set(traffic)
+    try:
+        payload, status = chat_request(data, request.headers.get("Idempotency-Key"), request.remote_addr)
+    finally:
+        UPSTREAM_PRIORITY.reset(priority)
+        ADMISSION.leave(traffic)
+    return jsonify(payload), status
 
-    if not user_message:
+@app.route("/api/chat/stream", methods=["POST"])
+def chat_stream():
+    """/api/chat relayed as server-sent events while the completion is generated.
+
+    Events: "token" (a JSON string with the next piece of the answer), then one
+    "done" with the same payload /api/chat returns, or "error" ({"error": ...}).
+    Answers that need no completion arrive as a single "done".
+    """
+    data = request.json
+    if not data.get("message"):
         return jsonify({"error": "No message provided"}), 400
+    try:
+        traffic = admit(data, request.headers, request.remote_addr)
+    except admission.Rejected as e:
+        return rejection(e)
+    idempotency_key = request.headers.get("Idempotency-Key")
+    remote_addr = request.remote_addr
+    events = queue.Queue()
+
+    def run():
+        ON_TOKEN.set(lambda text: events.put(("token", text)))
+        UPSTREAM_PRIORITY.set(traffic)
+        try:
+            payload, status = chat_request(data, idempotency_key, remote_addr)
+            events.put(("done" if status == 200 else "error", payload))
+        except Exception as e:
+            print(f"Streaming error: {e}")
+            events.put(("error", {"error": "Something went wrong"}))
+        finally:
+            ADMISSION.leave(traffic)
+
+    threading.Thread(target=run, daemon=True).start()
+
+    def stream():
+        while True:
+            event, payload = events.get()
+            yield f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+            if event != "token":
+                return
+
+    return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def chat_request(data, idempotency_key=None, remote_addr=None):
+    """Answers one /api/chat request body. Returns (payload, HTTP status)."""
+    user_message = data.get("message", "")
+    session_id = str(data.get("session_id") or remote_addr)[:128] # Use IP as fallback session ID
+
+    if not user_message:
+        return {"error": "No message provided"}, 400
+
+    chosen_id = data.get("program_id")
+
+    def run():
+        if STATE_TOKENS:
+            # Stateless: the conversation comes with the request and goes back with the answer
+            session = STATE_TOKENS.loads(data.get("state_token"))
+            first_turn = not session["turns"]
+            payload, seconds = timed(run_steps, chat_steps(user_message, session_id, session, chosen_id))
+            payload = {**payload, "state_token": STATE_TOKENS.dumps(session)}
+        else:
+            # One turn of a session at a time; its session is saved before the next one loads it
+            with SESSIONS.lock(session_id):
+                session = SESSIONS.load(session_id)
+                first_turn = not session["turns"]
+                payload, seconds = timed(run_steps, chat_steps(user_message, session_id, session, chosen_id))
+                SESSIONS.save(session_id, session)
+        STAGE_TIMINGS.record("request", seconds)
+        log_turn(session_id, user_message, payload, first_turn)
+        return payload
+
+    idempotency_key = idempotency_key or data.get("idempotency_key")
+    if not idempotency_key:
+        return run(), 200
 
-    # Content Moderation - Custom Arabic/English bad words filter
-    OFFENSIVE_WORDS = [
-        # Arabic offensive words (common insults)
-        "كس", "طيز", "زب", "شرموط", "عرص", "منيوك", "قحبة", "كلب", "حمار", "غبي",
-        "احمق", "تافه", "حقير", "وسخ", "زبال", "ابن الكلب", "يلعن", "اللعنة",
-        "خرا", "زق", "انيك", "نيك", "متناك", "عاهرة", "فاجرة", "ملعون",
-        # English offensive words
-        "fuck", "shit", "bitch", "ass", "damn", "bastard", "idiot", "stupid",
-        "dumb", "moron", "retard", "crap", "dick", "pussy", "whore", "slut"
-    ]
-    
-    # Check for offensive words (case-insensitive)
-    message_lower = user_message.lower()
-    for word in OFFENSIVE_WORDS:
-        if word in message_lower:
-            print(f"[MODERATION-LOCAL] Blocked word '{word}' from {session_id}: {user_message}")
-            return jsonify({
-                "response": "⛔ هذه الرسالة غير مقبولة ومخالفة لسياسة الاستخدام.\n\nيُرجى الالتزام بأسلوب محترم عند التواصل مع المساعد الآلي للجامعة.\n\n⚠️ ملاحظة: يتم تسجيل جميع المحادثات.\n\n---\n⛔ This message is unacceptable and violates our usage policy.\n\nPlease use respectful language when communicating with the university assistant.\n\n⚠️ Note: All conversations are logged."
-            })
-
-    # Content Moderation - OpenAI API (for additional coverage)
     try:
-        moderation_response = client.moderations.create(input=user_message)
-        if moderation_response.results[0].flagged:
-            # Log the flagged content for review (optional)
-            print(f"[MODERATION-API] Flagged message from {session_id}: {user_message}")
-            return jsonify({
-                "response": "⛔ هذه الرسالة غير مقبولة ومخالفة لسياسة الاستخدام.\n\nيُرجى الالتزام بأسلوب محترم عند التواصل مع المساعد الآلي للجامعة.\n\n⚠️ ملاحظة: يتم تسجيل جميع المحادثات.\n\n---\n⛔ This message is unacceptable and violates our usage policy.\n\nPlease use respectful language when communicating with the university assistant.\n\n⚠️ Note: All conversations are logged."
-            })
-    except Exception as e:
-        print(f"Moderation API error: {e}")
-        # Continue without moderation if API fails (fallback)
+        payload, outcome = IDEMPOTENCY.run(f"{session_id}:{idempotency_key}", run, fingerprint=(user_message, chosen_id))
+    except idempotency.IdempotencyError as e:
+        return e.payload(), e.status
+    if outcome != "new":
+        print(f"[IDEMPOTENCY] {outcome} duplicate of {idempotency_key} from {session_id}")
+    return payload, 200
 
-    # Manage Conversation History
-    if session_id not in CONVERSATION_HISTORY:
-        CONVERSATION_HISTORY[session_id] = []
-    
-    # Append user message
-    CONVERSATION_HISTORY[session_id].append({"role": "user", "content": user_message})
-    
-    # Keep only last 6 messages (3 turns)
-    CONVERSATION_HISTORY[session_id] = CONVERSATION_HISTORY[session_id][-6:]
+def answer_message(user_message, session_id, chosen_id=None):
+    """Runs the whole chat pipeline for one message of a new conversation. Returns the response payload.
+
+    Kept outside the request handler so answers can also be computed without
+    a request (e.g. the precomputed FAQ answers). The conversation is not stored.
+    """
+    return run_steps(chat_steps(user_message, session_id, sessions.new_session(), chosen_id))
+
+# The pipeline is written as generators that yield their OpenAI calls as ops:
+#   ("screen", text, with_embedding) -> (flagged, embedding) from concurrent moderation and embedding,
+#   ("complete", kwargs) -> answer text, ("coalesce", key, steps) -> (payload, shared),
+# and their local CPU-heavy or SQLite steps as ("blocking", fn, args) -> fn(*args).
+# run_steps() executes them with the sync client; asgi_app.py runs the same
+# generators on the async client, the blocking steps in a thread.
+
+# Set by a streaming request (/api/chat/stream): completions are then streamed
+# and every piece of the answer is passed to this callback as it arrives
+ON_TOKEN = contextvars.ContextVar("ON_TOKEN", default=None)
+
+def record_usage(usage):
+    """Logs and counts the tokens of a completion, including the prompt tokens served from OpenAI's prompt cache."""
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    print(f"[PROMPT-CACHE] {cached}/{usage.prompt_tokens} prompt tokens cached, {usage.completion_tokens} completion tokens")
+    with STATS_LOCK:
+        PROMPT_TOKENS.update(calls=1, prompt=usage.prompt_tokens, cached=cached, completion=usage.completion_tokens)
+
+def complete(kwargs):
+    on_token = ON_TOKEN.get()
+    if on_token is None:
+        response = upstream("chat", client.chat.completions.with_raw_response.create, **kwargs)
+        record_usage(response.usage)
+        return response.choices[0].message.content
+    parts = []
+
+    def consume(raw):
+        # The last chunk of the stream carries the usage
+        for chunk in raw.parse():
+            record_usage(getattr(chunk, "usage", None))
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text:
+                parts.append(text)
+                on_token(text)
+        return "".join(parts)
+
+    # The slot is held until the stream ends; its latency is the time to the first byte
+    return upstream("chat", client.chat.completions.with_raw_response.create, consume,
+                    **kwargs, stream=True, stream_options={"include_usage": True})
+
+def run_steps(steps):
+    """Drives a pipeline generator, sending back each op's result (or raising its error)."""
+    value, error = None, None
+    while True:
+        try:
+            op = steps.throw(error) if error else steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value, error = None, None
+        try:
+            value = run_op(op)
+        except Exception as e:
+            error = e
+
+def run_op(op):
+    kind = op[0]
+    if kind == "screen":
+        return screen(op[1], op[2])
+    if kind == "complete":
+        answer, seconds = timed(complete, op[1])
+        STAGE_TIMINGS.record("completion", seconds)
+        return answer
+    if kind == "coalesce":
+        _, key, steps = op
+        return SINGLE_FLIGHT.do(key, lambda: run_steps(steps))
+    if kind == "blocking":
+        _, fn, args = op
+        return fn(*args)
+    raise ValueError(f"Unknown pipeline op '{kind}'")
+
+def chat_steps(user_message, session_id, session, chosen_id=None):
+    """The chat pipeline for one message (see run_steps). Returns the response payload.
+
+    Updates the session (see sessions.new_session()) in place.
+    """
+    # Content Moderation - Custom Arabic/English bad words filter
+    word = WORD_FILTER.find(user_message)
+    if word:
+        print(f"[MODERATION-LOCAL] Blocked word '{word}' from {session_id}: {user_message}")
+        return {
+            "response": "⛔ هذه الرسالة غير مقبولة ومخالفة لسياسة الاستخدام.\n\nيُرجى الالتزام بأسلوب محترم عند التواصل مع المساعد الآلي للجامعة.\n\n⚠️ ملاحظة: يتم تسجيل جميع المحادثات.\n\n---\n⛔ This message is unacceptable and violates our usage policy.\n\nPlease use respectful language when communicating with the university assistant.\n\n⚠️ Note: All conversations are logged."
+        }
+
+    # Local Intent Classifier - greetings, thanks, contact numbers, etc.
+    # Answered from templates without any OpenAI call.
+    intent, confidence = intents.classify(user_message, INTENT_CONFIDENCE_THRESHOLD)
+    if intent:
+        initialize_knowledge_base()
+        answer = CANNED_ANSWERS[intent]
+        print(f"[INTENT] {intent} ({confidence:.2f}) from {session_id}")
+        with STATS_LOCK:
+            INTENT_HITS[intent] += 1
+
+        remember_turn(session, user_message, answer, intent)
+        return {"response": answer}
+
+    with STATS_LOCK:
+        INTENT_HITS["other"] += 1
+
+    initialize_knowledge_base()
+
+    # Entity Linking - which programs / faculties does the message name?
+    # Follow-ups without a name ("how much is it?") fall back to the session's active program.
+    # A clarification option was clicked: answer the pending question for that program only.
+    state = session["state"]
+    if chosen_id and PROGRAM_INDEX and chosen_id in PROGRAM_INDEX.programs:
+        state["choice"] = chosen_id
+        pending = state.pop("pending_question", None)
+        if pending:
+            user_message = f"{pending} ({user_message})"
+        linked_programs = [chosen_id]
+        linked_faculties = []
+    else:
+        linked_programs = PROGRAM_INDEX.linker.program_ids(user_message) if PROGRAM_INDEX else []
+        linked_faculties = PROGRAM_INDEX.linker.faculty_ids(user_message) if PROGRAM_INDEX else []
+
+        # Explicit degree type ("ماجستير المحاسبة") keeps only programs of that type
+        types = programs.mentioned_types(user_message) if linked_programs else []
+        if types:
+            linked_programs = [pid for pid in linked_programs if PROGRAM_INDEX.programs[pid].type in types] or linked_programs
+        # A type chosen earlier in the session applies to the same subject again
+        elif state.get("choice"):
+            linked_programs = [state["choice"] if state["choice"] in PROGRAM_INDEX.family(pid) else pid for pid in linked_programs]
+            linked_programs = list(dict.fromkeys(linked_programs))
+
+    # Type Disambiguation - same subject as Diploma / Bachelor / Master
+    options = find_type_ambiguity(linked_programs, user_message, state)
+    if options:
+        answer, quick_replies = clarification_response(session_id, session, user_message, options)
+        remember_turn(session, user_message, answer, "clarification")
+        return {"response": answer, "options": quick_replies}
+
+    if len(linked_programs) == 1:
+        program = PROGRAM_INDEX.programs[linked_programs[0]]
+        state.update(program_id=program.id, program_type=program.type, faculty_id=program.faculty_id)
+    elif len(linked_faculties) == 1 and not linked_programs:
+        state.update(program_id=None, program_type=None, faculty_id=linked_faculties[0])
+    elif not linked_programs and not linked_faculties and PROGRAM_INDEX and state.get("program_id") in PROGRAM_INDEX.programs:
+        linked_programs = [state["program_id"]]
+    active_program = PROGRAM_INDEX.programs[linked_programs[0]] if len(linked_programs) == 1 else None
+
+    # Tuition Calculator - "how much is the whole degree", "semester with 15 hours"
+    cost_args = calculator.parse_cost_question(user_message) if active_program else None
+    if cost_args:
+        try:
+            breakdown = calculator.calculate_cost(active_program, **cost_args)
+            answer = calculator.format_cost(breakdown)
+            print(f"[CALCULATOR] {active_program.id} {cost_args} for {session_id}")
+            remember_turn(session, user_message, answer, "calculator")
+            return {"response": answer}
+        except ValueError as e:
+            print(f"Calculator error: {e}")
+
+    # Fact Lookup - hour price, credit hours, minimum average of one program
+    answer = programs.answer_fact(user_message, active_program) if active_program else None
+    if answer:
+        print(f"[FACT] {active_program.id} for {session_id}")
+        remember_turn(session, user_message, answer, "fact")
+        return {"response": answer}
+
+    # Structured Query Engine - price / GPA ranges, cheapest, comparisons.
+    # Lists are answered directly; comparisons become a tiny exact context for the LLM.
+    structured_context = None
+    query = programs.parse_query(user_message, PROGRAM_INDEX) if PROGRAM_INDEX else None
+    if query:
+        result = programs.run_query(PROGRAM_INDEX, query)
+        print(f"[STRUCTURED] {result['kind']} -> {len(result['programs'])} programs for {session_id}")
+        if result["kind"] == "list":
+            answer = programs.format_result(result)
+            remember_turn(session, user_message, answer, "structured")
+            return {"response": answer}
+        structured_context = programs.format_result(result)
+
+    # Single-Flight - during announcements many people ask the same first question at once.
+    # One of them runs moderation / retrieval / completion; the others wait and share the answer.
+    first_turn = not session["turns"] and not chosen_id
+    llm_args = (user_message, linked_programs, linked_faculties, active_program, structured_context, first_turn)
+    if not first_turn:
+        return (yield from llm_steps(session_id, session, *llm_args))
+
+    key = (KB_VERSION, normalize_text(user_message), tuple(linked_programs), tuple(linked_faculties))
+    payload, shared = yield ("coalesce", key, llm_steps(session_id, session, *llm_args))
+    if shared:
+        print(f"[SINGLE-FLIGHT] {session_id} shares the answer to an identical question")
+        if payload.get("options"):
+            state["pending_question"] = user_message
+        remember_turn(session, user_message, payload["response"], "clarification" if payload.get("options") else "llm")
+    return payload
+
+def llm_steps(session_id, session, user_message, linked_programs, linked_faculties, active_program, structured_context, first_turn):
+    """The part of the pipeline that calls OpenAI: moderation, retrieval and the completion."""
+    # Content Moderation - OpenAI API (for additional coverage), concurrently with
+    # the question's embedding for retrieval (not needed with a structured answer).
+    # A flagged message never reaches retrieval.
+    flagged, query_embedding = yield ("screen", user_message, not structured_context)
+    if flagged:
+        # Log the flagged content for review (optional)
+        print(f"[MODERATION-API] Flagged message from {session_id}: {user_message}")
+        return {
+            "response": "⛔ هذه الرسالة غير مقبولة ومخالفة لسياسة الاستخدام.\n\nيُرجى الالتزام بأسلوب محترم عند التواصل مع المساعد الآلي للجامعة.\n\n⚠️ ملاحظة: يتم تسجيل جميع المحادثات.\n\n---\n⛔ This message is unacceptable and violates our usage policy.\n\nPlease use respectful language when communicating with the university assistant.\n\n⚠️ Note: All conversations are logged."
+        }
+
+    # Semantic Answer Cache - popular first-turn questions were answered before, maybe by another worker.
+    # Entries are only shared between questions naming the same programs / faculties.
+    cache_entities = None
+    if ANSWER_CACHE and first_turn and not structured_context:
+        cache_entities = ",".join(sorted(linked_programs) + sorted(f"faculty:{f}" for f in linked_faculties))
+        hit = (yield ("blocking", ANSWER_CACHE.lookup, (KB_VERSION, cache_entities, query_embedding))) if query_embedding else None
+        if hit:
+            answer, score = hit
+            print(f"[ANSWER-CACHE] Hit ({score:.3f}) for {session_id}")
+            remember_turn(session, user_message, answer, "llm")
+            return {"response": answer}
 
     # Retrieve context based on the LATEST message
     # (Optional: specialized retrieval using summarized history, but simple query is usually fine for now)
-    context_chunks = retrieve_context(user_message)
+    top_score = None
+    if structured_context:
+        context_chunks = [structured_context]
+    else:
+        exclude_ids = PROGRAM_INDEX.family(active_program.id) - {active_program.id} if active_program else ()
+        indices, top_score = yield ("blocking", retrieve_context, (user_message, linked_programs, linked_faculties, exclude_ids, query_embedding))
+        context_chunks = [CHUNKS[i] for i in indices]
+
+        # The two best chunks are the same subject in different degree types -> ask which one
+        top_programs = [CHUNK_META.get(i, {}).get("program_id") for i in indices[:2]]
+        if not linked_programs and len(top_programs) == 2 and all(top_programs) and top_programs[1] in PROGRAM_INDEX.family(top_programs[0]):
+            options = find_type_ambiguity(top_programs[:1], user_message, session["state"])
+            if options:
+                answer, quick_replies = clarification_response(session_id, session, user_message, options)
+                remember_turn(session, user_message, answer, "clarification")
+                return {"response": answer, "options": quick_replies}
     
     if not context_chunks:
         # Fallback: Provide general info about valid topics so GPT can at least say "I can answer X, Y, Z"
@@ -460,49 +1495,164 @@ def chat():
     else:
         context_text = "\n\n".join(context_chunks)
 
-    # Format history for prompt
-    history_text = "\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in CONVERSATION_HISTORY[session_id][:-1]])
-    
-    system_prompt = (
-        "You are a helpful assistant for Middle East University (MEU) in Jordan. "
-        "Your goal is to answer student questions based on the provided context.\n\n"
-        
-        "IMPORTANT RULES:\n"
-        "1. **Prioritize History for Follow-ups**: If the user asks a follow-up question (e.g., 'How much is it?', 'What are the requirements?') and the previous message was about a specific program/topic, ASSUME they are asking about the SAME topic. Use information from the Conversation History if the current Context is irrelevant.\n"
-        "2. **Disambiguate Program Types**: If the Context contains MULTIPLE programs with similar names but DIFFERENT types (e.g., Diploma vs Bachelor, or Bachelor vs Master), you MUST ask the user to clarify which type they mean. Example: 'هل تقصد دبلوم الإعلام الرقمي أم بكالوريوس الصحافة والإعلام الرقمي؟' (Do you mean the Diploma or Bachelor?). Do NOT assume one type over another.\n"
-        "3. **Ask for Clarification**: If the user's question is vague (e.g., 'fees', 'master', 'location') AND there is NO clear topic in the Conversation History, ask a clarifying question. Example: 'Which program are you asking about?'\n"
-        "4. **Unknown Info**: If the answer is STRICTLY not in the context and you cannot clarify, you MUST answer EXACTLY with the following Arabic text:\n"
-        "\"للحصول على المعلومة المطلوبة يمكنك التواصل مع الجامعة من خلال الارقام التالية \n"
-        "+962 6 4790222\n"
-        "+962 79 712 2000\n"
-        "او عبر الواتس اب \n"
-        "+962 79 712 2000\"\n"
-        "5. **Be Concise**: Keep answers short and relevant.\n\n"
+    # Model Routing - pick the tier from what is known locally (see router.py)
+    if structured_context:
+        intent = "comparison"
+    elif context_chunks and context_chunks[0].startswith("Question:"):
+        intent = "canned"  # best match is one of the canned answers
+    elif linked_programs or linked_faculties:
+        intent = "lookup"
+    else:
+        intent = "general"
+    features = router.question_features(user_message, context_chunks, list(linked_programs) + list(linked_faculties), intent, top_score)
+    tier, settings, rule = ROUTER.route(features)
+    print(f"[ROUTER] {tier} (rule {rule}) for {session_id}: {features}")
 
-        f"--- Conversation History ---\n{history_text}\n\n"
-        f"--- New User Question ---\n{user_message}\n\n"
-        f"--- Context (Search Results) ---\n{context_text}\n----------------"
-    )
+    kind = "llm"
+    started = time.perf_counter()
+    answer = None
+    if settings.get("model") is None:
+        # No-LLM tier: the canned answer of the best chunk, else the default tier
+        top = context_chunks[0] if context_chunks else ""
+        answer = top.split("Answer:", 1)[1].strip() if "Answer:" in top else None
+        if answer:
+            kind = "direct"
+        else:
+            tier, settings = "default", ROUTER.tiers.get("default", router.DEFAULT_TIERS["default"])
+    if not answer:
+        try:
+            answer = yield ("complete", dict(
+                model=settings["model"],
+                # Static prefix first (cached upstream), the question once, at the end
+                messages=build_messages(session, user_message, context_text),
+                temperature=settings.get("temperature", 0.7),
+                max_tokens=settings.get("max_tokens", 500),
+                timeout=LLM_TIMEOUT_SECONDS
+            ))
+            if cache_entities is not None and query_embedding:
+                yield ("blocking", ANSWER_CACHE.store, (KB_VERSION, cache_entities, user_message, query_embedding, answer))
+        except Exception as e:
+            # Summary mode: answer from the chunks we already retrieved instead of failing
+            reason = "circuit_open" if isinstance(e, circuit.CircuitOpenError) else "timeout" if isinstance(e, openai.APITimeoutError) else "error"
+            print(f"OpenAI Error ({reason}), answering in summary mode: {e}")
+            kind = "summary_mode"
+            with STATS_LOCK:
+                SUMMARY_MODE_ANSWERS[reason] += 1
+            entities = [f"({pid})" for pid in linked_programs]  # program chunks name their id in brackets
+            answer = extractive.extractive_answer(user_message, context_chunks, entities)
+            if not answer:
+                answer = f"{extractive.SUMMARY_MODE_MARKER}\n{UNKNOWN_INFO_ANSWER}"
+
+    # Latency outcome of the decision, per tier (p95 in /api/metrics under stage_timings)
+    elapsed = time.perf_counter() - started
+    STAGE_TIMINGS.record(f"route:{tier}", elapsed)
+    print(f"[ROUTER] {tier} answered ({kind}) in {elapsed * 1000:.0f} ms for {session_id}")
+
+    remember_turn(session, user_message, answer, kind)
+
+    return {"response": answer}
+
+@app.route("/api/faq", methods=["GET"])
+def faq_list():
+    """Keys and questions of the canonical FAQ answers."""
+    return jsonify([{"key": key, "question": question} for key, question in FAQ_QUESTIONS.items()])
+
+@app.route("/api/faq/<key>", methods=["GET"])
+def faq(key):
+    """Cacheable answer to a canonical question. The ETag changes with the knowledge base."""
+    if key not in FAQ_QUESTIONS:
+        return jsonify({"error": f"Unknown FAQ '{key}'"}), 404
+
+    initialize_knowledge_base()
+    etag = f"{KB_VERSION}-{key}"
+    cache_control = f"public, max-age={FAQ_MAX_AGE}"
+
+    # Revalidation: answer 304 before touching the pipeline
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = cache_control
+        return response
+
+    payload = faq_answer(key)
+    response = jsonify({"key": key, "question": FAQ_QUESTIONS[key], "version": KB_VERSION, **payload})
+    if extractive.SUMMARY_MODE_MARKER in payload["response"]:
+        response.headers["Cache-Control"] = "no-store"
+        return response
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = cache_control
+    return response
+
+@app.route("/api/cost", methods=["GET", "POST"])
+def cost():
+    """Deterministic tuition calculator.
+
+    Parameters (JSON body or query string): program_id, hours, semesters,
+    whole_degree, non_jordanian, summer_semesters (alone: only summer semesters).
+    """
+    params = request.get_json(silent=True) or request.args
+    program_id = params.get("program_id")
+    if not program_id:
+        return jsonify({"error": "No program_id provided"}), 400
+
+    initialize_knowledge_base()
+    program = PROGRAM_INDEX.programs.get(program_id) if PROGRAM_INDEX else None
+    if not program:
+        return jsonify({"error": f"Unknown program_id '{program_id}'"}), 404
+
+    def flag(name):
+        return str(params.get(name, "")).lower() in ("1", "true", "yes")
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini", # Cost effective model
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
-            temperature=0.7,
-            max_tokens=500
+        breakdown = calculator.calculate_cost(
+            program,
+            hours=int(params["hours"]) if params.get("hours") else None,
+            semesters=int(params["semesters"]) if params.get("semesters") else None,
+            whole_degree=flag("whole_degree"),
+            non_jordanian=flag("non_jordanian"),
+            summer_semesters=int(params.get("summer_semesters") or 0),
         )
-        answer = response.choices[0].message.content
-        
-        # Append assistant answer to history
-        CONVERSATION_HISTORY[session_id].append({"role": "assistant", "content": answer})
-        
-        return jsonify({"response": answer})
-    except Exception as e:
-        print(f"OpenAI Error: {e}")
-        return jsonify({"error": str(e)}), 500
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    breakdown["text"] = calculator.format_cost(breakdown)
+    return jsonify(breakdown)
+
+@app.route("/api/metrics", methods=["GET"])
+def metrics():
+    """Counters for monitoring the local fast paths."""
+    with STATS_LOCK:
+        intent_hits = dict(INTENT_HITS)
+        summary_mode = dict(SUMMARY_MODE_ANSWERS)
+        degraded = dict(DEGRADED)
+        prompt_tokens = dict(PROMPT_TOKENS)
+    return jsonify({
+        "intents": {
+            "hits": intent_hits,
+            "threshold": INTENT_CONFIDENCE_THRESHOLD,
+        },
+        "summary_mode": summary_mode,
+        "degraded": degraded,
+        "circuit_breakers": {endpoint: breaker.metrics() for endpoint, breaker in UPSTREAM_BREAKERS.items()},
+        "prompt_tokens": {
+            **prompt_tokens,
+            "cached_ratio": round(prompt_tokens["cached"] / prompt_tokens["prompt"], 3) if prompt_tokens.get("prompt") else None,
+        },
+        "answer_cache": ANSWER_CACHE.metrics() if ANSWER_CACHE else None,
+        "moderation_cache": MODERATION_CACHE.metrics(),
+        "idempotency": IDEMPOTENCY.metrics(),
+        "single_flight": SINGLE_FLIGHT.metrics(),
+        "query_embedding_cache": QUERY_EMBEDDING_CACHE.metrics(),
+        "retrieval_cache": RETRIEVAL_CACHE.metrics(),
+        "sessions": SESSIONS.metrics() if SESSIONS else STATE_TOKENS.metrics(),
+        "admission": ADMISSION.metrics(),
+        "upstream": {endpoint: limiter.metrics() for endpoint, limiter in UPSTREAM_LIMITS.items()},
+        "http_pool": {"http2_enabled": openai_clients.HTTP2, **openai_clients.POOL_STATS.metrics()},
+        "stage_timings": STAGE_TIMINGS.metrics(),
+        "routing": ROUTER.metrics(),
+        "knowledge_base": {"version": KB_VERSION, "warmup": dict(WARMUP)},
+        **{name: source() for name, source in METRICS_SOURCES.items()},
+    })
 
 if __name__ == "__main__":
     print("Running locally")
@@ -0,0 +1,320 @@
+"""ASGI serving mode: the /api/chat contract on Starlette with the async OpenAI client.
+
+    uvicorn asgi_app:app --host 0.0.0.0 --port 4000 --workers 2
+
+The chat pipeline is the same one app.py runs (app.chat_steps); only its
+OpenAI calls are awaited here instead of blocking a thread, so one worker
+holds hundreds of open conversations. Every other route (static files, FAQ,
+cost calculator, metrics) is the Flask app, mounted as WSGI.
+"""
+import asyncio
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+
+import openai
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as chatbot
+import openai_clients
+from singleflight import AsyncSingleFlight
+
+# Same settings as app.client; one pool for all the coroutines of the worker
+aclient = openai_clients.make_async_client(
+    pool_size=int(os.getenv("OPENAI_ASYNC_POOL_SIZE", "100")),
+    keepalive=float(os.getenv("OPENAI_KEEPALIVE", "30")),
+    connect_timeout=float(os.getenv("OPENAI_CONNECT_TIMEOUT", "3")),
+    pool_timeout=float(os.getenv("OPENAI_POOL_TIMEOUT", "5")),
+)
+
+SINGLE_FLIGHT = AsyncSingleFlight(timeout=chatbot.SINGLE_FLIGHT.timeout)
+
+IN_FLIGHT = {"current": 0, "peak": 0}
+
+
+async def upstream(endpoint, create, consume=None, **kwargs):
+    """Async twin of app.upstream(): same limiters and circuit breakers, so both clients share them per endpoint."""
+    kwargs.setdefault("timeout", chatbot.UPSTREAM_TIMEOUTS[endpoint])
+    breaker = chatbot.UPSTREAM_BREAKERS[endpoint]
+    rate_limited = failed = 0
+    while True:
+        breaker.allow()
+        try:
+            async with chatbot.UPSTREAM_LIMITS[endpoint].async_slot(chatbot.UPSTREAM_PRIORITY.get()) as call:
+                raw = await create(**kwargs)
+                call.responded(raw.headers)
+                result = await consume(raw) if consume else raw.parse()
+        except openai.RateLimitError as e:
+            breaker.record(None)
+            if rate_limited == chatbot.UPSTREAM_RATE_LIMIT_RETRIES or e.code == "insufficient_quota":
+                raise
+            rate_limited += 1
+            print(f"[UPSTREAM] {endpoint} rate-limited, queueing again ({rate_limited}/{chatbot.UPSTREAM_RATE_LIMIT_RETRIES})")
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            breaker.record(False)
+            if endpoint not in chatbot.IDEMPOTENT_ENDPOINTS or failed == chatbot.UPSTREAM_RETRIES:
+                raise
+            delay = openai_clients.backoff(failed)
+            failed += 1
+            print(f"[UPSTREAM] {endpoint} failed ({e.__class__.__name__}), retry {failed}/{chatbot.UPSTREAM_RETRIES} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+        except BaseException:
+            breaker.record(None)
+            raise
+        else:
+            breaker.record(True, call.latency)
+            return result
+
+
+async def is_flagged(user_message):
+    key = chatbot.moderation_key(user_message)
+    flagged = chatbot.MODERATION_CACHE.get(key)
+    if flagged is None:
+        moderation_response = await upstream("moderations", aclient.moderations.with_raw_response.create, input=user_message, model=chatbot.MODERATION_MODEL)
+        flagged = moderation_response.results[0].flagged
+        chatbot.MODERATION_CACHE.set(key, flagged)
+    return flagged
+
+
+async def embed_query(query):
+    key = chatbot.normalize_text(query)
+    embedding = chatbot.QUERY_EMBEDDING_CACHE.get(key)
+    if embedding is not None:
+        return embedding
+    try:
+        query_response = await upstream("embeddings", aclient.embeddings.with_raw_response.create, input=query, model="text-embedding-3-small")
+        embedding = query_response.data[0].embedding
+    except Exception as e:
+        print(f"Error embedding query: {e}")
+        return None
+    chatbot.QUERY_EMBEDDING_CACHE.set(key, embedding)
+    return embedding
+
+
+async def timed(awaitable):
+    started = time.perf_counter()
+    result = await awaitable
+    return result, time.perf_counter() - started
+
+
+async def screen(user_message, with_embedding=True):
+    """Async twin of app.screen(): a flagged message cancels the embedding."""
+    started = time.perf_counter()
+    moderation = asyncio.create_task(timed(is_flagged(user_message)))
+    embedding = asyncio.create_task(timed(embed_query(user_message))) if with_embedding else None
+    try:
+        flagged, moderation_seconds = None, None
+        try:
+            flagged, moderation_seconds = await moderation
+        except Exception as e:
+            print(f"Moderation API error: {e}")
+        if flagged or embedding is None:
+            chatbot.record_screen(time.perf_counter() - started, moderation_seconds, None)
+            return flagged, None
+        query_embedding, embedding_seconds = await embedding
+        chatbot.record_screen(time.perf_counter() - started, moderation_seconds, embedding_seconds)
+        return flagged, query_embedding
+    finally:
+        if embedding:
+            embedding.cancel()
+
+
+async def complete(kwargs):
+    on_token = chatbot.ON_TOKEN.get()
+    if on_token is None:
+        response = await upstream("chat", aclient.chat.completions.with_raw_response.create, **kwargs)
+        chatbot.record_usage(response.usage)
+        return response.choices[0].message.content
+    parts = []
+
+    async def consume(raw):
+        async for chunk in raw.parse():
+            chatbot.record_usage(getattr(chunk, "usage", None))
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text:
+                parts.append(text)
+                on_token(text)
+        return "".join(parts)
+
+    return await upstream("chat", aclient.chat.completions.with_raw_response.create, consume,
+                          **kwargs, stream=True, stream_options={"include_usage": True})
+
+
+async def run_op(op):
+    kind = op[0]
+    if kind == "screen":
+        return await screen(op[1], op[2])
+    if kind == "complete":
+        answer, seconds = await timed(complete(op[1]))
+        chatbot.STAGE_TIMINGS.record("completion", seconds)
+        return answer
+    if kind == "coalesce":
+        _, key, steps = op
+        return await SINGLE_FLIGHT.do(key, lambda: run_steps(steps))
+    if kind == "blocking":
+        # Retrieval, answer-cache comparisons and SQLite would stall every open stream
+        _, fn, args = op
+        return await asyncio.to_thread(fn, *args)
+    raise ValueError(f"Unknown pipeline op '{kind}'")
+
+
+async def run_steps(steps):
+    """Async twin of app.run_steps()."""
+    value, error = None, None
+    while True:
+        try:
+            op = steps.throw(error) if error else steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value, error = None, None
+        try:
+            value = await run_op(op)
+        except Exception as e:
+            error = e
+
+
+async def chat(request):
+    try:
+        data = await read_json(request)
+        # Token buckets are a SQLite (or Redis) transaction that may wait on other workers
+        traffic = await asyncio.to_thread(chatbot.admit, data, request.headers, client_host(request))
+    except chatbot.admission.Rejected as e:
+        return rejection(e)
+    priority = chatbot.UPSTREAM_PRIORITY.set(traffic)
+    try:
+        payload, status = await chat_request(data, request.headers.get("Idempotency-Key"), client_host(request))
+    finally:
+        chatbot.UPSTREAM_PRIORITY.reset(priority)
+        chatbot.ADMISSION.leave(traffic)
+    return JSONResponse(payload, status_code=status)
+
+
+async def chat_stream(request):
+    """Same events as the Flask /api/chat/stream."""
+    try:
+        data = await read_json(request)
+        if not data.get("message"):
+            return JSONResponse({"error": "No message provided"}, status_code=400)
+        traffic = await asyncio.to_thread(chatbot.admit, data, request.headers, client_host(request))
+    except chatbot.admission.Rejected as e:
+        return rejection(e)
+    idempotency_key = request.headers.get("Idempotency-Key")
+    events = asyncio.Queue()
+
+    async def run():
+        chatbot.ON_TOKEN.set(lambda text: events.put_nowait(("token", text)))
+        chatbot.UPSTREAM_PRIORITY.set(traffic)
+        try:
+            payload, status = await chat_request(data, idempotency_key, client_host(request))
+            events.put_nowait(("done" if status == 200 else "error", payload))
+        except Exception as e:
+            print(f"Streaming error: {e}")
+            events.put_nowait(("error", {"error": "Something went wrong"}))
+        finally:
+            chatbot.ADMISSION.leave(traffic)
+
+    async def stream():
+        task = asyncio.create_task(run())  # own context: ON_TOKEN is only set for this request
+        while True:
+            event, payload = await events.get()
+            yield f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+            if event != "token":
+                break
+        await task
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def read_json(request):
+    if int(request.headers.get("content-length") or 0) > chatbot.app.config["MAX_CONTENT_LENGTH"]:
+        raise chatbot.admission.Rejected(413, "Request body is too large")
+    try:
+        return await request.json()
+    except ValueError:
+        return {}
+
+
+def rejection(e):
+    print(f"[ADMISSION] {e.status} {e.error}")
+    return JSONResponse(e.payload(), status_code=e.status, headers=e.headers())
+
+
+def client_host(request):
+    return chatbot.client_address(request.client.host if request.client else None, request.headers.get("X-Forwarded-For"))
+
+
+async def chat_request(data, idempotency_key=None, remote_addr=None):
+    """Async twin of app.chat_request(). Returns (payload, HTTP status)."""
+    user_message = data.get("message", "")
+    session_id = str(data.get("session_id") or remote_addr)[:128]  # IP as fallback session ID
+
+    if not user_message:
+        return {"error": "No message provided"}, 400
+
+    chosen_id = data.get("program_id")
+    # Knowledge-base (re)loads call the sync client, keep them off the event loop
+    await asyncio.to_thread(chatbot.initialize_knowledge_base)
+
+    async def run():
+        if chatbot.STATE_TOKENS:
+            session = chatbot.STATE_TOKENS.loads(data.get("state_token"))
+            first_turn = not session["turns"]
+            payload, seconds = await timed(run_steps(chatbot.chat_steps(user_message, session_id, session, chosen_id)))
+            payload = {**payload, "state_token": chatbot.STATE_TOKENS.dumps(session)}
+        else:
+            # Sessions and the conversation log are SQLite (or Redis) I/O: in a thread, off the event loop
+            async with chatbot.SESSIONS.async_lock(session_id):
+                session = await asyncio.to_thread(chatbot.SESSIONS.load, session_id)
+                first_turn = not session["turns"]
+                payload, seconds = await timed(run_steps(chatbot.chat_steps(user_message, session_id, session, chosen_id)))
+                await asyncio.to_thread(chatbot.SESSIONS.save, session_id, session)
+        chatbot.STAGE_TIMINGS.record("request", seconds)
+        await asyncio.to_thread(chatbot.log_turn, session_id, user_message, payload, first_turn)
+        return payload
+
+    IN_FLIGHT["current"] += 1
+    IN_FLIGHT["peak"] = max(IN_FLIGHT["peak"], IN_FLIGHT["current"])
+    try:
+        idempotency_key = idempotency_key or data.get("idempotency_key")
+        if not idempotency_key:
+            return await run(), 200
+
+        # The store of app.py: same contract, and duplicates across both servers attach
+        try:
+            payload, outcome = await chatbot.IDEMPOTENCY.run_async(f"{session_id}:{idempotency_key}", run, fingerprint=(user_message, chosen_id))
+        except chatbot.idempotency.IdempotencyError as e:
+            return e.payload(), e.status
+        if outcome != "new":
+            print(f"[IDEMPOTENCY] {outcome} duplicate of {idempotency_key} from {session_id}")
+        return payload, 200
+    finally:
+        IN_FLIGHT["current"] -= 1
+
+
+def metrics():
+    return {
+        "in_flight": dict(IN_FLIGHT),
+        "single_flight": SINGLE_FLIGHT.metrics(),
+    }
+
+
+@asynccontextmanager
+async def lifespan(_):
+    chatbot.METRICS_SOURCES["asgi"] = metrics
+    await asyncio.to_thread(chatbot.initialize_knowledge_base)
+    yield
+    await aclient.close()
+
+
+app = Starlette(
+    routes=[
+        Route("/api/chat", chat, methods=["POST"]),
+        Route("/api/chat/stream", chat_stream, methods=["POST"]),
+        Mount("/", WSGIMiddleware(chatbot.app)),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,171 @@
+"""Benchmarks the Flask (gunicorn) and ASGI (uvicorn) serving modes against a mock OpenAI.
+
+Starts a local mock of the OpenAI endpoints with fixed latencies, then each
+server pointed at it through OPENAI_BASE_URL, and reports throughput and
+p50 / p99 latency of /api/chat at 50, 200 and 1000 concurrent users.
+
+    python benchmark_asgi.py
+
+The mock upstream alone: uvicorn benchmark_asgi:mock_app --port 8900
+"""
+import asyncio
+import concurrent.futures
+import hashlib
+import os
+import subprocess
+import sys
+import time
+
+import requests
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+# Configuration
+USER_COUNTS = [50, 200, 1000]
+MOCK_PORT = 8900
+SERVERS = {
+    # Same command line as the Procfile
+    "flask (gunicorn 4x4)": (8901, [sys.executable, "-m", "gunicorn", "app:app", "--workers", "4", "--threads", "4",
+                                    "--timeout", "300", "--backlog", "4096", "--bind", "127.0.0.1:8901"]),
+    "asgi (uvicorn 1 worker)": (8902, [sys.executable, "-m", "uvicorn", "asgi_app:app", "--port", "8902",
+                                       "--workers", "1", "--log-level", "warning", "--no-access-log", "--backlog", "4096"]),
+}
+MODERATION_LATENCY = float(os.getenv("MOCK_MODERATION_LATENCY", "0.15"))
+EMBEDDING_LATENCY = float(os.getenv("MOCK_EMBEDDING_LATENCY", "0.15"))
+COMPLETION_LATENCY = float(os.getenv("MOCK_COMPLETION_LATENCY", "0.8"))
+EMBEDDING_SIZE = 256
+
+
+# --- Mock OpenAI upstream ----------------------------------------------------
+
+def fake_embedding(text):
+    digest = hashlib.sha256(text.encode("utf-8")).digest()
+    return [(digest[i % len(digest)] - 128) / 128 for i in range(EMBEDDING_SIZE)]
+
+
+async def moderations(request):
+    await asyncio.sleep(MODERATION_LATENCY)
+    return JSONResponse({"id": "modr-mock", "model": "mock", "results": [{"flagged": False, "categories": {}, "category_scores": {}}]})
+
+
+async def embeddings(request):
+    body = await request.json()
+    inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    await asyncio.sleep(EMBEDDING_LATENCY)
+    return JSONResponse({
+        "object": "list",
+        "model": body["model"],
+        "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(text)} for i, text in enumerate(inputs)],
+        "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+    })
+
+
+async def completions(request):
+    body = await request.json()
+    await asyncio.sleep(COMPLETION_LATENCY)
+    return JSONResponse({
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Mock answer."}}],
+        "usage": {"prompt_tokens": 500, "completion_tokens": 3, "total_tokens": 503},
+    })
+
+
+mock_app = Starlette(routes=[
+    Route("/v1/moderations", moderations, methods=["POST"]),
+    Route("/v1/embeddings", embeddings, methods=["POST"]),
+    Route("/v1/chat/completions", completions, methods=["POST"]),
+])
+
+
+# --- Load generation ---------------------------------------------------------
+
+def simulate_user(url, user_id):
+    """One first-turn question per user; distinct texts so no cache or coalescing helps."""
+    payload = {"message": f"ما هي شروط القبول في كلية الهندسة {user_id}", "session_id": f"bench_{user_id}"}
+    start = time.time()
+    try:
+        response = requests.post(url, json=payload, timeout=600)
+        return response.status_code == 200, time.time() - start
+    except Exception:
+        return False, time.time() - start
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else 0
+
+
+def run_level(url, users):
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=users) as executor:
+        results = list(executor.map(lambda i: simulate_user(url, i), range(users)))
+    total = time.time() - start
+    durations = [d for ok, d in results if ok]
+    return {
+        "ok": len(durations),
+        "failed": users - len(durations),
+        "throughput": len(durations) / total,
+        "p50": percentile(durations, 50),
+        "p99": percentile(durations, 99),
+    }
+
+
+def start(command, port, env):
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    for _ in range(100):
+        try:
+            requests.get(f"http://127.0.0.1:{port}/", timeout=5)
+            return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def run_benchmark():
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY="mock",
+        OPENAI_BASE_URL=f"http://127.0.0.1:{MOCK_PORT}/v1",
+        ANSWER_CACHE="0",
+        WARM_CACHES="0",
+        CONVERSATION_LOG="",
+        # Serving capacity is measured here, not admission control: no budgets, no in-flight cap
+        RATE_LIMIT_IP="0",
+        RATE_LIMIT_SESSION="0",
+        MAX_IN_FLIGHT="100000",
+    )
+    print(f"Mock upstream latency: moderation {MODERATION_LATENCY}s, embedding {EMBEDDING_LATENCY}s, completion {COMPLETION_LATENCY}s")
+    mock = start([sys.executable, "-m", "uvicorn", "benchmark_asgi:mock_app", "--port", str(MOCK_PORT),
+                  "--log-level", "warning", "--no-access-log", "--backlog", "4096"], MOCK_PORT, env)
+    rows = []
+    try:
+        for name, (port, command) in SERVERS.items():
+            server = start(command, port, env)
+            try:
+                url = f"http://127.0.0.1:{port}/api/chat"
+                simulate_user(url, "warmup")  # loads the knowledge base
+                for users in USER_COUNTS:
+                    print(f"{name}: {users} users...")
+                    rows.append((name, users, run_level(url, users)))
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    print("-" * 78)
+    print(f"{'server':26} {'users':>6} {'ok':>6} {'failed':>6} {'req/s':>8} {'p50 (s)':>8} {'p99 (s)':>8}")
+    for name, users, r in rows:
+        print(f"{name:26} {users:6} {r['ok']:6} {r['failed']:6} {r['throughput']:8.1f} {r['p50']:8.2f} {r['p99']:8.2f}")
+    print("-" * 78)
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,41 @@
+"""Throughput of the local bad-words filter: the old per-word substring loop vs the compiled pattern.
+
+    python benchmark_moderation.py
+
+Runs both over the verify_moderation.py corpus and reports messages per
+second and how many clean messages each one blocks.
+"""
+import time
+
+from profanity import OFFENSIVE_WORDS, WordFilter
+from verify_moderation import CLEAN, OFFENSIVE
+
+ROUNDS = 2000
+
+
+def substring_loop(user_message):
+    """The filter as app.py used to run it: the word list rebuilt per message, one `in` per word."""
+    offensive_words = list(OFFENSIVE_WORDS)
+    message_lower = user_message.lower()
+    for word in offensive_words:
+        if word in message_lower:
+            return word
+    return None
+
+
+def measure(find):
+    messages = CLEAN + OFFENSIVE
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for message in messages:
+            find(message)
+    elapsed = time.perf_counter() - start
+    return len(messages) * ROUNDS / elapsed, sum(1 for message in CLEAN if find(message))
+
+
+if __name__ == "__main__":
+    word_filter = WordFilter()
+    print(f"{'filter':18} {'msgs/s':>10} {'clean blocked':>14}")
+    for name, find in (("substring loop", substring_loop), ("compiled pattern", word_filter.find)):
+        rate, false_blocks = measure(find)
+        print(f"{name:18} {rate:10.0f} {false_blocks:>8}/{len(CLEAN)}")
@@ -0,0 +1,173 @@
+import math
+import re
+
+from programs import PRICE_FACT
+from textnorm import normalize_text
+
+# The Jordanian dinar is pegged at 0.709 JOD per USD
+USD_PER_JOD = 1.41
+
+# Regular semesters needed to finish each program type (normal study plan)
+SEMESTERS_BY_TYPE = {"bachelor": 8, "diploma": 4, "master": 4, "higher_diploma": 2}
+DEFAULT_SEMESTER_HOURS = 15
+DEFAULT_SUMMER_HOURS = 9  # the usual summer semester load
+
+AMOUNT = re.compile(r"(\d+(?:\.\d+)?)\s*(?:دينار|JOD)", re.I)
+
+
+def parse_fee(text):
+    """Parses one ebooklet fee line, e.g. "رسوم التسجيل الفصلية 500 دينار"."""
+    match = AMOUNT.search(text)
+    if not match:
+        return None
+    label = text[:match.start()].strip()
+    normalized = normalize_text(label)
+
+    if "اختياري" in normalized:
+        kind = "optional"
+    elif "امتحان" in normalized:
+        kind = "per_exam"
+    elif "صيفي" in normalized:
+        kind = "summer"
+    elif "مره واحده" in normalized or "لمره" in normalized:
+        kind = "one_time"
+    elif "فصلي" in normalized:
+        kind = "semester"
+    else:
+        kind = "other"
+
+    return {
+        "label": label,
+        "jod": float(match.group(1)),
+        "kind": kind,
+        "refundable": "مسترد" in normalized,
+        "non_jordanian_only": "غير الاردنيين" in normalized,
+    }
+
+
+def parse_fees(fees):
+    """Parses a program's fees list, skipping lines without an amount."""
+    return [fee for fee in (parse_fee(f) for f in fees) if fee]
+
+
+def _item(label, jod, usd=None):
+    return {"label": label, "jod": round(jod, 2), "usd": round(usd if usd is not None else jod * USD_PER_JOD, 2)}
+
+
+def calculate_cost(program, hours=None, semesters=None, whole_degree=False, non_jordanian=False, summer_semesters=0):
+    """Itemised JOD/USD cost for a programs.Program.
+
+    whole_degree uses the program's total credit hours and its normal number of
+    semesters and includes one-time fees. Otherwise hours default to the load of
+    the semesters: one regular semester, or none (semesters=0) with only
+    summer_semesters.
+    """
+    if program.price_jod is None:
+        raise ValueError(f"No credit hour price for program '{program.id}'")
+
+    if whole_degree:
+        hours = hours or program.credit_hours
+        if not hours:
+            raise ValueError(f"Unknown credit hours for program '{program.id}'")
+        semesters = semesters or SEMESTERS_BY_TYPE.get(program.type) or math.ceil(hours / DEFAULT_SEMESTER_HOURS)
+    else:
+        if semesters is None:
+            semesters = 0 if summer_semesters else 1
+        hours = hours or DEFAULT_SEMESTER_HOURS * semesters + DEFAULT_SUMMER_HOURS * summer_semesters
+
+    price_usd = program.price_usd if program.price_usd is not None else program.price_jod * USD_PER_JOD
+    items = [_item(f"الرسوم الدراسية ({hours} ساعة × {program.price_jod:g} دينار)",
+                   hours * program.price_jod, hours * price_usd)]
+    notes = []
+
+    for fee in parse_fees(program.fees):
+        if fee["non_jordanian_only"] and not non_jordanian:
+            notes.append(f"{fee['label']}: {fee['jod']:g} دينار (للطلبة غير الأردنيين فقط)")
+        elif fee["kind"] == "semester" and semesters:
+            items.append(_item(f"{fee['label']} × {semesters}", fee["jod"] * semesters))
+        elif fee["kind"] == "summer" and summer_semesters:
+            items.append(_item(f"{fee['label']} × {summer_semesters}", fee["jod"] * summer_semesters))
+        elif fee["kind"] == "one_time" and whole_degree:
+            label = fee["label"] + (" (تسترد)" if fee["refundable"] else "")
+            items.append(_item(label, fee["jod"]))
+        else:
+            notes.append(f"{fee['label']}: {fee['jod']:g} دينار")
+
+    return {
+        "program_id": program.id,
+        "program": program.label,
+        "hours": hours,
+        "semesters": semesters,
+        "summer_semesters": summer_semesters,
+        "whole_degree": whole_degree,
+        "items": items,
+        "total_jod": round(sum(i["jod"] for i in items), 2),
+        "total_usd": round(sum(i["usd"] for i in items), 2),
+        "notes": notes,
+    }
+
+
+def format_cost(breakdown):
+    """Formats a cost breakdown as a short bilingual answer."""
+    periods = [f"{breakdown['hours']} ساعة"]
+    if breakdown["semesters"]:
+        periods.append(f"{breakdown['semesters']} {'فصول' if breakdown['whole_degree'] else 'فصل'}")
+    if breakdown["summer_semesters"]:
+        periods.append(f"{breakdown['summer_semesters']} فصل صيفي")
+    if breakdown["whole_degree"]:
+        title = f"التكلفة التقديرية لكامل {breakdown['program']} ({'، '.join(periods)}):"
+    else:
+        title = f"التكلفة التقديرية لـ {breakdown['program']} ({'، '.join(periods)}):"
+    lines = [title]
+    for item in breakdown["items"]:
+        lines.append(f"- {item['label']}: {item['jod']:g} دينار ({item['usd']:g} USD)")
+    lines.append(f"المجموع (Total): {breakdown['total_jod']:g} JOD / {breakdown['total_usd']:g} USD")
+    if breakdown["notes"]:
+        lines.append("رسوم أخرى حسب الحالة (غير محسوبة في المجموع):")
+        lines.extend(f"- {note}" for note in breakdown["notes"])
+    lines.append("* الأرقام تقديرية وقد تختلف حسب الخطة الدراسية. / Estimates only.")
+    return "\n".join(lines)
+
+
+# --- Cost questions in chat ---------------------------------------------------
+
+HOURS = re.compile(r"(\d+)\s*(?:ساعه|ساعات|credit hours?|hours?|hrs?)\b")
+SEMESTERS = re.compile(r"(\d+)\s*(?:فصل|فصول|semesters?)\b")
+WHOLE_DEGREE = re.compile(
+    r"كامل|كامله|اجمالي|الاجماليه|الكليه للتخصص|مجموع|طول الدراسه|"
+    r"whole|full degree|entire|total cost|all years"
+)
+SEMESTER_WORDS = re.compile(r"فصل|الفصل|semester")
+SUMMER_WORDS = re.compile(r"صيفي|summer")
+COST_WORDS = re.compile(r"تكلف|كلف|يكلف|بكلف|كم سعر|كم رسوم|كم بدفع|cost|how much|price|fees|total|مجموع|اجمالي")
+NON_JORDANIAN = re.compile(r"غير اردني|وافد|non jordanian|international student|foreign student")
+
+
+def parse_cost_question(message):
+    """Returns calculate_cost() keyword arguments for a total-cost question, or None.
+
+    The price of one hour ("سعر الساعة في الفصل الصيفي") is a fact, not a cost
+    to calculate, unless the question also gives hours, semesters or the whole degree.
+    """
+    text = normalize_text(message)
+    if not COST_WORDS.search(text):
+        return None
+
+    hours = HOURS.search(text)
+    semesters = SEMESTERS.search(text)
+    whole = bool(WHOLE_DEGREE.search(text))
+    if not (hours or semesters or whole or SEMESTER_WORDS.search(text)):
+        return None
+    if PRICE_FACT.search(text) and not (hours or semesters or whole):
+        return None
+
+    args = {
+        "hours": int(hours.group(1)) if hours else None,
+        "semesters": int(semesters.group(1)) if semesters else None,
+        "whole_degree": whole,
+        "non_jordanian": bool(NON_JORDANIAN.search(text)),
+    }
+    if SUMMER_WORDS.search(text) and not whole:
+        # A summer semester: its own fee instead of the regular semester's
+        args.update(semesters=0, summer_semesters=int(semesters.group(1)) if semesters else 1)
+    return args
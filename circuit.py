@@ -0,0 +1,92 @@
+import threading
+import time
+from collections import Counter, deque
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpenError(Exception):
+    """The endpoint's circuit is open: the call was not made."""
+
+
+class CircuitBreaker:
+    """Stops calling an upstream endpoint that keeps failing, so requests degrade at once instead of waiting.
+
+    closed: calls go through; over the last `window` calls (at least
+    `min_calls`), failures and calls slower than `slow_seconds` are counted,
+    and reaching `failure_ratio` opens the circuit. open: calls fail with
+    CircuitOpenError for `open_seconds`. half_open: `probes` calls go
+    through; if they all succeed the circuit closes, a failure opens it again.
+    """
+
+    def __init__(self, name, failure_ratio=0.5, min_calls=5, window=20, slow_seconds=None, open_seconds=30.0, probes=1):
+        self.name = name
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.slow_seconds = slow_seconds
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.state = CLOSED
+        self.stats = Counter()
+        self._outcomes = deque(maxlen=window)  # True for a failed or slow call
+        self._opened_at = 0.0
+        self._probing = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Raises CircuitOpenError unless a call may go through now."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                self._transition(HALF_OPEN)
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN and self._probing < self.probes:
+                self._probing += 1
+                return
+            self.stats["rejected"] += 1
+        raise CircuitOpenError(f"{self.name} circuit is {self.state}")
+
+    def record(self, ok, seconds=None):
+        """Outcome of an allowed call: True / False, or None when it says nothing about the endpoint's health."""
+        with self._lock:
+            if ok and self.slow_seconds and seconds is not None and seconds > self.slow_seconds:
+                self.stats["slow"] += 1
+                ok = False
+            if ok is False:
+                self.stats["failures"] += 1
+            if self.state == HALF_OPEN:
+                self._probing = max(0, self._probing - 1)
+                if ok is False:
+                    self._transition(OPEN)
+                elif ok:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.probes:
+                        self._transition(CLOSED)
+                return
+            if ok is None or self.state != CLOSED:
+                return
+            self._outcomes.append(not ok)
+            failures = sum(self._outcomes)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_ratio:
+                self._transition(OPEN)
+
+    def _transition(self, state):
+        print(f"[CIRCUIT] {self.name}: {self.state} -> {state}")
+        self.state = state
+        self.stats[f"to_{state}"] += 1
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        self._probing = self._probe_successes = 0
+        if state == CLOSED:
+            self._outcomes.clear()
+
+    def metrics(self):
+        with self._lock:
+            recent = len(self._outcomes)
+            return {
+                "state": self.state,
+                "recent_failure_ratio": round(sum(self._outcomes) / recent, 3) if recent else None,
+                "open_for_s": round(max(0.0, self._opened_at + self.open_seconds - time.monotonic()), 1) if self.state == OPEN else None,
+                **self.stats,
+            }
@@ -0,0 +1,275 @@
+import asyncio
+import heapq
+import itertools
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager, contextmanager
+
+# Queued calls are served in this order; unknown classes go last
+PRIORITIES = {"interactive": 0, "batch": 1, "warmup": 2}
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class UpstreamBusy(TimeoutError):
+    """No upstream slot became free within the queue timeout."""
+
+
+def parse_duration(text):
+    """OpenAI's reset durations ("20ms", "1s", "6m0s") in seconds, None if unreadable."""
+    parts = DURATION_PART.findall(text or "")
+    return sum(float(value) * DURATION_UNITS[unit] for value, unit in parts) if parts else None
+
+
+def retry_after(headers):
+    """Seconds the server asks us to wait before the next request, from a 429's headers."""
+    if not headers:
+        return None
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        try:
+            return float(headers[name]) * scale
+        except (KeyError, TypeError, ValueError):
+            pass
+    return parse_duration(headers.get("x-ratelimit-reset-requests"))
+
+
+def header_int(headers, name):
+    try:
+        return int(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class _Waiter:
+    __slots__ = ("granted", "cancelled", "wake")
+
+    def __init__(self, wake):
+        self.granted = False
+        self.cancelled = False
+        self.wake = wake
+
+
+class Call:
+    """What the caller reports about one upstream call: response headers, time to first byte."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.headers = None
+        self.latency = None
+
+    def responded(self, headers=None):
+        """Marks the response headers as received (for a stream, before its body)."""
+        self.headers = headers
+        self.latency = time.perf_counter() - self.started
+
+
+class AdaptiveLimiter:
+    """Concurrency window for one upstream endpoint, adjusted with AIMD.
+
+    Every successful call widens the window by 1/window (about one slot per
+    window of calls), much less near the window of the last 429, unless the
+    x-ratelimit-* headers say the quota is almost used. A 429 or a timeout
+    shrinks it by `backoff`, a call slower than `latency_tolerance` times the
+    usual latency by `slow_backoff`, at most once per `cooldown` seconds. A 429 also pauses the endpoint until its
+    Retry-After. Calls over the window wait in a queue, best priority
+    class first, and give up with UpstreamBusy after `queue_timeout` seconds.
+    Works for threads (slot) and coroutines (async_slot) sharing one window.
+    """
+
+    def __init__(self, name, initial=8, min_limit=1, max_limit=64, backoff=0.7, slow_backoff=0.9,
+                 latency_tolerance=2.0, cooldown=1.0, queue_timeout=10.0, congestion_errors=()):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.slow_backoff = slow_backoff
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.queue_timeout = queue_timeout
+        self.congestion_errors = congestion_errors
+        self.in_flight = 0
+        self.baseline = None  # usual latency: follows decreases at once, increases slowly
+        self.ceiling = None  # window of the last 429
+        self.paused_until = 0.0
+        self.remaining = {}  # last x-ratelimit-remaining-* values seen
+        self.stats = Counter()
+        self._last_decrease = 0.0
+        self._queue = []  # (priority, sequence, waiter)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    # --- Admission ---------------------------------------------------------
+
+    def _has_room(self, now):
+        return self.in_flight < max(self.min_limit, int(self.limit)) and now >= self.paused_until
+
+    def _enter(self, priority, wake):
+        """Takes a slot at once (returns None) or queues a waiter for one."""
+        with self._lock:
+            if not self._queue and self._has_room(time.monotonic()):
+                self.in_flight += 1
+                return None
+            waiter = _Waiter(wake)
+            heapq.heappush(self._queue, (PRIORITIES.get(priority, len(PRIORITIES)), next(self._sequence), waiter))
+            self.stats[f"queued:{priority}"] += 1
+            return waiter
+
+    def _give_up(self, waiter):
+        """True if the waiter left the queue without a slot, False if it got one meanwhile."""
+        with self._lock:
+            if waiter.granted:
+                return False
+            waiter.cancelled = True
+            self.stats["queue_timeouts"] += 1
+            return True
+
+    def _grant(self):
+        """Hands the free slots to the queued waiters. Returns their wake-ups, to call without the lock."""
+        wakes = []
+        now = time.monotonic()
+        while self._queue and self._has_room(now):
+            _, _, waiter = heapq.heappop(self._queue)
+            if waiter.cancelled:
+                continue
+            waiter.granted = True
+            self.in_flight += 1
+            wakes.append(waiter.wake)
+        return wakes
+
+    def _dispatch(self):
+        with self._lock:
+            wakes = self._grant()
+        for wake in wakes:
+            wake()
+
+    def acquire(self, priority="interactive"):
+        event = threading.Event()
+        waiter = self._enter(priority, event.set)
+        if waiter and not event.wait(self.queue_timeout) and self._give_up(waiter):
+            raise UpstreamBusy(f"No {self.name} slot within {self.queue_timeout}s")
+
+    async def acquire_async(self, priority="interactive"):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enter(priority, wake)
+        if not waiter:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if self._give_up(waiter):
+                raise UpstreamBusy(f"No {self.name} slot within {self.queue_timeout}s")
+        except asyncio.CancelledError:
+            if not self._give_up(waiter):
+                self.release()
+            raise
+
+    # --- Feedback ----------------------------------------------------------
+
+    def _decrease(self, now, factor, reason):
+        self.stats[reason] += 1
+        if now - self._last_decrease >= self.cooldown:
+            self._last_decrease = now
+            self.limit = max(self.min_limit, self.limit * factor)
+            self.stats["decreases"] += 1
+
+    def _near_quota(self, headers):
+        """The headers say the requests (or tokens) left in the quota window would not cover a wider window."""
+        if not headers:
+            return False
+        requests = header_int(headers, "x-ratelimit-remaining-requests")
+        tokens, token_limit = header_int(headers, "x-ratelimit-remaining-tokens"), header_int(headers, "x-ratelimit-limit-tokens")
+        if requests is not None:
+            self.remaining["requests"] = requests
+        if tokens is not None:
+            self.remaining["tokens"] = tokens
+        return (requests is not None and requests <= self.in_flight + 1) or bool(tokens is not None and token_limit and tokens < token_limit * 0.05)
+
+    def release(self, latency=None, throttled=False, congested=False, headers=None):
+        """Frees a slot and adjusts the window from how the call went (latency None: no sample)."""
+        now = time.monotonic()
+        pause = None
+        with self._lock:
+            self.in_flight -= 1
+            if throttled:
+                self.ceiling = self.limit
+                self._decrease(now, self.backoff, "throttled")
+                pause = retry_after(headers) or self.cooldown
+                self.paused_until = max(self.paused_until, now + pause)
+            elif congested:
+                self._decrease(now, self.backoff, "timeouts")
+            elif latency is not None:
+                self.stats["ok"] += 1
+                if self.baseline is None or latency < self.baseline:
+                    self.baseline = latency
+                else:
+                    self.baseline += (latency - self.baseline) * 0.01
+                if latency > self.baseline * self.latency_tolerance:
+                    self._decrease(now, self.slow_backoff, "slow")
+                elif self._near_quota(headers):
+                    self.stats["near_quota"] += 1
+                else:
+                    # Probe slowly past the window that was last rate-limited
+                    step = 1 / self.limit if self.ceiling is None or self.limit + 1 < self.ceiling else 1 / self.limit ** 2
+                    self.limit = min(self.max_limit, self.limit + step)
+            wakes = self._grant()
+        for wake in wakes:
+            wake()
+        if pause:
+            # Nothing releases a slot while paused: wake the queue when the pause ends
+            timer = threading.Timer(pause, self._dispatch)
+            timer.daemon = True
+            timer.start()
+
+    def _release_after(self, call, error):
+        if error is None:
+            self.release(call.latency or time.perf_counter() - call.started, headers=call.headers)
+        elif getattr(error, "status_code", None) == 429:
+            self.release(throttled=True, headers=getattr(getattr(error, "response", None), "headers", None))
+        else:
+            self.release(congested=isinstance(error, self.congestion_errors))
+
+    @contextmanager
+    def slot(self, priority="interactive"):
+        """Holds a slot around one call. Raises UpstreamBusy when none frees up in time."""
+        self.acquire(priority)
+        call = Call()
+        try:
+            yield call
+        except BaseException as e:
+            self._release_after(call, e)
+            raise
+        self._release_after(call, None)
+
+    @asynccontextmanager
+    async def async_slot(self, priority="interactive"):
+        await self.acquire_async(priority)
+        call = Call()
+        try:
+            yield call
+        except BaseException as e:
+            self._release_after(call, e)
+            raise
+        self._release_after(call, None)
+
+    def metrics(self):
+        with self._lock:
+            queued = Counter(waiter_priority for waiter_priority, _, waiter in self._queue if not waiter.cancelled)
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "queued": {name: queued[rank] for name, rank in PRIORITIES.items() if queued[rank]},
+                "ceiling": round(self.ceiling, 2) if self.ceiling is not None else None,
+                "baseline_ms": round(self.baseline * 1000, 1) if self.baseline is not None else None,
+                "paused_for_s": round(max(0.0, self.paused_until - time.monotonic()), 2),
+                "remaining": dict(self.remaining),
+                **self.stats,
+            }
@@ -0,0 +1,102 @@
+import math
+import re
+from collections import Counter
+
+from linker import canonical
+
+SUMMARY_MODE_MARKER = "📄 وضع الملخص (Summary mode)"
+SUMMARY_MODE_NOTE = (
+    "المساعد يعمل حالياً بوضع الملخص، وهذه أقرب المعلومات لسؤالك:\n"
+    "The assistant is in summary mode; these are the most relevant facts:"
+)
+
+# Question words and fillers that say nothing about what is asked
+STOPWORDS = {
+    "ما", "ماذا", "هل", "كم", "كيف", "متى", "اين", "من", "هو", "هي", "في", "عن", "على",
+    "الى", "او", "ان", "انا", "بدي", "اريد", "لو", "يا", "مع", "شو", "قديش",
+    "what", "is", "are", "the", "a", "an", "of", "in", "for", "to", "how", "much",
+    "many", "do", "does", "i", "can", "me", "about", "and", "or", "which", "who",
+}
+
+# Field separators inside the chunks built by load_data()
+FIELD_SPLIT = re.compile(r"(?<=\.)\s+(?=[A-Z][a-z]+)|\s+\|\s+")
+QA_ANSWER = re.compile(r"Answer:\s*(.+)$", re.S)
+MAX_UNIT_CHARS = 600
+MIN_RELATIVE_SCORE = 0.6  # drop units scoring far below the best one
+
+
+def _terms(text):
+    return {t for t in canonical(text).split() if t not in STOPWORDS and len(t) > 1}
+
+
+def _units(chunk):
+    """Splits a chunk into answerable units: the Answer of a Q&A chunk, else its fields."""
+    qa = QA_ANSWER.search(chunk)
+    if qa:
+        return [qa.group(1).strip()]
+    return [u.strip() for u in FIELD_SPLIT.split(chunk) if len(u.strip()) > 3]
+
+
+def extractive_answer(question, chunks, entities=(), max_units=3):
+    """Builds a short answer from the retrieved chunks without calling the LLM.
+
+    Units are scored by the share of question terms they contain, plus a bonus
+    when their chunk is about one of the given entities (program names / ids).
+    Returns None when nothing in the chunks overlaps with the question.
+    """
+    terms = _terms(question)
+    if not terms:
+        return None
+    entity_terms = [e for e in entities if e]
+
+    scored = []
+    for rank, chunk in enumerate(chunks):
+        units = _units(chunk)
+        header = units[0] if units else ""
+        about_entity = any(e in chunk for e in entity_terms)
+        for position, unit in enumerate(units):
+            overlap = len(terms & _terms(unit)) / len(terms)
+            score = overlap + (0.5 if about_entity else 0) - rank * 0.02
+            if overlap > 0 or (about_entity and position > 0):
+                scored.append((score, rank, position, unit, header))
+
+    if not scored:
+        return None
+
+    scored.sort(key=lambda x: x[0], reverse=True)
+    cutoff = scored[0][0] * MIN_RELATIVE_SCORE
+    picked = sorted((s for s in scored[:max_units] if s[0] >= cutoff), key=lambda x: (x[1], x[2]))
+
+    lines = [SUMMARY_MODE_MARKER, SUMMARY_MODE_NOTE, ""]
+    shown = set()
+    for _, _, position, unit, header in picked:
+        # Field units ("Price per credit hour: ...") need their program line for context
+        if position > 0 and header not in shown:
+            lines.append(f"• {header[:MAX_UNIT_CHARS]}")
+            shown.add(header)
+        if unit not in shown:
+            lines.append(f"• {unit[:MAX_UNIT_CHARS]}")
+            shown.add(unit)
+    return "\n".join(lines)
+
+
+class LexicalIndex:
+    """Keyword retrieval over the chunks, for when the question cannot be embedded (OpenAI down).
+
+    Scores are the IDF-weighted share of the question's terms found in a
+    chunk, between 0 and 1 like cosine similarities.
+    """
+
+    def __init__(self, chunks):
+        self.chunk_terms = [_terms(chunk) for chunk in chunks]
+        document_frequency = Counter(term for terms in self.chunk_terms for term in terms)
+        self.idf = {term: math.log(1 + len(chunks) / df) for term, df in document_frequency.items()}
+
+    def scores(self, question):
+        terms = _terms(question)
+        # Terms in no chunk still count in the total, with the highest weight
+        weights = {term: self.idf.get(term, math.log(1 + len(self.chunk_terms))) for term in terms}
+        total = sum(weights.values())
+        if not total:
+            return [0.0] * len(self.chunk_terms)
+        return [sum(weights[term] for term in terms & chunk_terms) / total for chunk_terms in self.chunk_terms]
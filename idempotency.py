@@ -0,0 +1,284 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_expires ON results (expires);
+"""
+
+PRUNE_INTERVAL = 60  # seconds between deletions of expired SQLite results
+
+
+class IdempotencyError(Exception):
+    """A duplicate request that cannot get the original's result."""
+
+    status = 409
+
+    def payload(self):
+        return {"error": self.error}
+
+
+class KeyReusedError(IdempotencyError, ValueError):
+    """The idempotency key was already used for a different request."""
+
+    status = 422
+    error = "Idempotency-Key was already used for a different message"
+
+
+class StillRunningError(IdempotencyError, TimeoutError):
+    """The original request did not finish within the wait timeout."""
+
+    status = 409
+    error = "The original request is still running, try again later"
+
+
+class _Entry:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.wakes = []  # callbacks of waiting coroutines, called once done
+        self.result = None
+        self.error = None
+        self.expires_at = None  # set when done
+
+
+class SQLiteResults:
+    """Completed results shared by all workers of one machine through a SQLite file (WAL mode)."""
+
+    backend = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._last_prune = 0
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        # sqlite3 connections cannot be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def get(self, key):
+        """(fingerprint, result) stored for the key, or None."""
+        row = self._db().execute(
+            "SELECT fingerprint, payload FROM results WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def put(self, key, fingerprint, result, ttl):
+        now = time.time()
+        db = self._db()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO results (key, fingerprint, payload, expires) VALUES (?, ?, ?, ?)",
+                (key, fingerprint, json.dumps(result, ensure_ascii=False), now + ttl),
+            )
+            if now - self._last_prune > PRUNE_INTERVAL:
+                self._last_prune = now
+                db.execute("DELETE FROM results WHERE expires <= ?", (now,))
+
+
+class RedisResults:
+    """Completed results in Redis, shared by every node. Needs the redis package (pip install redis)."""
+
+    backend = "redis"
+    PREFIX = "chatbot:idempotency:"
+
+    def __init__(self, url):
+        import redis
+
+        self.redis = redis.Redis.from_url(url, socket_timeout=2)
+
+    def get(self, key):
+        data = self.redis.get(self.PREFIX + key)
+        if not data:
+            return None
+        stored = json.loads(data)
+        return stored["fingerprint"], stored["payload"]
+
+    def put(self, key, fingerprint, result, ttl):
+        data = json.dumps({"fingerprint": fingerprint, "payload": result}, ensure_ascii=False)
+        self.redis.set(self.PREFIX + key, data, ex=max(1, int(ttl)))
+
+
+class IdempotencyStore:
+    """Short-lived results of requests by client idempotency key.
+
+    The first request with a key runs. A duplicate arriving while it is still
+    running waits for it and gets the same result; one arriving later gets the
+    stored result until it expires after `ttl` seconds. A duplicate is never
+    run again: it fails with the original's error, with KeyReusedError when
+    its fingerprint differs, or with StillRunningError after `wait_timeout`.
+    run() serves threads and run_async() coroutines, with the same entries.
+
+    Running requests are only known to this process. Completed results (JSON)
+    also go to `shared` (SQLiteResults, RedisResults), so a retry landing on
+    another worker replays them instead of running again.
+    """
+
+    def __init__(self, ttl=300, max_size=10000, wait_timeout=60, shared=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.wait_timeout = wait_timeout
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = Counter()
+
+    def run(self, key, fn, fingerprint=None):
+        """Returns (result, outcome) where outcome is "new", "in_flight" or "replayed"."""
+        entry, outcome = self._begin(key, fingerprint)
+        if outcome != "new":
+            if not entry.done.wait(self.wait_timeout):
+                self._count("timeouts")
+                raise StillRunningError(f"Original request for idempotency key '{key}' is still running")
+            return self._replay(entry, outcome)
+
+        try:
+            stored = self._shared_get(key, fingerprint)
+            result = fn() if stored is None else stored[0]
+        except BaseException as e:
+            self._finish(key, entry, error=e)
+            raise
+        self._finish(key, entry, result=result)
+        if stored is not None:
+            return result, "replayed"
+        self._shared_put(key, fingerprint, result)
+        return result, "new"
+
+    async def run_async(self, key, make_coroutine, fingerprint=None):
+        """run() for coroutines: make_coroutine() starts the work, duplicates wait without blocking the loop."""
+        entry, outcome = self._begin(key, fingerprint)
+        if outcome != "new":
+            if not await self._wait_async(entry):
+                self._count("timeouts")
+                raise StillRunningError(f"Original request for idempotency key '{key}' is still running")
+            return self._replay(entry, outcome)
+
+        try:
+            # The shared store is SQLite or Redis I/O: in a thread, off the event loop
+            stored = await asyncio.to_thread(self._shared_get, key, fingerprint)
+            result = await make_coroutine() if stored is None else stored[0]
+        except BaseException as e:
+            self._finish(key, entry, error=e)
+            raise
+        self._finish(key, entry, result=result)
+        if stored is not None:
+            return result, "replayed"
+        await asyncio.to_thread(self._shared_put, key, fingerprint, result)
+        return result, "new"
+
+    def _begin(self, key, fingerprint):
+        """Returns (entry, outcome): "new" when the caller must run the request."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry.expires_at is not None and entry.expires_at <= now:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                entry = self._entries[key] = _Entry(fingerprint)
+                self.stats["new"] += 1
+                self._evict()
+                return entry, "new"
+            outcome = "replayed" if entry.done.is_set() else "in_flight"
+
+        if entry.fingerprint != fingerprint:
+            self._count("reused")
+            raise KeyReusedError(f"Idempotency key '{key}' was used for a different request")
+        return entry, outcome
+
+    def _shared_get(self, key, fingerprint):
+        """(result,) completed for the key by another process, or None."""
+        if self.shared is None:
+            return None
+        try:
+            stored = self.shared.get(key)
+        except Exception as e:
+            # Like a miss: the request runs, at worst twice
+            print(f"[IDEMPOTENCY] Shared store error, not checking: {e}")
+            self._count("store_errors")
+            return None
+        if stored is None:
+            return None
+        if stored[0] != json.dumps(fingerprint):
+            self._count("reused")
+            raise KeyReusedError(f"Idempotency key '{key}' was used for a different request")
+        self._count("shared_replayed")
+        return (stored[1],)
+
+    def _shared_put(self, key, fingerprint, result):
+        if self.shared is None:
+            return
+        try:
+            self.shared.put(key, json.dumps(fingerprint), result, self.ttl)
+        except Exception as e:
+            print(f"[IDEMPOTENCY] Shared store error, result not shared: {e}")
+            self._count("store_errors")
+
+    def _finish(self, key, entry, result=None, error=None):
+        with self._lock:
+            if error is not None:
+                # Duplicates waiting get the error; a later retry with the same key runs again
+                entry.error = error if isinstance(error, Exception) else RuntimeError("Original request was cancelled")
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            entry.result = result
+            entry.expires_at = time.monotonic() + self.ttl
+            entry.done.set()
+            wakes, entry.wakes = entry.wakes, []
+        for wake in wakes:
+            wake()
+
+    async def _wait_async(self, entry):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        with self._lock:
+            if entry.done.is_set():
+                return True
+            entry.wakes.append(wake)
+        try:
+            await asyncio.wait_for(future, self.wait_timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _replay(self, entry, outcome):
+        self._count(outcome)
+        if entry.error is not None:
+            raise entry.error
+        return entry.result, outcome
+
+    def _evict(self):
+        # Oldest first; entries still running are kept so their duplicates can attach
+        for key in list(self._entries):
+            if len(self._entries) <= self.max_size:
+                break
+            if self._entries[key].done.is_set():
+                del self._entries[key]
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def metrics(self):
+        with self._lock:
+            return {"size": len(self._entries), "shared": self.shared.backend if self.shared else None, **self.stats}
@@ -0,0 +1,163 @@
+import math
+from collections import Counter, defaultdict
+
+from textnorm import tokenize
+
+# Intents that can be answered from a template without calling OpenAI.
+# "other" means: send the message down the normal retrieval + LLM pipeline.
+CANNED_INTENTS = [
+    "greeting", "thanks", "developer", "contact", "contact_admission",
+    "contact_finance", "facilities", "recreational_facilities", "health_facilities",
+]
+
+# Seed examples used to train the local model (normalized at import)
+INTENT_EXAMPLES = {
+    "greeting": [
+        "مرحبا", "مرحبا بك", "اهلا", "اهلا وسهلا", "السلام عليكم", "السلام عليكم ورحمة الله",
+        "هلا", "صباح الخير", "مساء الخير", "هاي", "hi", "hello", "hey", "hello there",
+        "good morning", "good evening", "مرحبا كيف الحال", "كيفك", "كيف حالك",
+    ],
+    "thanks": [
+        "شكرا", "شكرا لك", "شكرا جزيلا", "مشكور", "يعطيك العافيه", "الله يعطيك العافيه",
+        "thanks", "thank you", "thank you very much", "thanks a lot", "شكرا على المساعده",
+        "ممتاز شكرا", "تمام شكرا",
+    ],
+    "developer": [
+        "من صنعك", "من طورك", "من برمجك", "مين عملك", "من انت", "من قام بتطويرك",
+        "who made you", "who developed you", "who created you", "who built you", "who are you",
+    ],
+    "contact": [
+        "كيف يمكنني التواصل", "كيف يمكنني التواصل مع الجامعه", "كيف اتواصل مع الجامعه",
+        "ما رقم الجامعه", "رقم الجامعه", "رقم الهاتف", "ما هو رقم الهاتف", "رقم الواتس اب",
+        "ما عنوان الجامعه", "وين الجامعه", "اين تقع الجامعه", "ايميل الجامعه",
+        "البريد الالكتروني للجامعه", "ساعات الدوام", "متى الدوام",
+        "contact", "contact info", "how can i contact the university", "phone number",
+        "university address", "where is the university", "email address", "working hours",
+    ],
+    "contact_admission": [
+        "كيف يمكنني التواصل مع القبول و التسجيل", "كيف اتواصل مع القبول والتسجيل",
+        "رقم القبول والتسجيل", "رقم دائره القبول والتسجيل", "التواصل مع القبول",
+        "admission contact", "admission and registration phone number",
+        "how can i contact admission and registration",
+    ],
+    "contact_finance": [
+        "كيف يمكنني التواصل مع المالية", "كيف يمكنني التواصل مع الدائره الماليه",
+        "رقم الدائره الماليه", "رقم الماليه", "التواصل مع الماليه",
+        "finance department contact", "finance department phone number",
+        "how can i contact the finance department",
+    ],
+    "facilities": [
+        "ما مرافق الجامعه", "مرافق الجامعه", "ما هي مرافق الجامعه", "خدمات الجامعه",
+        "university facilities", "what facilities does the university have", "campus facilities",
+    ],
+    "recreational_facilities": [
+        "ما المرافق الترفيهيه", "المرافق الترفيهيه", "ما هي المرافق الترفيهيه",
+        "recreational facilities", "what are the recreational facilities", "entertainment facilities",
+    ],
+    "health_facilities": [
+        "ما المرافق الصحيه", "المرافق الصحيه", "ما هي المرافق الصحيه", "التامين الصحي",
+        "health facilities", "medical services", "what are the health facilities",
+    ],
+    # Everything the retrieval pipeline should handle. Keeps the model from
+    # forcing real questions into one of the canned intents.
+    "other": [
+        "ما هي التخصصات المتاحه", "مرحبا ما هي التخصصات المتاحه", "ما تخصصات البكالوريوس",
+        "ما تخصصات الماجستير", "ما تخصصات الدبلوم المتوسط", "البرامج الدوليه",
+        "كم سعر الساعه في علم الحاسوب", "كم رسوم التسجيل", "كم رسم امتحان المستوى",
+        "ما شروط القبول في الصيدله", "معدل القبول في التمريض", "من هو رئيس الجامعه",
+        "من هم اعضاء مجلس الامناء", "من هم اعضاء مجلس العمداء", "تخصصات كليه تكنولوجيا المعلومات",
+        "كم تكلفه التخصص كامل", "هل يوجد تخصص ذكاء اصطناعي", "اجراءات قبول الماجستير",
+        "ما الوثائق المطلوبه للتسجيل", "كم عدد ساعات التخصص", "كم سعر ساعه التمريض",
+        "رقم مكتب عميد كليه الهندسه", "what majors are available", "how much is the credit hour",
+        "what are the admission requirements", "who is the university president",
+        "master programs", "bachelor programs in engineering", "how much does nursing cost",
+        "tuition fees for pharmacy", "is there a scholarship", "when does registration start",
+    ],
+}
+
+# Polite filler words that carry no intent
+FILLER_TOKENS = {"يا", "لو", "سمحت", "فضلك", "please", "pls", "plz", "bot", "بوت"}
+
+
+def _tokens(text):
+    return [t for t in tokenize(text) if t not in FILLER_TOKENS]
+
+
+# Exact (normalized) seed phrases answered with full confidence before the model runs
+KEYWORD_RULES = {
+    " ".join(_tokens(phrase)): intent
+    for intent in CANNED_INTENTS
+    for phrase in INTENT_EXAMPLES[intent]
+}
+
+DEFAULT_CONFIDENCE_THRESHOLD = 0.8
+MAX_INTENT_TOKENS = 12  # canned intents are short; longer messages go to the LLM
+
+
+def _features(tokens):
+    """Unigrams plus bigrams of normalized tokens."""
+    feats = list(tokens)
+    feats.extend(f"{a}_{b}" for a, b in zip(tokens, tokens[1:]))
+    return feats
+
+
+def train(examples):
+    """Trains a multinomial Naive Bayes model (a linear model in log space)."""
+    class_counts = Counter()
+    feature_counts = defaultdict(Counter)
+    vocabulary = set()
+    for intent, phrases in examples.items():
+        for phrase in phrases:
+            feats = _features(_tokens(phrase))
+            class_counts[intent] += 1
+            feature_counts[intent].update(feats)
+            vocabulary.update(feats)
+
+    total = sum(class_counts.values())
+    model = {"priors": {}, "weights": {}, "unknown": {}, "vocabulary": vocabulary}
+    for intent in class_counts:
+        denom = sum(feature_counts[intent].values()) + len(vocabulary)
+        model["priors"][intent] = math.log(class_counts[intent] / total)
+        model["weights"][intent] = {
+            feat: math.log((count + 1) / denom) for feat, count in feature_counts[intent].items()
+        }
+        model["unknown"][intent] = math.log(1 / denom)
+    return model
+
+
+MODEL = train(INTENT_EXAMPLES)
+
+
+def _predict(tokens):
+    feats = [f for f in _features(tokens) if f in MODEL["vocabulary"]]
+    if not feats:
+        return "other", 0.0
+
+    scores = {}
+    for intent, prior in MODEL["priors"].items():
+        weights = MODEL["weights"][intent]
+        unknown = MODEL["unknown"][intent]
+        scores[intent] = prior + sum(weights.get(f, unknown) for f in feats)
+
+    # Softmax over class scores gives the confidence
+    best = max(scores, key=scores.get)
+    norm = sum(math.exp(s - scores[best]) for s in scores.values())
+    return best, 1 / norm
+
+
+def classify(message, threshold=DEFAULT_CONFIDENCE_THRESHOLD):
+    """Returns (intent, confidence). intent is None unless a canned intent is confident enough."""
+    tokens = _tokens(message)
+    if not tokens or len(tokens) > MAX_INTENT_TOKENS:
+        return None, 0.0
+
+    # 1. Keyword rules (whole message is a known canned phrase)
+    intent = KEYWORD_RULES.get(" ".join(tokens))
+    if intent:
+        return intent, 1.0
+
+    # 2. Linear model
+    intent, confidence = _predict(tokens)
+    if intent in CANNED_INTENTS and confidence >= threshold:
+        return intent, confidence
+    return None, confidence
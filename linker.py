@@ -0,0 +1,191 @@
+import re
+from collections import Counter, namedtuple
+
+from textnorm import normalize_text
+
+Match = namedtuple("Match", ["kind", "id", "score", "alias"])
+
+# Curated aliases on top of the names and ids in the data file (normalized when indexed)
+PROGRAM_ALIASES = {
+    "ai": ["ai", "artificial intelligence", "ذكاء اصطناعي", "ذكاء صناعي"],
+    "computer-science": ["cs", "computer science", "كمبيوتر", "علوم حاسوب", "علم حاسوب"],
+    "software-eng": ["software engineering", "برمجيات"],
+    "cybersecurity": ["cyber security", "سايبر", "امن سيبراني", "امن المعلومات"],
+    "business-admin": ["business administration", "ادارة اعمال"],
+    "mba": ["mba", "ماجستير ادارة اعمال", "ماجستير ادارة الاعمال"],
+    "accounting": ["accounting", "محاسبه"],
+    "digital-marketing": ["digital marketing", "تسويق الكتروني", "تسويق"],
+    "fintech": ["fintech", "financial technology", "تكنولوجيا ماليه"],
+    "hrm": ["hrm", "human resources", "موارد بشريه"],
+    "law": ["law", "حقوق", "محاماه"],
+    "pharmacy": ["pharmacy", "pharm d", "صيدله"],
+    "nursing": ["nursing", "تمريض"],
+    "dip-nursing": ["associate nursing", "دبلوم تمريض", "تمريض مشارك"],
+    "physiotherapy": ["physiotherapy", "physical therapy", "علاج طبيعي"],
+    "medical-lab": ["medical lab", "تحاليل طبيه", "مختبرات"],
+    "architecture": ["architecture", "عماره"],
+    "graphic-design": ["graphic design", "جرافيك", "جرافيكس"],
+    "interior-design": ["interior design", "ديكور"],
+    "journalism": ["journalism", "صحافه", "اعلام رقمي"],
+    "broadcasting": ["radio and tv", "اذاعه وتلفزيون"],
+    "eng-lit": ["english literature", "english language and literature", "ادب انجليزي", "لغه انجليزيه"],
+    "arabic-lit": ["arabic literature", "arabic language and literature", "ادب عربي", "لغه عربيه"],
+    "translation": ["translation", "ترجمه"],
+    "paramedic": ["paramedic", "اسعاف"],
+    "nutrition": ["nutrition", "تغذيه"],
+    "genetics": ["genetics", "biotechnology", "جينات"],
+}
+
+FACULTY_ALIASES = {
+    "it": ["information technology", "تكنولوجيا المعلومات", "كليه it", "it faculty", "faculty of it", "college of it"],
+    "engineering": ["engineering", "هندسه", "كليه الهندسه"],
+    "business": ["business", "كليه الاعمال"],
+    "law": ["faculty of law", "كليه الحقوق"],
+    "media": ["media", "اعلام", "كليه الاعلام"],
+    "pharmacy": ["faculty of pharmacy", "كليه الصيدله"],
+    "nursing": ["faculty of nursing", "كليه التمريض"],
+    "allied-medical": ["allied medical", "medical sciences", "علوم طبيه مسانده"],
+    "arts-education": ["arts", "اداب", "علوم تربويه"],
+}
+
+# Names and ids that are also everyday words ("how much is it?", "taught in
+# english"): never indexed, so ordinary sentences do not link them
+COMMON_WORDS = {"it", "se", "english", "arabic", "انجليزي", "عربي"}
+
+# Written in capitals, these still name the entity ("what about IT?", "تخصصات IT"),
+# unless every English word of the message is ("HOW MUCH IS IT"); Arabic has no case
+CASE_SENSITIVE_ALIASES = {"IT": "information technology", "SE": "software engineering"}
+CASE_SENSITIVE = re.compile(r"\b(?:" + "|".join(CASE_SENSITIVE_ALIASES) + r")\b")
+LATIN_WORD = re.compile(r"[A-Za-z]+")
+
+# The language a course is taught in ("in english", "باللغة العربية") is not the language program
+INSTRUCTION_LANGUAGE = re.compile(
+    r"\b(?:in|into) (?:the )?(?:english|arabic)\b(?! (?:language )?(?:and )?literature)(?: language)?"
+    r"|\bب(?:ال)?(?:لغه ال)?(?:انجليزي|انكليزي|عربي)ه?\b"
+)
+
+# Attached prefixes stripped from every token before matching ("والتمريض" -> "تمريض")
+PREFIXES = ("وال", "بال", "فال", "كال", "لل", "ال")
+MIN_TRIGRAM_ALIAS = 4  # shorter aliases ("ai", "it", "mba") must match a whole token
+MAX_SPAN_TOKENS = 4
+DEFAULT_THRESHOLD = 0.72
+
+
+def _strip(token):
+    for prefix in PREFIXES:
+        if token.startswith(prefix) and len(token) - len(prefix) >= 3:
+            return token[len(prefix):]
+    return token
+
+
+def canonical(text):
+    """Normalized text with attached prefixes removed from each token."""
+    return " ".join(_strip(t) for t in normalize_text(text).split())
+
+
+def trigrams(text):
+    padded = f" {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class EntityLinker:
+    """Maps free-text program / faculty mentions to ids with a character-trigram index."""
+
+    def __init__(self, index, threshold=DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self.aliases = []  # (kind, id, alias, trigram set)
+        self.exact = {}  # alias -> [(kind, id)]
+        self.postings = {}  # trigram -> [alias position]
+
+        for pid, prog in index.programs.items():
+            self._add("program", pid, prog.name_ar)
+            self._add("program", pid, pid.replace("-", " "))
+            for alias in PROGRAM_ALIASES.get(pid, []):
+                self._add("program", pid, alias)
+        for faculty_id, names in index.faculties.items():
+            for name in (names.get("ar"), names.get("en"), faculty_id.replace("-", " ")):
+                if name:
+                    self._add("faculty", faculty_id, name)
+            for alias in FACULTY_ALIASES.get(faculty_id, []):
+                self._add("faculty", faculty_id, alias)
+
+    def _add(self, kind, entity_id, alias):
+        alias = canonical(alias)
+        if not alias or alias in COMMON_WORDS:
+            return
+        self.exact.setdefault(alias, [])
+        if (kind, entity_id) in self.exact[alias]:
+            return
+        self.exact[alias].append((kind, entity_id))
+        if len(alias) < MIN_TRIGRAM_ALIAS:
+            return
+        grams = trigrams(alias)
+        position = len(self.aliases)
+        self.aliases.append((kind, entity_id, alias, grams))
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(position)
+
+    def link(self, text):
+        """Returns the best Match per entity mentioned in text, highest score first.
+
+        Longer spans win: once a span matched, shorter spans inside it are not
+        matched again ("دبلوم التمريض" does not also yield "التمريض").
+        """
+        latin_words = LATIN_WORD.findall(text)
+        if len(latin_words) == 1 or not all(word.isupper() for word in latin_words):
+            text = CASE_SENSITIVE.sub(lambda m: CASE_SENSITIVE_ALIASES[m.group()], text)
+        tokens = canonical(INSTRUCTION_LANGUAGE.sub(" ", normalize_text(text))).split()
+        best = {}
+        covered = set()
+
+        def consider(kind, entity_id, score, alias):
+            key = (kind, entity_id)
+            if key not in best or score > best[key].score:
+                best[key] = Match(kind, entity_id, round(score, 3), alias)
+
+        spans = [
+            (start, start + size)
+            for size in range(min(MAX_SPAN_TOKENS, len(tokens)), 0, -1)
+            for start in range(len(tokens) - size + 1)
+        ]
+
+        # 1. Exact alias matches
+        for start, end in spans:
+            positions = set(range(start, end))
+            if positions & covered:
+                continue
+            span = " ".join(tokens[start:end])
+            for kind, entity_id in self.exact.get(span, []):
+                consider(kind, entity_id, 1.0, span)
+                covered |= positions
+
+        # 2. Fuzzy trigram matches (typos, spelling variants) on what is left
+        for start, end in spans:
+            positions = set(range(start, end))
+            span = " ".join(tokens[start:end])
+            if positions & covered or len(span) < MIN_TRIGRAM_ALIAS:
+                continue
+
+            grams = trigrams(span)
+            overlap = Counter()
+            for gram in grams:
+                overlap.update(self.postings.get(gram, ()))
+            for position, shared in overlap.items():
+                kind, entity_id, alias, alias_grams = self.aliases[position]
+                score = 2 * shared / (len(grams) + len(alias_grams))  # Dice coefficient
+                if score >= self.threshold:
+                    consider(kind, entity_id, score, alias)
+                    covered |= positions
+
+        return sorted(best.values(), key=lambda m: m.score, reverse=True)
+
+    def program_ids(self, text):
+        """Program ids mentioned in text. Keeps only the top-scoring tier so siblings drop out."""
+        matches = [m for m in self.link(text) if m.kind == "program"]
+        if not matches:
+            return []
+        top = matches[0].score
+        return [m.id for m in matches if m.score >= top - 0.1]
+
+    def faculty_ids(self, text):
+        return [m.id for m in self.link(text) if m.kind == "faculty"]
@@ -0,0 +1,127 @@
+"""Finds the most asked questions in the conversation log.
+
+Questions are grouped by their normalized form, then groups whose embeddings
+are close are merged into one cluster. The top N clusters are written to
+warm_queries.json, which app.py runs through its caches after every
+knowledge-base load.
+
+    python mine_queries.py [--log logs/conversations.jsonl] [--top 50] [--no-embeddings]
+"""
+import argparse
+import json
+import os
+from collections import Counter
+
+import openai
+from dotenv import load_dotenv
+
+import intents
+from textnorm import normalize_text
+
+load_dotenv()
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_FILE = os.path.join(BASE_DIR, "logs", "conversations.jsonl")
+OUTPUT_FILE = os.path.join(BASE_DIR, "warm_queries.json")
+SIMILARITY_THRESHOLD = 0.92  # two question groups closer than this are the same question
+EMBEDDING_BATCH = 100
+
+
+def read_questions(path, all_turns=False):
+    """Questions from the log. Follow-ups depend on history, so only first turns by default."""
+    questions = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("message") and (all_turns or record.get("first_turn")):
+                questions.append(record["message"])
+    return questions
+
+
+def group_by_normal_form(questions):
+    """normalized text -> Counter of the raw spellings. Locally answered intents are skipped."""
+    groups = {}
+    for question in questions:
+        key = normalize_text(question)
+        if not key:
+            continue
+        if intents.classify(question)[0]:
+            continue  # greetings, thanks, contact: already answered without the LLM
+        groups.setdefault(key, Counter())[question.strip()] += 1
+    return groups
+
+
+def embed(texts):
+    client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    vectors = []
+    for start in range(0, len(texts), EMBEDDING_BATCH):
+        response = client.embeddings.create(input=texts[start:start + EMBEDDING_BATCH], model="text-embedding-3-small")
+        vectors.extend(data.embedding for data in response.data)
+    return vectors
+
+
+def unit(vector):
+    norm = sum(x * x for x in vector) ** 0.5
+    return [x / norm for x in vector] if norm else vector
+
+
+def cluster(groups, use_embeddings=True, threshold=SIMILARITY_THRESHOLD):
+    """Greedy clustering, most frequent group first: a group joins the first cluster it is close to."""
+    keys = sorted(groups, key=lambda k: sum(groups[k].values()), reverse=True)
+    vectors = [unit(v) for v in embed(keys)] if use_embeddings and keys else [None] * len(keys)
+
+    clusters = []  # [vector of the first group, Counter of raw spellings]
+    for key, vector in zip(keys, vectors):
+        for centre, spellings in clusters:
+            if vector is not None and sum(a * b for a, b in zip(centre, vector)) >= threshold:
+                spellings.update(groups[key])
+                break
+        else:
+            clusters.append([vector, Counter(groups[key])])
+    return [spellings for _, spellings in clusters]
+
+
+def top_questions(clusters, top):
+    ranked = sorted(clusters, key=lambda c: sum(c.values()), reverse=True)[:top]
+    return [
+        {
+            "question": spellings.most_common(1)[0][0],
+            "count": sum(spellings.values()),
+            "variants": [q for q, _ in spellings.most_common(5)],
+        }
+        for spellings in ranked
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--log", default=LOG_FILE)
+    parser.add_argument("--out", default=OUTPUT_FILE)
+    parser.add_argument("--top", type=int, default=50)
+    parser.add_argument("--threshold", type=float, default=SIMILARITY_THRESHOLD)
+    parser.add_argument("--all-turns", action="store_true", help="include follow-up questions")
+    parser.add_argument("--no-embeddings", action="store_true", help="group by normalized form only")
+    args = parser.parse_args()
+
+    questions = read_questions(args.log, args.all_turns)
+    groups = group_by_normal_form(questions)
+    print(f"{len(questions)} questions, {len(groups)} distinct normalized forms")
+
+    clusters = cluster(groups, not args.no_embeddings, args.threshold)
+    result = top_questions(clusters, args.top)
+
+    print("-" * 50)
+    for i, item in enumerate(result, 1):
+        print(f"{i:3}. {item['count']:5}  {item['question']}")
+    print("-" * 50)
+
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Wrote {len(result)} questions to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import importlib.util
+import random
+import threading
+import time
+from collections import Counter
+
+import openai
+
+from stage_timings import StageTimings
+
+# The SDK's own httpx (openai.DEFAULT_CONNECTION_LIMITS is an httpx.Limits)
+Limits = type(openai.DEFAULT_CONNECTION_LIMITS)
+
+# HTTP/2 needs the h2 package (pip install "httpx[http2]"); HTTP/1.1 keep-alive otherwise
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+
+def backoff(attempt, base=0.25, cap=4.0):
+    """Seconds before retry number `attempt` (0, 1, ...): full jitter, so retries of many threads spread out."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class PoolStats:
+    """Connection reuse of the OpenAI clients, from the HTTP transport's trace events.
+
+    A request that opens a connection counts as "connected" (and a TLS
+    handshake if it has one), one sent over an open connection as "reused".
+    Waiting for a free connection of the pool, and connecting, are timed.
+    """
+
+    def __init__(self):
+        self.stats = Counter()
+        self.timings = StageTimings()
+        self._lock = threading.Lock()
+
+    def tracer(self):
+        """Trace callback for one request (the httpcore "trace" request extension)."""
+        started = time.perf_counter()
+        request = {"connecting": None, "waited": False}
+
+        def event(name):
+            now = time.perf_counter()
+            if not request["waited"]:
+                request["waited"] = True
+                self.timings.record("pool_wait", now - started)
+            if name == "connection.connect_tcp.started":
+                request["connecting"] = now
+            elif name == "connection.start_tls.complete":
+                self._count("tls_handshakes")
+            elif name.endswith(".send_request_headers.started"):
+                if request["connecting"] is None:
+                    self._count("reused")
+                else:
+                    self._count("connected")
+                    self.timings.record("connect", now - request["connecting"])
+                self._count(name.split(".")[0])  # http11 / http2
+            elif name.endswith(".failed"):
+                self._count("failed")
+        return event
+
+    def hook(self, request):
+        event = self.tracer()
+        request.extensions["trace"] = lambda name, info: event(name)
+
+    async def async_hook(self, request):
+        event = self.tracer()
+
+        async def trace(name, info):
+            event(name)
+        request.extensions["trace"] = trace
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        requests = stats.get("reused", 0) + stats.get("connected", 0)
+        return {
+            **stats,
+            "reuse_ratio": round(stats.get("reused", 0) / requests, 3) if requests else None,
+            **self.timings.metrics(),
+        }
+
+
+POOL_STATS = PoolStats()
+
+
+def make_client(pool_size=16, keepalive=30.0, connect_timeout=3.0, pool_timeout=5.0):
+    """The OpenAI client of a worker: one keep-alive pool of `pool_size` connections.
+
+    The SDK's own retries are off; the callers retry what is safe to retry
+    (see app.upstream()). Request timeouts are per endpoint, these bound
+    connecting and waiting for a free connection.
+    """
+    return openai.OpenAI(
+        max_retries=0,
+        timeout=openai.Timeout(60.0, connect=connect_timeout, pool=pool_timeout),
+        http_client=openai.DefaultHttpxClient(
+            limits=Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=keepalive),
+            http2=HTTP2,
+            event_hooks={"request": [POOL_STATS.hook]},
+        ),
+    )
+
+
+def make_async_client(pool_size=100, keepalive=30.0, connect_timeout=3.0, pool_timeout=5.0):
+    """make_client() for asgi_app.py."""
+    return openai.AsyncOpenAI(
+        max_retries=0,
+        timeout=openai.Timeout(60.0, connect=connect_timeout, pool=pool_timeout),
+        http_client=openai.DefaultAsyncHttpxClient(
+            limits=Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=keepalive),
+            http2=HTTP2,
+            event_hooks={"request": [POOL_STATS.async_hook]},
+        ),
+    )
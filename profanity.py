@@ -0,0 +1,105 @@
+import re
+
+from textnorm import normalize_text
+
+# Blocked words (normalized at import, like the intent examples)
+OFFENSIVE_WORDS = [
+    # Arabic offensive words (common insults)
+    "كس", "طيز", "زب", "شرموط", "عرص", "منيوك", "قحبة", "كلب", "حمار", "غبي",
+    "احمق", "تافه", "حقير", "وسخ", "زبال", "ابن الكلب", "يلعن", "اللعنة",
+    "خرا", "زق", "انيك", "نيك", "متناك", "عاهرة", "فاجرة", "ملعون",
+    # English offensive words
+    "fuck", "shit", "bitch", "ass", "damn", "bastard", "idiot", "stupid",
+    "dumb", "moron", "retard", "crap", "dick", "pussy", "whore", "slut",
+    # Compounds of the ambiguous words, which only match whole tokens
+    "asshole", "dumbass", "jackass", "damnit", "dammit", "goddamn",
+]
+
+# Roots that no clean word contains: they block any token they appear in, so
+# compounds ("bullshit", "motherfucker", "fuckin") need no entry of their own.
+# كس only with the pronoun that makes it an insult (كسمك, كسختك), كسر is clean.
+STRONG_WORDS = ["fuck", "shit", "bitch", "كسم", "كسخت"]
+
+# Innocent words that a blocked word plus a prefix / suffix would otherwise
+# match (e.g. ل + زق, زب + ون). Compared against the whole normalized token.
+ALLOWLIST = ["بكس", "لزق", "بزق", "زبون", "زبونه", "زبوني"]
+
+# Any other blocked word matches a whole token, optionally with the affixes of its language:
+# Arabic conjunctions, article and prepositions before it, gender / plural / pronoun
+# endings after it; English inflections after it. So "كلب" blocks "والكلب" and
+# "كلبه" but not "كلبش", and "ass" blocks "asses" but not "class" or "assignment".
+ARABIC_PREFIXES = ["", "و", "ف"], ["", "ال", "بال", "لل", "ب", "ل"]
+ARABIC_SUFFIXES = ["ه", "ها", "هم", "ك", "كم", "ي", "ين", "ون", "ات"]
+ENGLISH_SUFFIXES = ["s", "es", "ed", "er", "ers", "ing", "y", "ty"]
+ARABIC_LETTERS = re.compile(r"[\u0600-\u06FF]")
+
+# The pattern runs on the raw message, so it matches what normalize_text() would
+# fold: every letter also matches its spelling variants, and diacritics or
+# tatweel may appear between letters
+LETTER_VARIANTS = {"ا": "اأإآٱ", "ه": "هة", "ي": "يىئ", "و": "وؤ"}
+DIACRITICS = r"[\u064B-\u0652\u0670\u0640]*"
+TOKEN_CHARS = r"[\w\u064B-\u0652\u0670\u0640]*"
+
+
+def arabic_regex(text):
+    """Regex for a normalized Arabic string that matches its unnormalized spellings."""
+    parts = []
+    for char in text:
+        if char == " ":
+            parts.append(r"\W+")
+        elif char in LETTER_VARIANTS:
+            parts.append(f"[{LETTER_VARIANTS[char]}]")
+        else:
+            parts.append(re.escape(char))
+    return DIACRITICS.join(parts)
+
+
+def alternation(regexes):
+    # Longest first, so a longer alternative wins over its prefix
+    return "(?:" + "|".join(sorted(set(regexes), key=len, reverse=True)) + ")"
+
+
+def build_pattern(words, strong_words=()):
+    """One compiled alternation of all the words with their per-language token
+    boundaries, and of the strong words anywhere in a token."""
+    arabic, english = [], []
+    for word in words:
+        word = normalize_text(word)
+        if not word:
+            continue
+        if ARABIC_LETTERS.search(word):
+            arabic.append(arabic_regex(word))
+        else:
+            english.append(re.escape(word))
+    alternatives = []
+    if arabic:
+        conjunctions, articles = ARABIC_PREFIXES
+        alternatives.append(
+            alternation(arabic_regex(p) for p in conjunctions) + "?" + DIACRITICS
+            + alternation(arabic_regex(p) for p in articles) + "?" + DIACRITICS
+            + "(?P<arabic>" + alternation(arabic) + DIACRITICS
+            + alternation(arabic_regex(s) for s in ARABIC_SUFFIXES) + "?)"
+        )
+    if english:
+        alternatives.append(alternation(english) + alternation(ENGLISH_SUFFIXES) + "?")
+    strong = [arabic_regex(word) for word in map(normalize_text, strong_words) if word]
+    if strong:
+        alternatives.append(TOKEN_CHARS + alternation(strong) + TOKEN_CHARS)
+    return re.compile(rf"(?<!\w)(?:{'|'.join(alternatives)}){DIACRITICS}(?!\w)")
+
+
+class WordFilter:
+    """Local moderation: finds blocked words in a message with one precompiled regex."""
+
+    def __init__(self, words=OFFENSIVE_WORDS, allowlist=ALLOWLIST, strong_words=STRONG_WORDS):
+        self.pattern = build_pattern(words, strong_words)
+        self.allowlist = {normalize_text(word) for word in allowlist}
+
+    def find(self, text):
+        """Returns the first blocked token of the message (normalized), or None if it is clean."""
+        for match in self.pattern.finditer((text or "").lower()):
+            # Allowlisted with or without the Arabic prefixes (لزبون is ل + زبون)
+            token = normalize_text(match.group())
+            if token not in self.allowlist and normalize_text(match.group("arabic") or "") not in self.allowlist:
+                return token
+        return None
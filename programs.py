@@ -0,0 +1,377 @@
+import re
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+
+from linker import EntityLinker, canonical
+from textnorm import normalize_text
+
+PROGRAM_TYPES = {
+    "bachelor_programs": "bachelor",
+    "master_programs": "master",
+    "diploma_programs": "diploma",
+    "higher_diploma_programs": "higher_diploma",
+}
+
+TYPE_LABELS = {
+    "bachelor": ("بكالوريوس", "Bachelor"),
+    "master": ("ماجستير", "Master"),
+    "diploma": ("دبلوم متوسط", "Diploma"),
+    "higher_diploma": ("دبلوم عالي", "Higher Diploma"),
+}
+
+# Minimum Jordanian high school average from the general bachelor admission rules
+# in the ebooklet ("الحقوق 65، التمريض والعلوم الطبية المساندة 70، الهندسة والصيدلة 80").
+# The scraped admission_gpa field is 60 for every program, so these are applied on top.
+MIN_GPA_BY_FACULTY = {"law": 65, "nursing": 70, "allied-medical": 70}
+MIN_GPA_BY_PROGRAM = {"pharmacy": 80, "genetics": 60}
+ENGINEERING_GPA = 80
+
+# Same subject offered as different degree types where the names do not share words
+FAMILY_PAIRS = [("dip-medical-lab", "medical-lab"), ("master-pharmacy", "pharmacy")]
+
+
+@dataclass
+class Program:
+    id: str
+    name_ar: str
+    type: str
+    faculty_id: str = None
+    faculty_ar: str = None
+    faculty_en: str = None
+    price_jod: float = None
+    price_usd: float = None
+    min_gpa: float = None
+    credit_hours: int = None
+    fees: list = field(default_factory=list)
+
+    @property
+    def type_ar(self):
+        return TYPE_LABELS.get(self.type, (self.type, self.type))[0]
+
+    @property
+    def label(self):
+        return f"{self.type_ar} {self.name_ar} ({self.id})"
+
+
+def _number(value):
+    """Parses prices like "80", 80 or "$115" into a float."""
+    if value is None:
+        return None
+    match = re.search(r"\d+(?:\.\d+)?", str(value))
+    return float(match.group()) if match else None
+
+
+def _credit_hours(prog):
+    """Credit hours from the record, or from the ebooklet page script it was scraped from."""
+    if prog.get("credits"):
+        return int(prog["credits"])
+    source = prog.get("admission_requirements", "")
+    pid = re.escape(prog.get("id", ""))
+    match = (
+        re.search(r"[\"']" + pid + r"[\"'][^{}]*?credits:\s*(\d+)", source, re.S)
+        or re.search(pid + r"[\"']\s*:\s*\{[^}]*?credits:\s*(\d+)", source, re.S)
+    )
+    return int(match.group(1)) if match else None
+
+
+def _min_gpa(prog, prog_type):
+    if prog_type != "bachelor":
+        return None
+    gpa = _number(prog.get("admission_gpa"))
+    rule = MIN_GPA_BY_PROGRAM.get(prog.get("id"))
+    if rule is None:
+        rule = MIN_GPA_BY_FACULTY.get(prog.get("faculty_id"))
+    if rule is None and prog.get("name_ar", "").startswith("هندسة"):
+        rule = ENGINEERING_GPA
+    if rule is None:
+        return gpa
+    return max(gpa or 0, rule)
+
+
+class ProgramIndex:
+    """Typed program records with sorted price/GPA indexes and faculty/type maps."""
+
+    def __init__(self, programs, faculties, version=None):
+        self.version = version
+        self.programs = {p.id: p for p in programs}
+        self.faculties = faculties  # faculty_id -> {"ar": ..., "en": ...}
+
+        self.by_price = sorted((p.price_jod, p.id) for p in programs if p.price_jod is not None)
+        self.by_gpa = sorted((p.min_gpa, p.id) for p in programs if p.min_gpa is not None)
+        self.by_faculty = {}
+        self.by_type = {}
+        for p in programs:
+            self.by_type.setdefault(p.type, []).append(p.id)
+            if p.faculty_id:
+                self.by_faculty.setdefault(p.faculty_id, []).append(p.id)
+
+        self.families = self._build_families(programs)
+        self.linker = EntityLinker(self)
+
+    @staticmethod
+    def _build_families(programs):
+        """Groups the same subject across degree types ("التمريض" / "التمريض المشارك").
+
+        Two programs of different types are related when the words of one name
+        are contained in the other. Returns id -> frozenset of related ids.
+        """
+        words = {p.id: set(canonical(p.name_ar).split()) - {"و"} for p in programs}
+        related = {p.id: {p.id} for p in programs}
+        for a in programs:
+            for b in programs:
+                if a.type != b.type and words[a.id] and words[a.id] <= words[b.id]:
+                    related[a.id].add(b.id)
+                    related[b.id].add(a.id)
+        for a, b in FAMILY_PAIRS:
+            if a in related and b in related:
+                related[a].add(b)
+                related[b].add(a)
+        return {pid: frozenset(ids) for pid, ids in related.items() if len(ids) > 1}
+
+    def family(self, program_id):
+        """Related programs of other degree types, including program_id itself."""
+        return self.families.get(program_id, frozenset([program_id]))
+
+    def __len__(self):
+        return len(self.programs)
+
+    def price_between(self, low=None, high=None):
+        """Ids with low <= price_jod <= high, in ascending price order."""
+        prices = [price for price, _ in self.by_price]
+        start = 0 if low is None else bisect_left(prices, low)
+        end = len(prices) if high is None else bisect_right(prices, high)
+        return [pid for _, pid in self.by_price[start:end]]
+
+    def gpa_at_most(self, gpa):
+        """Bachelor ids whose minimum admission average is <= gpa."""
+        gpas = [value for value, _ in self.by_gpa]
+        return [pid for _, pid in self.by_gpa[:bisect_right(gpas, gpa)]]
+
+
+def build_index(data, version=None):
+    """Builds a ProgramIndex from the loaded meu_data.json."""
+    ebooklet = data.get("ebooklet", {})
+
+    faculties = {}
+    for fac in ebooklet.get("faculties", []):
+        faculties[fac.get("id")] = {"ar": fac.get("name"), "en": fac.get("nameEn")}
+
+    programs = []
+    for key, prog_type in PROGRAM_TYPES.items():
+        for prog in ebooklet.get(key, []):
+            faculty_id = prog.get("faculty_id")
+            if faculty_id and faculty_id not in faculties:
+                faculties[faculty_id] = {"ar": prog.get("faculty_ar"), "en": prog.get("faculty")}
+            programs.append(Program(
+                id=prog.get("id", ""),
+                name_ar=prog.get("name_ar", "Unknown Program"),
+                type=prog_type,
+                faculty_id=faculty_id,
+                faculty_ar=prog.get("faculty_ar"),
+                faculty_en=prog.get("faculty"),
+                price_jod=_number(prog.get("credit_hour_price_jod")),
+                price_usd=_number(prog.get("credit_hour_price_usd")),
+                min_gpa=_min_gpa(prog, prog_type),
+                credit_hours=_credit_hours(prog),
+                fees=[f.replace("\n", " ") for f in prog.get("fees", [])],
+            ))
+    return ProgramIndex(programs, faculties, version)
+
+
+# --- Query parsing -----------------------------------------------------------
+
+TYPE_WORDS = [
+    ("higher_diploma", ("دبلوم عالي", "higher diploma")),
+    ("master", ("ماجستير", "master", "mba")),
+    ("diploma", ("دبلوم", "diploma")),
+    ("bachelor", ("بكالوريوس", "bachelor")),
+]
+
+NUMBER = r"(\d+(?:\.\d+)?)"
+LESS_THAN = re.compile(r"(?:اقل|ارخص|تحت|دون|less|under|below|cheaper|lower)\s+(?:من\s+|than\s+)?" + NUMBER)
+MORE_THAN = re.compile(r"(?:اكثر|اعلي|اغلي|فوق|more|above|over|higher)\s+(?:من\s+|than\s+)?" + NUMBER)
+BETWEEN = re.compile(r"(?:بين|between)\s+" + NUMBER + r"\s+(?:و\s*|and\s+)" + NUMBER)
+PERCENT = re.compile(NUMBER + r"\s*%|%\s*" + NUMBER + r"|(?:معدل|معدلي|average|gpa)\s+" + NUMBER)
+CHEAPEST = re.compile(r"ارخص|اقل سعر|اقل تكلفه|cheapest|lowest price|least expensive")
+DEAREST = re.compile(r"اغلي|اعلي سعر|most expensive|highest price")
+COMPARE = re.compile(r"قارن|مقارنه|الفرق بين|compare|comparison|difference between|\bvs\b|versus")
+# A range is a price range only when its number reads as a price: a currency
+# right after it, or a price word just before the comparison ("hour price under 60").
+# "more than 18 hours" is a credit load, not a price.
+CURRENCY_AFTER = re.compile(r"\s*(?:دينار|دنانير|jod|jd|usd|دولار|\$)")
+PRICE_BEFORE = re.compile(r"(?:سعر|ثمن|تكلف\S*|رسوم|price|cost|fees?)(?:\s+\S+){0,3}\s*$")
+PRICE_COMPARISON = re.compile(r"ارخص|اغلي|cheaper")
+# An average alone filters the catalog only when the question asks for programs
+# ("which majors accept 65%"); "what if my average is 55%" is an admission question.
+CATALOG_WORDS = re.compile(r"تخصص|برامج|برنامج|program|major|speciali[sz]|ادرس|study")
+
+
+def mentioned_types(message):
+    """Degree types named in the message (ماجستير, دبلوم, bachelor, ...)."""
+    text = normalize_text(message)
+    found = []
+    for prog_type, words in TYPE_WORDS:
+        for word in words:
+            if word in text:
+                found.append(prog_type)
+                text = text.replace(word, " ")
+                break
+    return found
+
+
+def _about_price(text, match):
+    return bool(
+        CURRENCY_AFTER.match(text, match.end())
+        or PRICE_BEFORE.search(text, 0, match.start())
+        or PRICE_COMPARISON.match(match.group())
+    )
+
+
+def find_programs(index, text):
+    """Program ids mentioned in the text (see linker.EntityLinker)."""
+    return index.linker.program_ids(text)
+
+
+def parse_query(message, index):
+    """Parses a range / sort / compare question into structured operations.
+
+    Returns None when the message is not a structured question.
+    """
+    text = normalize_text(message)
+    query = {
+        "types": mentioned_types(text),
+        "faculty": next(iter(index.linker.faculty_ids(message)), None),  # raw: "IT" is matched in capitals
+        "price": None,
+        "gpa": None,
+        "sort": None,
+        "compare": None,
+    }
+
+    between = BETWEEN.search(text)
+    less = LESS_THAN.search(text)
+    more = MORE_THAN.search(text)
+    if between and _about_price(text, between):
+        query["price"] = (float(between.group(1)), float(between.group(2)))
+    elif less and _about_price(text, less):
+        query["price"] = (None, float(less.group(1)))
+    elif more and _about_price(text, more):
+        query["price"] = (float(more.group(1)), None)
+
+    percent = PERCENT.search(text)
+    if percent and CATALOG_WORDS.search(text):
+        query["gpa"] = float(next(g for g in percent.groups() if g))
+
+    if CHEAPEST.search(text):
+        query["sort"] = "asc"
+    elif DEAREST.search(text):
+        query["sort"] = "desc"
+
+    if COMPARE.search(text) or " و " in f" {text} ":
+        mentioned = find_programs(index, message)
+        if len(mentioned) >= 2 or (mentioned and len(query["types"]) >= 2):
+            query["compare"] = mentioned
+
+    if not (query["price"] or query["gpa"] or query["sort"] or query["compare"]):
+        return None
+    return query
+
+
+def run_query(index, query, limit=3):
+    """Executes a parsed query. Returns {"kind": "list" | "compare", "programs": [...]}."""
+    if query["compare"]:
+        ids = set(query["compare"])
+        # "nursing diploma and bachelor": pull in the same-named program of each mentioned type
+        if query["types"]:
+            names = {normalize_text(index.programs[pid].name_ar) for pid in ids}
+            for pid, prog in index.programs.items():
+                if prog.type in query["types"] and any(n in normalize_text(prog.name_ar) for n in names):
+                    ids.add(pid)
+            ids = {pid for pid in ids if index.programs[pid].type in query["types"]} or ids
+        programs = sorted((index.programs[pid] for pid in ids), key=lambda p: (p.type, p.price_jod or 0))
+        return {"kind": "compare", "programs": programs}
+
+    if query["price"]:
+        candidates = index.price_between(*query["price"])
+    else:
+        candidates = [pid for _, pid in index.by_price]
+
+    if query["gpa"] is not None:
+        allowed = set(index.gpa_at_most(query["gpa"]))
+        candidates = [pid for pid in candidates if pid in allowed]
+    if query["types"]:
+        allowed = {pid for t in query["types"] for pid in index.by_type.get(t, [])}
+        candidates = [pid for pid in candidates if pid in allowed]
+    if query["faculty"]:
+        allowed = set(index.by_faculty.get(query["faculty"], []))
+        candidates = [pid for pid in candidates if pid in allowed]
+
+    programs = [index.programs[pid] for pid in candidates]  # already in ascending price order
+    if query["sort"] == "desc":
+        programs.reverse()
+    if query["sort"]:
+        # Keep every program tied with the cheapest / most expensive one
+        best = programs[0].price_jod if programs else None
+        programs = [p for p in programs if p.price_jod == best] or programs[:limit]
+    return {"kind": "list", "programs": programs}
+
+
+PRICE_FACT = re.compile(r"سعر (?:ال)?ساعه|ثمن (?:ال)?ساعه|سعر الساعات|price per (?:credit )?hour|(?:credit )?hour price|cost per hour")
+HOURS_FACT = re.compile(r"عدد (?:ال)?ساعات|كم ساعه|credit hours|how many hours")
+GPA_FACT = re.compile(r"معدل (?:ال)?قبول|الحد الادني للمعدل|اقل معدل|minimum (?:average|gpa)|required (?:average|gpa)")
+
+
+def answer_fact(message, program):
+    """Answers a single-field question (hour price, credit hours, minimum average) about one program."""
+    text = normalize_text(message)
+    if PRICE_FACT.search(text) and program.price_jod is not None:
+        # Records without a USD price give the JOD one only
+        usd = program.price_usd
+        return (
+            f"سعر الساعة المعتمدة في {program.label}: {program.price_jod:g} دينار"
+            + (f" ({usd:g} USD).\n" if usd is not None else ".\n")
+            + f"Credit hour price: {program.price_jod:g} JOD" + (f" / {usd:g} USD." if usd is not None else ".")
+        )
+    if HOURS_FACT.search(text) and program.credit_hours:
+        return (
+            f"عدد الساعات المعتمدة في {program.label}: {program.credit_hours} ساعة.\n"
+            f"Total credit hours: {program.credit_hours}."
+        )
+    if GPA_FACT.search(text) and program.min_gpa:
+        return (
+            f"الحد الأدنى لمعدل القبول في {program.label} للطلبة الأردنيين: {program.min_gpa:g}%.\n"
+            f"Minimum admission average: {program.min_gpa:g}%."
+        )
+    return None
+
+
+def _program_line(prog):
+    line = f"- {prog.label}"
+    if prog.price_jod is not None:
+        usd = f" / {prog.price_usd:g} USD" if prog.price_usd is not None else ""
+        line += f": {prog.price_jod:g} دينار{usd} للساعة"
+    if prog.min_gpa:
+        line += f" | الحد الأدنى للمعدل {prog.min_gpa:g}%"
+    if prog.credit_hours:
+        line += f" | {prog.credit_hours} ساعة معتمدة"
+    return line
+
+
+def format_result(result):
+    """Formats a query result as a short bilingual answer / LLM context."""
+    programs = result["programs"]
+    if not programs:
+        return (
+            "لا توجد تخصصات مطابقة لهذه الشروط.\n"
+            "No programs match these criteria."
+        )
+    if result["kind"] == "compare":
+        lines = ["مقارنة التخصصات (Program comparison):"]
+        for prog in programs:
+            lines.append(_program_line(prog))
+            if prog.fees:
+                lines.append("  الرسوم الإضافية: " + " | ".join(prog.fees))
+        return "\n".join(lines)
+
+    lines = [f"التخصصات المطابقة ({len(programs)}) - Matching programs:"]
+    lines.extend(_program_line(prog) for prog in programs)
+    return "\n".join(lines)
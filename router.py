@@ -0,0 +1,95 @@
+import json
+import os
+import threading
+from collections import Counter
+
+# Models of the LLM tiers; comparisons and long multi-program questions go to the stronger one
+SMALL_MODEL = os.getenv("ROUTER_SMALL_MODEL", "gpt-4o-mini")
+COMPLEX_MODEL = os.getenv("ROUTER_COMPLEX_MODEL", "gpt-4o")
+
+# Tiers a question can be routed to. model None answers without the LLM, from
+# the retrieved canned answer ("Question: ... Answer: ..." chunks).
+DEFAULT_TIERS = {
+    "direct": {"model": None},
+    "small": {"model": SMALL_MODEL, "max_tokens": 250, "temperature": 0.3},
+    "default": {"model": SMALL_MODEL, "max_tokens": 500, "temperature": 0.7},
+    "complex": {"model": COMPLEX_MODEL, "max_tokens": 900, "temperature": 0.5},
+}
+
+# Rules in order, the first one whose conditions all hold wins; a rule without
+# conditions is the fallback. Conditions: intents (list), min_/max_ words,
+# entities, chunks and top_score (cosine similarity of the best chunk).
+DEFAULT_ROUTES = [
+    {"tier": "direct", "intents": ["canned"], "max_words": 6, "max_entities": 0, "min_top_score": 0.6},
+    {"tier": "complex", "intents": ["comparison"]},
+    {"tier": "complex", "min_entities": 3},
+    {"tier": "complex", "min_words": 40},
+    {"tier": "small", "intents": ["canned", "lookup"], "max_words": 12, "max_entities": 1},
+    {"tier": "default"},
+]
+
+FEATURES = ("words", "entities", "chunks", "top_score")
+
+
+def question_features(question, chunks, entities, intent, top_score=None):
+    """What a route can be chosen on, all known locally before the completion."""
+    return {
+        "intent": intent,
+        "words": len(question.split()),
+        "entities": len(entities),
+        "chunks": len(chunks),
+        "top_score": round(top_score, 3) if top_score is not None else None,
+    }
+
+
+def matches(rule, features):
+    if "intents" in rule and features["intent"] not in rule["intents"]:
+        return False
+    for name in FEATURES:
+        value = features.get(name)
+        if f"min_{name}" in rule and (value is None or value < rule[f"min_{name}"]):
+            return False
+        if f"max_{name}" in rule and (value is None or value > rule[f"max_{name}"]):
+            return False
+    return True
+
+
+class Router:
+    """Picks the model tier, token limit and temperature of a question from a rule table.
+
+    The table is plain data so it can be tuned without code changes: load()
+    reads {"tiers": {...}, "routes": [...]} from a JSON file, either key
+    replacing the default. Decisions are counted per tier and rule for /api/metrics.
+    """
+
+    def __init__(self, tiers=None, routes=None):
+        self.tiers = tiers or DEFAULT_TIERS
+        self.routes = routes or DEFAULT_ROUTES
+        for rule in self.routes:
+            if rule["tier"] not in self.tiers:
+                raise ValueError(f"Route to unknown tier '{rule['tier']}'")
+        self.decisions = Counter()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            table = json.load(f)
+        return cls(table.get("tiers"), table.get("routes"))
+
+    def route(self, features):
+        """(tier name, tier settings, index of the matching rule) for the features of a question."""
+        for index, rule in enumerate(self.routes):
+            if matches(rule, features):
+                with self._lock:
+                    self.decisions[rule["tier"]] += 1
+                return rule["tier"], self.tiers[rule["tier"]], index
+        # No fallback rule in the table: the default tier
+        with self._lock:
+            self.decisions["default"] += 1
+        return "default", self.tiers.get("default", DEFAULT_TIERS["default"]), None
+
+    def metrics(self):
+        with self._lock:
+            decisions = dict(self.decisions)
+        return {"decisions": decisions, "tiers": self.tiers}
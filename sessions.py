@@ -0,0 +1,270 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated);
+"""
+
+PRUNE_INTERVAL = 60  # seconds between deletions of expired SQLite sessions
+
+
+def new_session():
+    """An empty conversation.
+
+    state: what follow-up questions refer to (active program, its type and
+    faculty, chosen degree type, last intent, pending question); summary:
+    the last few turns, condensed; turns: how many turns it had.
+    """
+    return {"state": {}, "summary": [], "turns": 0}
+
+
+class SessionStore:
+    """Conversation sessions by id, expiring `ttl` seconds after their last turn.
+
+    A turn loads its session, runs the pipeline and saves it back while
+    holding the session's lock, so two requests of one session in the same
+    process never interleave. Sessions are stored as JSON, which is also
+    what the memory metrics count.
+    """
+
+    backend = None
+
+    def __init__(self, ttl=3600, max_sessions=10000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.stats = Counter()
+        self._locks = {}  # session id -> [lock, users]
+        self._locks_lock = threading.Lock()
+        self._async_locks = {}  # session id -> [asyncio.Lock, users]
+
+    def load(self, session_id):
+        """The stored session, or a new one."""
+        data = self._get(session_id)
+        self._count("hits" if data else "misses")
+        return {**new_session(), **json.loads(data)} if data else new_session()
+
+    def save(self, session_id, session):
+        self._set(session_id, json.dumps(session, ensure_ascii=False))
+
+    @contextmanager
+    def lock(self, session_id):
+        with self._locks_lock:
+            entry = self._locks.setdefault(session_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[session_id]
+
+    @asynccontextmanager
+    async def async_lock(self, session_id):
+        """lock() for coroutines on one event loop (asgi_app.py)."""
+        entry = self._async_locks.setdefault(session_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._async_locks[session_id]
+
+    def _count(self, name, n=1):
+        with self._locks_lock:
+            self.stats[name] += n
+
+    def metrics(self):
+        with self._locks_lock:
+            stats = dict(self.stats)
+        return {"backend": self.backend, "ttl": self.ttl, "max_sessions": self.max_sessions, **self._usage(), **stats}
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions of this process only, least recently used evicted past `max_sessions`."""
+
+    backend = "memory"
+
+    def __init__(self, ttl=3600, max_sessions=10000):
+        super().__init__(ttl, max_sessions)
+        self._data = OrderedDict()  # session id -> (expires_at, json)
+        self._lock = threading.Lock()
+
+    def _get(self, session_id):
+        with self._lock:
+            entry = self._data.get(session_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._data[session_id]
+                self._count("expired")
+                return None
+            return entry[1]
+
+    def _set(self, session_id, data):
+        with self._lock:
+            self._data[session_id] = (time.monotonic() + self.ttl, data)
+            self._data.move_to_end(session_id)
+            while len(self._data) > self.max_sessions:
+                self._data.popitem(last=False)
+                self._count("evicted")
+
+    def _usage(self):
+        with self._lock:
+            return {"sessions": len(self._data), "bytes": sum(len(data) for _, data in self._data.values())}
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions shared by all workers of one machine through a SQLite file (WAL mode)."""
+
+    backend = "sqlite"
+
+    def __init__(self, path, ttl=3600, max_sessions=10000):
+        super().__init__(ttl, max_sessions)
+        self.path = path
+        self._local = threading.local()
+        self._last_prune = 0
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        # sqlite3 connections cannot be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _get(self, session_id):
+        row = self._db().execute(
+            "SELECT data FROM sessions WHERE id = ? AND updated > ?", (session_id, time.time() - self.ttl)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, session_id, data):
+        now = time.time()
+        db = self._db()
+        with db:
+            db.execute(
+                "INSERT INTO sessions (id, data, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET data = excluded.data, updated = excluded.updated",
+                (session_id, data, now),
+            )
+        if now - self._last_prune > PRUNE_INTERVAL:
+            self._last_prune = now
+            self._prune(now)
+
+    def _prune(self, now):
+        db = self._db()
+        with db:
+            expired = db.execute("DELETE FROM sessions WHERE updated <= ?", (now - self.ttl,)).rowcount
+            evicted = db.execute(
+                "DELETE FROM sessions WHERE id IN (SELECT id FROM sessions ORDER BY updated DESC LIMIT -1 OFFSET ?)",
+                (self.max_sessions,),
+            ).rowcount
+        self._count("expired", expired)
+        self._count("evicted", evicted)
+
+    def _usage(self):
+        sessions, size = self._db().execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM sessions WHERE updated > ?", (time.time() - self.ttl,)
+        ).fetchone()
+        return {"sessions": sessions, "bytes": size}
+
+
+class RedisSessionStore(SessionStore):
+    """Sessions in Redis (or any server speaking its protocol, e.g. Valkey), shared by every node.
+
+    Needs the redis package (pip install redis). Expiry is Redis' own; past
+    max_sessions the server's maxmemory policy decides what to evict.
+    """
+
+    backend = "redis"
+    PREFIX = "chatbot:session:"
+
+    def __init__(self, url, ttl=3600, max_sessions=10000):
+        import redis
+
+        super().__init__(ttl, max_sessions)
+        self.redis = redis.Redis.from_url(url, socket_timeout=2)
+
+    def _get(self, session_id):
+        data = self.redis.get(self.PREFIX + session_id)
+        return data.decode("utf-8") if data else None
+
+    def _set(self, session_id, data):
+        self.redis.set(self.PREFIX + session_id, data, ex=self.ttl)
+
+    def _usage(self):
+        sessions = sum(1 for _ in self.redis.scan_iter(match=self.PREFIX + "*", count=1000))
+        return {"sessions": sessions, "server_bytes": self.redis.info("memory").get("used_memory")}
+
+
+class StateTokens:
+    """Stateless sessions: the conversation travels with every request as a signed token.
+
+    The answer carries a token of the session (its compact state and
+    summary), which the client sends back with its next message. Tokens are signed and zlib
+    compressed, not encrypted: the client can read its own conversation but
+    not change it. Any worker or node can serve any turn.
+    """
+
+    backend = "token"
+
+    def __init__(self, secret, ttl=3600):
+        self.ttl = ttl
+        self._serializer = URLSafeTimedSerializer(secret, salt="chat-state")
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def loads(self, token):
+        """The session in the token, or a new one when it is missing, expired or tampered with."""
+        if not token:
+            return new_session()
+        try:
+            session = self._serializer.loads(token, max_age=self.ttl)
+        except SignatureExpired:
+            self._count("expired")
+            return new_session()
+        except BadSignature:
+            self._count("invalid")
+            return new_session()
+        self._count("loaded")
+        return {**new_session(), **session}
+
+    def dumps(self, session):
+        token = self._serializer.dumps(session)
+        self._count("issued")
+        self._count("bytes", len(token))
+        return token
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        total_bytes = stats.pop("bytes", 0)
+        return {
+            "backend": self.backend,
+            "ttl": self.ttl,
+            "avg_token_bytes": round(total_bytes / stats["issued"]) if stats.get("issued") else None,
+            **stats,
+        }
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+from collections import Counter
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one execution.
+
+    The first caller (the leader) runs the function; callers arriving while it
+    runs wait for its result instead of running it again. A follower that
+    waits longer than the timeout, or whose leader failed, runs the function
+    itself.
+    """
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.stats = Counter()
+
+    def do(self, key, fn, timeout=None):
+        """Returns (result, shared): shared is True when the result came from another caller."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                call.followers += 1
+                leader = False
+
+        if not leader:
+            if not call.done.wait(self.timeout if timeout is None else timeout):
+                self._count("timeouts")
+                return fn(), False
+            if call.error is not None:
+                self._count("leader_errors")
+                return fn(), False
+            self._count("coalesced")
+            return call.result, True
+
+        self._count("leaders")
+        try:
+            call.result = fn()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def metrics(self):
+        with self._lock:
+            return {"in_flight": len(self._calls), **self.stats}
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines running on one event loop."""
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._calls = {}  # key -> future of the leader's result
+        self.stats = Counter()
+
+    async def do(self, key, make_coroutine, timeout=None):
+        """Returns (result, shared) like SingleFlight.do(); make_coroutine() starts the work."""
+        future = self._calls.get(key)
+        if future is not None:
+            try:
+                result = await asyncio.wait_for(asyncio.shield(future), self.timeout if timeout is None else timeout)
+            except asyncio.TimeoutError:
+                self.stats["timeouts"] += 1
+                return await make_coroutine(), False
+            except Exception:
+                self.stats["leader_errors"] += 1
+                return await make_coroutine(), False
+            self.stats["coalesced"] += 1
+            return result, True
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        self.stats["leaders"] += 1
+        try:
+            result = await make_coroutine()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            # A cancelled leader must not cancel its followers: they retry on their own
+            future.set_exception(e if isinstance(e, Exception) else RuntimeError("leader cancelled"))
+            future.exception()  # retrieved: no "never retrieved" warning when nobody waited
+            raise
+        finally:
+            del self._calls[key]
+
+    def metrics(self):
+        return {"in_flight": len(self._calls), **self.stats}
@@ -0,0 +1,43 @@
+import threading
+from collections import Counter, deque
+
+
+def _percentile(values, p):
+    """p-th percentile (0-100) of sorted values."""
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class StageTimings:
+    """Durations of the pipeline stages (moderation, embedding, completion, ...).
+
+    Keeps the most recent `window` samples of every stage for the averages and
+    percentiles reported in /api/metrics, and a running count of all samples.
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._samples = {}  # stage -> deque of seconds
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            samples = self._samples.get(stage)
+            if samples is None:
+                samples = self._samples[stage] = deque(maxlen=self.window)
+            samples.append(seconds)
+            self._counts[stage] += 1
+
+    def metrics(self):
+        with self._lock:
+            snapshot = {stage: sorted(samples) for stage, samples in self._samples.items()}
+            counts = dict(self._counts)
+        result = {}
+        for stage, values in snapshot.items():
+            result[stage] = {
+                "count": counts[stage],
+                "avg_ms": round(sum(values) / len(values) * 1000, 1),
+                "p50_ms": round(_percentile(values, 50) * 1000, 1),
+                "p95_ms": round(_percentile(values, 95) * 1000, 1),
+            }
+        return result
@@ -5,10 +5,22 @@ document.addEventListener('DOMContentLoaded', () => {
     const sendBtn = document.getElementById('sendBtn');
     const suggestionChips = document.querySelectorAll('.suggestion-chip');
 
+    // One conversation per tab, kept across reloads: the server stores its history under this id
+    const sessionId = sessionStorage.getItem('sessionId') || randomId();
+    sessionStorage.setItem('sessionId', sessionId);
+    // Servers without a session store (SESSION_STORE=token) return the conversation
+    // as a signed token with every answer; it goes back with the next message
+    let stateToken = sessionStorage.getItem('stateToken');
+
     // Suggestion Chips
     suggestionChips.forEach(chip => {
         chip.addEventListener('click', () => {
             const text = chip.textContent;
+            // Canonical questions have a cacheable GET endpoint
+            if (chip.dataset.faq) {
+                sendMessage(text, {}, `/api/faq/${chip.dataset.faq}`);
+                return;
+            }
             input.value = text;
             form.dispatchEvent(new Event('submit'));
         });
@@ -18,7 +30,12 @@ document.addEventListener('DOMContentLoaded', () => {
         e.preventDefault();
         const message = input.value.trim();
         if (!message) return;
+        await sendMessage(message);
+    });
 
+    // extra: additional request fields, e.g. { program_id } from a clarification option
+    // faqUrl: GET this precomputed answer instead of posting to /api/chat
+    async function sendMessage(message, extra = {}, faqUrl = null) {
         // Add User Message
         addMessage(message, 'user');
         input.value = '';
@@ -28,23 +45,13 @@ document.addEventListener('DOMContentLoaded', () => {
         const loadingId = addLoading();
 
         try {
-            const response = await fetch('/api/chat', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({ message: message })
-            });
-
-            const data = await response.json();
-            
-            // Remove Loading
-            removeMessage(loadingId);
-
-            if (data.error) {
-                addMessage('Sorry, something went wrong: ' + data.error, 'bot');
+            if (faqUrl) {
+                const response = await fetch(faqUrl);
+                showAnswer(await response.json(), loadingId);
             } else {
-                addMessage(data.response, 'bot');
+                const body = { message: message, session_id: sessionId, ...extra };
+                if (stateToken) body.state_token = stateToken;
+                await streamChat(body, loadingId);
             }
         } catch (err) {
             removeMessage(loadingId);
@@ -54,7 +61,98 @@ document.addEventListener('DOMContentLoaded', () => {
             sendBtn.disabled = false;
             input.focus();
         }
-    });
+    }
+
+    // data: an /api/chat payload; bubble: the message already showing the streamed tokens
+    function showAnswer(data, loadingId, bubble = null) {
+        // Remove Loading
+        removeMessage(loadingId);
+
+        const text = data.error ? 'Sorry, something went wrong: ' + data.error : data.response;
+        if (data.state_token) {
+            stateToken = data.state_token;
+            sessionStorage.setItem('stateToken', stateToken);
+        }
+        if (bubble) {
+            setContent(bubble, text);
+        } else {
+            addMessage(text, 'bot');
+        }
+        if (!data.error && data.options) addOptions(data.options);
+    }
+
+    // Server-sent events from /api/chat/stream: tokens are shown as they arrive,
+    // the final "done" event carries the full answer
+    async function streamChat(body, loadingId) {
+        const response = await postChat('/api/chat/stream', body);
+        const contentType = response.headers.get('Content-Type') || '';
+        if (!contentType.startsWith('text/event-stream')) {
+            showAnswer(await response.json(), loadingId);
+            return;
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let text = '';
+        let bubble = null;
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const event = parseEvent(buffer.slice(0, boundary));
+                buffer = buffer.slice(boundary + 2);
+                if (event.type !== 'token') {
+                    showAnswer(event.data, loadingId, bubble);
+                    return;
+                }
+                if (!bubble) {
+                    removeMessage(loadingId);
+                    bubble = addMessage('', 'bot');
+                }
+                text += event.data;
+                setContent(bubble, text);
+                scrollToBottom();
+            }
+        }
+        showAnswer({ error: 'The answer was interrupted.' }, loadingId, bubble);
+    }
+
+    function parseEvent(raw) {
+        let type = 'message';
+        const data = [];
+        raw.split('\n').forEach(line => {
+            if (line.startsWith('event:')) type = line.slice(6).trim();
+            else if (line.startsWith('data:')) data.push(line.slice(5).trim());
+        });
+        return { type: type, data: JSON.parse(data.join('\n')) };
+    }
+
+    // One idempotency key per message: a retry of the same message never runs twice on the server
+    async function postChat(url, body) {
+        const options = {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Idempotency-Key': randomId()
+            },
+            body: JSON.stringify(body)
+        };
+        try {
+            return await fetch(url, options);
+        } catch (err) {
+            // Network error: retry once with the same key
+            return await fetch(url, options);
+        }
+    }
+
+    function randomId() {
+        if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+        return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+    }
 
     function addMessage(text, sender) {
         const msgDiv = document.createElement('div');
@@ -67,7 +165,30 @@ document.addEventListener('DOMContentLoaded', () => {
         `;
         messagesDiv.appendChild(msgDiv);
         scrollToBottom();
-        return msgDiv.id = 'msg-' + Date.now();
+        msgDiv.id = 'msg-' + Date.now();
+        return msgDiv;
+    }
+
+    function setContent(msgDiv, text) {
+        msgDiv.querySelector('.message-content').innerHTML = text.replace(/\n/g, '<br>');
+    }
+
+    // Quick-reply buttons for "Diploma or Bachelor?" clarifications
+    function addOptions(options) {
+        const optionsDiv = document.createElement('div');
+        optionsDiv.className = 'message-options';
+        options.forEach(option => {
+            const btn = document.createElement('button');
+            btn.className = 'suggestion-chip';
+            btn.textContent = option.label;
+            btn.addEventListener('click', () => {
+                optionsDiv.remove();
+                sendMessage(option.label, { program_id: option.program_id });
+            });
+            optionsDiv.appendChild(btn);
+        });
+        messagesDiv.appendChild(optionsDiv);
+        scrollToBottom();
     }
 
     function addLoading() {
@@ -0,0 +1,35 @@
+import re
+
+# Arabic diacritics (tashkeel), superscript alef and tatweel
+ARABIC_DIACRITICS = re.compile(r"[ً-ْٰـ]")
+
+ARABIC_LETTER_MAP = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ة": "ه",
+    "ى": "ي",
+    "ؤ": "و",
+    "ئ": "ي",
+    # Arabic-Indic and Persian digits -> ASCII
+    "٠": "0", "١": "1", "٢": "2", "٣": "3", "٤": "4",
+    "٥": "5", "٦": "6", "٧": "7", "٨": "8", "٩": "9",
+    "۰": "0", "۱": "1", "۲": "2", "۳": "3", "۴": "4",
+    "۵": "5", "۶": "6", "۷": "7", "۸": "8", "۹": "9",
+})
+
+# Everything that is not a letter, digit, % or . (decimals) becomes a space
+PUNCTUATION = re.compile(r"[^\w%.]+|_")
+TRAILING_DOTS = re.compile(r"(?<!\d)\.|\.(?!\d)")
+
+def normalize_text(text):
+    """Normalizes Arabic/English text for matching (spelling variants, case, punctuation)."""
+    if not text:
+        return ""
+    text = ARABIC_DIACRITICS.sub("", text)
+    text = text.translate(ARABIC_LETTER_MAP).lower()
+    text = PUNCTUATION.sub(" ", text)
+    text = TRAILING_DOTS.sub(" ", text)
+    return " ".join(text.split())
+
+def tokenize(text):
+    """Returns the normalized tokens of a message."""
+    return normalize_text(text).split()
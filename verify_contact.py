@@ -3,7 +3,7 @@ import requests
 import time
 
 url = "http://127.0.0.1:5000/api/chat"
-headers = {"Content-Type": "application/json"}
+headers = {"Content-Type": "application/json", "X-Traffic-Class": "batch"}
 
 print("\n--- Verifying Contact Information ---")
 
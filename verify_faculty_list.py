@@ -3,7 +3,7 @@ import json
 import time
 
 url = "http://127.0.0.1:5000/api/chat"
-headers = {"Content-Type": "application/json"}
+headers = {"Content-Type": "application/json", "X-Traffic-Class": "batch"}
 
 # Wait for server to start
 time.sleep(5)
@@ -2,7 +2,7 @@ import requests
 import time
 
 url = "http://127.0.0.1:5000/api/chat"
-headers = {"Content-Type": "application/json"}
+headers = {"Content-Type": "application/json", "X-Traffic-Class": "batch"}
 
 time.sleep(5)
 
@@ -0,0 +1,88 @@
+"""Checks that pronoun follow-ups ("how many credit hours does it have") stay on the session's program.
+
+    python verify_followups.py
+
+Loads the knowledge base (needs OPENAI_API_KEY for the chunk embeddings). The
+follow-ups are answered from the program index, without the completion API.
+"""
+import sys
+
+import app
+import programs
+import sessions
+
+# Everyday sentences that must not name a program or faculty ("it" is not the IT faculty)
+NO_ENTITY = [
+    "how much is it?",
+    "how many credit hours does it have",
+    "Is the program taught in english?",
+    "is it taught in arabic",
+    "هل التدريس باللغة الانجليزية",
+    "هل المواد بالانجليزي",
+]
+
+# "IT" in capitals names the faculty, in English or Arabic messages, and filters a structured query
+FACULTY_IT = [
+    ("what about IT?", False),
+    ("ما هي تخصصات IT", False),
+    ("cheapest IT major", True),
+    ("ارخص تخصص في IT", True),
+]
+
+# Conversations of (question, text the answer must contain), all about one program
+CONVERSATIONS = [
+    ("computer-science", [
+        ("كم سعر الساعة في علم الحاسوب", "(computer-science)"),
+        ("how many credit hours does it have", "Total credit hours"),
+        ("what is the minimum average for it", "Minimum admission average"),
+    ]),
+    ("computer-science", [
+        ("what is the credit hour price in computer science", "(computer-science)"),
+        ("كم عدد الساعات فيه", "(computer-science)"),
+        ("how much is it?", None),
+    ]),
+]
+
+
+def run():
+    app.initialize_knowledge_base()
+    failures = 0
+
+    for question in NO_ENTITY:
+        matches = app.PROGRAM_INDEX.linker.link(question)
+        if matches:
+            failures += 1
+            print(f"FAIL (linked {[m.id for m in matches]}): {question}")
+
+    for question, structured in FACULTY_IT:
+        faculties = app.PROGRAM_INDEX.linker.faculty_ids(question)
+        if faculties != ["it"]:
+            failures += 1
+            print(f"FAIL (linked faculties {faculties}): {question}")
+        query = programs.parse_query(question, app.PROGRAM_INDEX)
+        if structured and (not query or query["faculty"] != "it"):
+            failures += 1
+            print(f"FAIL (query {query}): {question}")
+
+    for program_id, turns in CONVERSATIONS:
+        session = sessions.new_session()
+        for question, expected in turns:
+            if expected is None:
+                # Answered by the LLM: only check what the session keeps
+                steps = app.chat_steps(question, "verify", session)
+                next(steps, None)
+            else:
+                payload = app.run_steps(app.chat_steps(question, "verify", session))
+                if expected not in payload["response"]:
+                    failures += 1
+                    print(f"FAIL (expected '{expected}'): {question}\n{payload['response']}")
+            if session["state"].get("program_id") != program_id:
+                failures += 1
+                print(f"FAIL (active program {session['state'].get('program_id')}): {question}")
+
+    print(f"{len(NO_ENTITY) + len(FACULTY_IT)} sentences, {len(CONVERSATIONS)} conversations, {failures} failures")
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if run() else 0)
@@ -0,0 +1,77 @@
+"""Checks that a retried request is not run twice when it lands on another worker (idempotency.py).
+
+    python verify_idempotency.py
+
+Two IdempotencyStore instances stand for two gunicorn workers: separate
+in-memory entries, one shared SQLite file of completed results. Each turn
+appends to a SQLite session the way app.chat_request() does. No API calls.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+import idempotency
+import sessions
+
+
+def run():
+    directory = tempfile.mkdtemp()
+    shared = idempotency.SQLiteResults(os.path.join(directory, "idempotency.sqlite3"))
+    workers = [idempotency.IdempotencyStore(shared=shared) for _ in range(2)]
+    session_store = sessions.SQLiteSessionStore(os.path.join(directory, "sessions.sqlite3"))
+    runs = []
+    failures = 0
+
+    def turn(message, fail=False):
+        def run_turn():
+            runs.append(message)
+            if fail:
+                raise RuntimeError("upstream failed")
+            session = session_store.load("s1")
+            session["turns"] += 1
+            session_store.save("s1", session)
+            return {"response": f"answer to {message}"}
+        return run_turn
+
+    def check(name, condition):
+        nonlocal failures
+        if not condition:
+            failures += 1
+            print(f"FAIL: {name}")
+
+    # The retry of a completed request on the other worker replays it
+    first, outcome = workers[0].run("s1:k1", turn("fees"), fingerprint=("fees", None))
+    again, again_outcome = workers[1].run("s1:k1", turn("fees"), fingerprint=("fees", None))
+    check("retry on the other worker runs again", len(runs) == 1 and again_outcome == "replayed")
+    check("retry on the other worker gets another answer", again == first)
+    check("retry on the other worker appends the turn twice", session_store.load("s1")["turns"] == 1)
+
+    # ... and so does a coroutine (asgi_app.py)
+    async def replay_async():
+        async def coroutine():
+            return turn("fees")()
+        return await workers[1].run_async("s1:k1", coroutine, fingerprint=("fees", None))
+    check("async retry on the other worker runs again", asyncio.run(replay_async())[1] == "replayed" and len(runs) == 1)
+
+    # The key reused for another message is rejected on the other worker too
+    try:
+        workers[1].run("s1:k1", turn("dean"), fingerprint=("dean", None))
+        check("reused key on the other worker is accepted", False)
+    except idempotency.KeyReusedError:
+        pass
+
+    # A failed request is not shared: its retry runs
+    try:
+        workers[0].run("s1:k2", turn("admission", fail=True), fingerprint=("admission", None))
+    except RuntimeError:
+        pass
+    _, outcome = workers[1].run("s1:k2", turn("admission"), fingerprint=("admission", None))
+    check("retry of a failed request is not run", outcome == "new" and runs.count("admission") == 2)
+
+    print(f"{len(runs)} runs, {failures} failures")
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if run() else 0)
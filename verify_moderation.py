@@ -0,0 +1,80 @@
+"""Checks the local bad-words filter (profanity.py) against a corpus of clean and offensive messages.
+
+    python verify_moderation.py
+"""
+import sys
+
+from profanity import WordFilter
+
+# Real questions, several of which the old substring scan blocked
+# (ass in class / assignment, كلب in كلبش, زق in زقاق, كس in كسر ...)
+CLEAN = [
+    "ما هي شروط القبول في كلية الهندسة",
+    "كم سعر الساعة في تخصص علم الحاسوب",
+    "what are the admission requirements for the master of business administration",
+    "I have a class assignment about mass communication",
+    "is there an assistant for international students",
+    "how do I pass the english placement test",
+    "I need to assess my options, which classes are available",
+    "who is the dean of the faculty of pharmacy",
+    "my shift ends late, are there evening classes",
+    "Dickinson scholarship details please",
+    "can I register for the scrapbook workshop",
+    "هل يوجد قسم للطب البيطري لعلاج الكلاب",
+    "كسر في الجدول الدراسي، كيف أعدل التسجيل",
+    "أين يقع الزقاق المؤدي إلى مواقف السيارات",
+    "هل التخصص مناسب لزبون يعمل في البنك",
+    "أريد معلومات عن تكنيك التصميم الجرافيكي",
+    "كم رسوم امتحان الكفاءة",
+    "هل يوجد بكس لنقل الطلاب من الجامعة",
+    "ما تخصصات كلية الآداب والعلوم التربوية",
+    "السلام عليكم ورحمة الله",
+]
+
+OFFENSIVE = [
+    "you are so stupid",
+    "this bot is fucking useless",
+    "STUPID BOT",
+    "what an idiot",
+    "shitty answers",
+    "go to hell bitches",
+    "انت غبي",
+    "يا حمار",
+    "والكلب هذا ما بيفهم",
+    "يلعن هالجامعة",
+    "اللعنة على هذا البوت",
+    "يا ابن الكلب",
+    "إنت تافهة",
+    "بوت حقير",
+    "يا غَبِيّ",
+    "كلبة",
+    # Compounds, which a whole-word match alone lets through
+    "that is bullshit",
+    "you dumbass",
+    "what an asshole",
+    "motherfucker",
+    "you shithead",
+    "fuckin useless bot",
+    "damnit answer me",
+    "كسمك",
+]
+
+
+def run():
+    word_filter = WordFilter()
+    failures = 0
+    for message in CLEAN:
+        word = word_filter.find(message)
+        if word:
+            failures += 1
+            print(f"FAIL (blocked '{word}'): {message}")
+    for message in OFFENSIVE:
+        if not word_filter.find(message):
+            failures += 1
+            print(f"FAIL (not blocked): {message}")
+    print(f"{len(CLEAN)} clean, {len(OFFENSIVE)} offensive messages, {failures} failures")
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if run() else 0)
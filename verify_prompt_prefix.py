@@ -0,0 +1,55 @@
+"""Checks that every completion prompt starts with the same bytes, so OpenAI's prompt cache applies.
+
+    python verify_prompt_prefix.py
+
+Loads the knowledge base (needs OPENAI_API_KEY for the chunk embeddings) and
+builds the prompts of different turns without calling the completion API.
+"""
+import sys
+
+import app
+import sessions
+
+
+def run():
+    app.initialize_knowledge_base()
+    failures = 0
+
+    first_turn = sessions.new_session()
+    follow_up = sessions.new_session()
+    follow_up["state"].update(program_id="master-accounting", program_type="master", last_intent="llm")
+    app.remember_turn(follow_up, "ما شروط القبول في ماجستير المحاسبة", "الحصول على درجة البكالوريوس", "llm")
+    turns = [
+        (first_turn, "ما شروط القبول في كلية الهندسة", "Faculty (الكلية): كلية الهندسة"),
+        (first_turn, "how much is the credit hour in pharmacy", "Program (تخصص): الصيدلة (pharmacy)"),
+        (follow_up, "كم سعر الساعة", "Program (تخصص): المحاسبة (master-accounting)"),
+        (follow_up, "وما هي الوثائق المطلوبة", ""),
+    ]
+
+    prefixes = set()
+    for session, question, context in turns:
+        messages = app.build_messages(session, question, context)
+        prefix = messages[0]["content"].encode("utf-8")
+        prefixes.add(prefix)
+        if question in prefix.decode("utf-8") or context and context in prefix.decode("utf-8"):
+            failures += 1
+            print(f"FAIL (request data in the static prefix): {question}")
+        occurrences = sum(m["content"].count(question) for m in messages)
+        if occurrences != 1:
+            failures += 1
+            print(f"FAIL (question sent {occurrences} times): {question}")
+
+    if len(prefixes) != 1:
+        failures += 1
+        print(f"FAIL: {len(prefixes)} different prefixes")
+    if app.build_prompt_prefix(app.PROGRAM_INDEX).encode("utf-8") not in prefixes:
+        failures += 1
+        print("FAIL: rebuilding the prefix gives different bytes")
+
+    prefix = prefixes.pop()
+    print(f"Prefix: {len(prefix)} bytes, {len(turns)} prompts, {failures} failures")
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if run() else 0)
@@ -0,0 +1,94 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS warmups (
+    version TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    updated REAL NOT NULL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS faq_answers (
+    version TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    PRIMARY KEY (version, key)
+);
+"""
+
+
+class SharedWarmup:
+    """Lets one worker of the machine warm the caches of a knowledge-base version, through a SQLite file.
+
+    The first worker to claim() a version warms it; the others skip the
+    warm-up and read what it shares: the FAQ answers stored here, and the
+    answers it put in the semantic answer cache. A claim without progress for
+    `stale_after` seconds (a crashed worker) can be taken over.
+    """
+
+    def __init__(self, path, stale_after=300):
+        self.path = path
+        self.stale_after = stale_after
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._local = threading.local()
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        # sqlite3 connections cannot be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def claim(self, version):
+        """True if this process is the one to warm `version`."""
+        db = self._db()
+        now = time.time()
+        # IMMEDIATE: two workers never both read "unclaimed"
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # Other versions, once done or abandoned (a worker may still be warming the previous one)
+            db.execute("DELETE FROM warmups WHERE version != ? AND (finished IS NOT NULL OR updated < ?)", (version, now - self.stale_after))
+            db.execute("DELETE FROM faq_answers WHERE version != ? AND version NOT IN (SELECT version FROM warmups)", (version,))
+            row = db.execute("SELECT owner, updated, finished FROM warmups WHERE version = ?", (version,)).fetchone()
+            claimed = row is None or row[0] == self.owner or (row[2] is None and now - row[1] > self.stale_after)
+            if claimed:
+                db.execute(
+                    "INSERT INTO warmups (version, owner, updated) VALUES (?, ?, ?) "
+                    "ON CONFLICT(version) DO UPDATE SET owner = excluded.owner, updated = excluded.updated, finished = NULL",
+                    (version, self.owner, now),
+                )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return claimed
+
+    def progress(self, version, finished=False):
+        """Keeps the claim alive (or marks the warm-up done)."""
+        now = time.time()
+        self._db().execute(
+            "UPDATE warmups SET updated = ?, finished = ? WHERE version = ? AND owner = ?",
+            (now, now if finished else None, version, self.owner),
+        )
+
+    def done(self, version):
+        row = self._db().execute("SELECT finished FROM warmups WHERE version = ?", (version,)).fetchone()
+        return bool(row and row[0])
+
+    def get_faq(self, version, key):
+        row = self._db().execute("SELECT payload FROM faq_answers WHERE version = ? AND key = ?", (version, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_faq(self, version, key, payload):
+        self._db().execute(
+            "INSERT OR REPLACE INTO faq_answers (version, key, payload) VALUES (?, ?, ?)",
+            (version, key, json.dumps(payload, ensure_ascii=False)),
+        )